@@ -0,0 +1,67 @@
+"""
+Bulk-loading synthetic documents into a fresh index with its default
+settings, and with the settings `sheer index` uses while loading
+(refreshes and replicas off, optionally an async translog).
+
+Needs a running cluster; it creates and deletes indices named
+sheer-bench-*.
+
+    SHEER_ELASTICSEARCH_HOSTS=localhost:9200 PYTHONPATH=. \
+        python benchmarks/bench_bulk_settings.py
+"""
+import os
+import time
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+
+from sheer.indexer import bulk_load_settings
+from sheer.utility import parse_es_hosts
+
+DOCUMENTS = 50000
+REFRESH_INTERVAL = '100ms'
+WORDS = ('sheer publishes content from elasticsearch using jinja templates '
+         'and markdown files with yaml frontmatter').split()
+
+
+def documents(index_name):
+    for i in range(DOCUMENTS):
+        yield {'_index': index_name,
+               '_id': str(i),
+               'title': 'Post %d' % i,
+               'tags': [WORDS[i % len(WORDS)], WORDS[(i * 7) % len(WORDS)]],
+               'text': ' '.join(WORDS[(i + j) % len(WORDS)]
+                                for j in range(200))}
+
+
+def load(es, index_name, **settings):
+    es.indices.create(index=index_name, settings={
+        'index.refresh_interval': REFRESH_INTERVAL})
+    try:
+        started = time.time()
+        if settings:
+            with bulk_load_settings(es, index_name, **settings):
+                bulk(es, documents(index_name))
+        else:
+            bulk(es, documents(index_name))
+            es.indices.refresh(index=index_name)
+        return DOCUMENTS / (time.time() - started)
+    finally:
+        es.indices.delete(index=index_name)
+
+
+def main():
+    hosts = parse_es_hosts(os.environ.get('SHEER_ELASTICSEARCH_HOSTS',
+                                          'localhost:9200'))
+    es = Elasticsearch(hosts)
+    print("%d documents, refresh_interval %s" % (DOCUMENTS, REFRESH_INTERVAL))
+    print("index defaults:           %8.0f docs/sec"
+          % load(es, 'sheer-bench-defaults'))
+    print("bulk load settings:       %8.0f docs/sec"
+          % load(es, 'sheer-bench-bulk', async_translog=False))
+    print("bulk load, async translog: %7.0f docs/sec"
+          % load(es, 'sheer-bench-async', async_translog=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Cold-start template compile cost with and without the on-disk bytecode cache.
+
+Each round simulates a freshly started worker: a new Jinja environment that
+has to turn every layout, include and page of a synthetic site into a
+Template. "warm" is the in-process cache hit the worker reaches afterwards.
+
+    PYTHONPATH=. python benchmarks/bench_bytecode_cache.py
+"""
+import os
+import shutil
+import tempfile
+import timeit
+
+import jinja2
+from jinja2.bccache import FileSystemBytecodeCache
+
+from sheer.templates import compile_template
+
+PAGES = 200
+ROUNDS = 5
+
+LAYOUT = """<html><head><title>{% block title %}{% endblock %}</title></head>
+<body>{% for item in nav %}<a href="{{ item.url }}">{{ item.title|e }}</a>
+{% endfor %}{% block content %}{% endblock %}</body></html>
+"""
+
+PAGE = """{% extends "base.html" %}
+{% block title %}Page NUMBER{% endblock %}
+{% block content %}
+{% for post in posts %}
+  <h2>{{ post.title }}</h2>{% if post.date %}{{ post.date|string }}{% endif %}
+  {% for tag in post.tags %}<span>{{ tag|upper }}</span>{% endfor %}
+{% else %}<p>Nothing here</p>{% endfor %}
+{% endblock %}
+"""
+
+
+def make_site():
+    site = tempfile.mkdtemp()
+    sources = {os.path.join(site, '_layouts', 'base.html'): LAYOUT}
+    for i in range(PAGES):
+        path = os.path.join(site, 'page%d' % i, 'index.html')
+        sources[path] = PAGE.replace('NUMBER', str(i))
+    return site, sources
+
+
+def cold_start(sources, bytecode_cache=None):
+    environment = jinja2.Environment(bytecode_cache=bytecode_cache)
+    return dict((path, compile_template(environment, source, None, path))
+                for path, source in sources.items())
+
+
+def main():
+    site, sources = make_site()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        no_cache = min(timeit.repeat(lambda: cold_start(sources),
+                                     number=1, repeat=ROUNDS))
+
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        cold_start(sources, bytecode_cache)  # first worker fills the cache
+        with_cache = min(timeit.repeat(
+            lambda: cold_start(sources, FileSystemBytecodeCache(cache_dir)),
+            number=1, repeat=ROUNDS))
+
+        compiled = cold_start(sources)
+        warm = min(timeit.repeat(
+            lambda: [compiled[path] for path in sources],
+            number=1, repeat=ROUNDS))
+    finally:
+        shutil.rmtree(site)
+        shutil.rmtree(cache_dir)
+
+    templates = len(sources)
+    print("%d templates per worker start" % templates)
+    print("cold, no bytecode cache:   %.2f ms" % (no_cache * 1000))
+    print("cold, with bytecode cache: %.2f ms" % (with_cache * 1000))
+    print("warm, in-process cache:    %.2f ms" % (warm * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Six single-facet possible_values_for calls versus one
+possible_values_for_fields call, against a fake Elasticsearch client with a
+fixed per-request latency.
+
+    PYTHONPATH=. python benchmarks/bench_facets.py
+"""
+import time
+import timeit
+
+import flask
+import mock
+
+from sheer.mappings import MappingRegistry
+from sheer.query import Query
+
+FACETS = ['tags', 'category', 'author', 'year', 'topic', 'audience']
+LATENCY = 0.005
+ROUNDS = 20
+
+
+def slow_search(**kwargs):
+    time.sleep(LATENCY)
+    aggs = kwargs['body'].get('aggs', {})
+    return {'hits': {'total': 0, 'hits': []},
+            'aggregations': dict((name, {'buckets': []}) for name in aggs)}
+
+
+def main():
+    es = mock.Mock()
+    es.search.side_effect = slow_search
+    app = flask.Flask(__name__)
+    app.es = es
+    app.es_index = 'content'
+    app.mappings = MappingRegistry(es, 'content')
+    definition = {'query': {'size': 10}}
+
+    with app.test_request_context('/'):
+        query = Query('posts.json', definition=definition)
+        single = min(timeit.repeat(
+            lambda: [query.possible_values_for(f) for f in FACETS],
+            number=1, repeat=ROUNDS))
+        calls_single = es.search.call_count // ROUNDS
+        es.search.reset_mock()
+        combined = min(timeit.repeat(
+            lambda: query.possible_values_for_fields(FACETS),
+            number=1, repeat=ROUNDS))
+        calls_combined = es.search.call_count // ROUNDS
+
+    print("%d facets, %.0f ms simulated latency per search"
+          % (len(FACETS), LATENCY * 1000))
+    print("possible_values_for x%d:    %6.1f ms, %d searches"
+          % (len(FACETS), single * 1000, calls_single))
+    print("possible_values_for_fields: %6.1f ms, %d search"
+          % (combined * 1000, calls_combined))
+
+
+if __name__ == '__main__':
+    main()
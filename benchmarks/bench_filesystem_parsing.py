@@ -0,0 +1,67 @@
+"""
+Parsing a directory of markdown files with frontmatter on one process, and
+on a pool of processes (one per core by default).
+
+    PYTHONPATH=. python benchmarks/bench_filesystem_parsing.py [workers]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from sheer.processors import filesystem
+
+FILES = 5000
+POST = u"""---
+title: Post number %(i)d
+author: Someone
+categories:
+  - Website
+  - News
+tags: [one, two, three]
+date: 2014-06-%(day)02d 10:30:00
+---
+%(body)s
+"""
+
+
+def write_site(directory):
+    body = "\n\n".join(["A paragraph of post text that goes on for a while."
+                        * 10] * 20)
+    for i in range(FILES):
+        day = i % 28 + 1
+        path = os.path.join(directory, '2014-06-%02d-post-%d.md' % (day, i))
+        with open(path, 'w') as f:
+            f.write(POST % {'i': i, 'day': day, 'body': body})
+
+
+def timed(directory, workers):
+    started = time.time()
+    count = sum(1 for document in
+                filesystem.documents('posts', directory=directory,
+                                     workers=workers))
+    assert count == FILES
+    return time.time() - started
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 \
+        else multiprocessing.cpu_count()
+    directory = tempfile.mkdtemp() + '/'
+    try:
+        write_site(directory)
+        serial = timed(directory, 1)
+        parallel = timed(directory, workers)
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d files" % FILES)
+    print("1 process:    %6.2f s, %6.0f docs/sec" % (serial, FILES / serial))
+    print("%d processes: %6.2f s, %6.0f docs/sec"
+          % (workers, parallel, FILES / parallel))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Parsing synthetic posts with document_from_str, against the previous
+approach: a whole-document regex to find the frontmatter and the
+pure-Python YAML loader. Half the posts have simple `key: value`
+frontmatter, half have lists and quoted values.
+
+    PYTHONPATH=. python benchmarks/bench_frontmatter.py
+"""
+import re
+import timeit
+
+import yaml
+
+from sheer import reader
+
+POSTS = 4000
+ROUNDS = 3
+OLD_FRONTMATTER = re.compile(r'^\s*---(.*)---\s*$', flags=re.MULTILINE | re.S)
+
+SIMPLE = u"""---
+title: Post number %(i)d
+author: Someone
+layout: post
+published: true
+date: 2014-06-%(day)02d 10:30:00
+---
+%(body)s
+"""
+
+COMPLEX = u"""---
+_id: '%(i)d'
+title: Post number %(i)d
+categories:
+- Website
+- News
+tags: [one, two, three]
+date: 2014-06-%(day)02d 10:30:00
+---
+%(body)s
+"""
+
+
+def old_document_from_str(data):
+    match = OLD_FRONTMATTER.match(data)
+    document = yaml.load(match.groups(1)[0], Loader=yaml.Loader)
+    document['text'] = data[match.end():]
+    return document
+
+
+def main():
+    body = "\n\n".join(["A paragraph of post text that goes on for a while."
+                        * 10] * 20)
+    posts = [(SIMPLE if i % 2 else COMPLEX) %
+             {'i': i, 'day': i % 28 + 1, 'body': body}
+             for i in range(POSTS)]
+
+    for post in posts[:2]:
+        assert reader.document_from_str(post) == old_document_from_str(post)
+
+    old = min(timeit.repeat(
+        lambda: [old_document_from_str(p) for p in posts],
+        number=1, repeat=ROUNDS))
+    new = min(timeit.repeat(
+        lambda: [reader.document_from_str(p) for p in posts],
+        number=1, repeat=ROUNDS))
+
+    print("%d posts, LibYAML %s" % (POSTS, "available" if
+                                    yaml.__with_libyaml__ else "missing"))
+    print("regex + yaml.Loader:        %6.0f ms" % (old * 1000))
+    print("delimiter scan + fast path: %6.0f ms" % (new * 1000))
+
+
+if __name__ == '__main__':
+    main()
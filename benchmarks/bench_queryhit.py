@@ -0,0 +1,112 @@
+"""
+Per-access cost of reading QueryHit attributes.
+
+Compares the old path (field lookup, mapping walk and dateutil parse on every
+access) with the compiled coercer table plus per-hit memoization.
+
+    PYTHONPATH=. python benchmarks/bench_queryhit.py
+"""
+import timeit
+
+import flask
+import mock
+import dateutil.parser
+
+from sheer.mappings import MappingRegistry
+from sheer.query import QueryHit, field_or_source_value
+
+ACCESSES = 5
+HITS = 2000
+
+MAPPING = {'content': {'mappings': {'posts': {'properties': {
+    'title': {'type': 'text'},
+    'date': {'type': 'date'},
+    'comment_count': {'type': 'integer'},
+    'tags': {'type': 'keyword'}}}}}}
+
+HIT = {'_type': 'posts', '_id': '1',
+       '_source': {'title': 'A post', 'date': '2015-01-11T09:34:40',
+                   'comment_count': 12, 'tags': ['a', 'b', 'c']}}
+
+
+# QueryHit.__getattr__ as it was before the coercer tables: walk the
+# mapping for the field's type, then coerce with a table built per call,
+# parsing dates with dateutil.
+def legacy_datatype(fieldname, hit_type, mapping_dict):
+    es_index = flask.current_app.es_index
+    try:
+        return mapping_dict[es_index]["mappings"][hit_type]["properties"][fieldname]["type"]
+    except KeyError:
+        return None
+
+
+def legacy_coerced_value(value, datatype):
+    if datatype == None or value == None:
+        return value
+
+    TYPE_MAP = {'string': str,
+                'text': str,
+                'keyword': str,
+                'date': dateutil.parser.parse,
+                'dict': dict,
+                'float': float,
+                'long': float,
+                'integer': int,
+                'boolean': bool}
+
+    coercer = TYPE_MAP.get(datatype, str)
+
+    if type(value) == list:
+        if value and type(value[0]) == list:
+            return [[coercer(y) for y in v] for v in value]
+        else:
+            return [coercer(v) for v in value] or ""
+    else:
+        return coercer(value)
+
+
+def legacy_access(hit_dict, attrname):
+    value = field_or_source_value(attrname, hit_dict)
+    datatype = legacy_datatype(attrname, 'posts', MAPPING)
+    return legacy_coerced_value(value, datatype)
+
+
+def run_legacy():
+    for i in range(HITS):
+        for j in range(ACCESSES):
+            legacy_access(HIT, 'date')
+            legacy_access(HIT, 'title')
+            legacy_access(HIT, 'tags')
+
+
+def run_compiled(registry):
+    for i in range(HITS):
+        hit = QueryHit(HIT, mappings=registry)
+        for j in range(ACCESSES):
+            hit.date
+            hit.title
+            hit.tags
+
+
+def main():
+    es = mock.Mock()
+    es.indices.get_mapping.return_value = MAPPING
+    app = flask.Flask(__name__)
+    app.es = es
+    app.es_index = 'content'
+    registry = MappingRegistry(es, 'content')
+
+    accesses = HITS * ACCESSES * 3
+    with app.app_context():
+        legacy = min(timeit.repeat(run_legacy, number=1, repeat=3))
+        compiled = min(timeit.repeat(lambda: run_compiled(registry),
+                                     number=1, repeat=3))
+
+    print("legacy:   %.3f us/access" % (legacy / accesses * 1e6))
+    print("compiled: %.3f us/access (including QueryHit construction)"
+          % (compiled / accesses * 1e6))
+    print("speedup:  %.1fx" % (legacy / compiled))
+
+
+if __name__ == '__main__':
+    main()
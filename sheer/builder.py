@@ -1,3 +1,250 @@
+import os
+import sys
+import json
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+
+from elasticsearch.helpers import scan
+
+from .dependencies import (BuildManifest, PageDependencies, document_digest,
+                           parse_document_key, search_digest)
+from .indexer import read_json_file
+from .query import send_search
+from .views import always_404_pattern
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT = '_site'
+DEFAULT_WORKERS = 4
+MGET_CHUNK_SIZE = 500
+
+
+def is_private(name):
+    # Sheer never serves paths with a part beginning with _ or .
+    return name.startswith('_') or name.startswith('.')
+
+
+def site_files(root_dir):
+    """
+    Yield the URL path of every file under `root_dir` that Sheer would
+    serve: pages are the .html files, everything else is static.
+    """
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = sorted(d for d in dirnames if not is_private(d))
+        relative_dir = os.path.relpath(dirpath, root_dir)
+        for filename in sorted(filenames):
+            if is_private(filename):
+                continue
+            relative_path = os.path.normpath(os.path.join(relative_dir,
+                                                          filename))
+            yield '/' + relative_path.replace(os.sep, '/')
+
+
+def page_url(path):
+    if path == '/index.html' or path.endswith('/index.html'):
+        return path[:-len('index.html')]
+    return path
+
+
+def lookup_ids(es, es_index):
+    """
+    The ids of every document in the index, without their sources.
+
+    Elasticsearch 7+ has no mapping types and the indexer doesn't write a
+    type field, so there is nothing to tell one lookup's documents from
+    another's by.
+    """
+    query = {'query': {'match_all': {}}}
+    for hit in scan(es, index=es_index, query=query, _source=False):
+        yield hit['_id']
+
+
+def lookup_urls(app):
+    """
+    Expand each document lookup in _settings/lookups.json once for every
+    document in the index.
+    """
+    lookups_json_path = os.path.join(app.root_dir, '_settings/lookups.json')
+    if not os.path.exists(lookups_json_path):
+        return
+    lookup_configs = read_json_file(lookups_json_path)
+    for name, configuration in sorted(lookup_configs.items()):
+        if configuration.get('type') is None:
+            continue
+        for docid in lookup_ids(app.es, app.es_index):
+            with app.test_request_context():
+                yield flask.url_for(name, id=docid)
+
+
+def output_path(output_dir, url):
+    if url.endswith('/'):
+        url += 'index.html'
+    return os.path.join(output_dir, *url[1:].split('/'))
+
+
+def write_file(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'wb') as output_file:
+        output_file.write(content)
+
+
+def render_page(app, url, output_dir):
+    """
+    Render `url` through the app and write it where a static server would
+    look for it. Returns an error message (None on success), and what the
+    page depended on.
+    """
+    dependencies = PageDependencies()
+    if always_404_pattern.search(url):
+        return None, dependencies
+    try:
+        with app.test_request_context(url):
+            flask.g.sheer_dependencies = dependencies
+            response = app.full_dispatch_request()
+            if response.status_code != 200:
+                return ('%s returned %s' % (url, response.status_code),
+                        dependencies)
+            write_file(output_path(output_dir, url), response.get_data())
+    except Exception as e:
+        logger.debug("failed to render %s", url, exc_info=True)
+        return '%s failed: %s' % (url, e), dependencies
+    return None, dependencies
+
+
+def changed_searches(app, keys, executor):
+    """
+    Send each search again and return the keys whose results differ from
+    the digests in `keys`.
+    """
+    def changed(item):
+        key, digest = item
+        try:
+            with app.app_context():
+                response = send_search(app.es, json.loads(key))
+        except Exception:
+            logger.debug("could not check %s", key, exc_info=True)
+            return key
+        if search_digest(response) != digest:
+            return key
+
+    return set(key for key in executor.map(changed, keys.items()) if key)
+
+
+def changed_documents(app, documents):
+    """
+    Fetch the documents (without rendering anything) and return the keys
+    whose sources differ from the digests in `documents`. Each document is
+    fetched with the same `_source` filtering the page used.
+    """
+    by_params = {}
+    for key in documents:
+        docid, params = parse_document_key(key)
+        group = json.dumps(params, sort_keys=True)
+        by_params.setdefault(group, (params, {}))[1][docid] = key
+
+    changed = set()
+    for group in sorted(by_params):
+        params, keys = by_params[group]
+        ids = sorted(keys)
+        for start in range(0, len(ids), MGET_CHUNK_SIZE):
+            chunk = ids[start:start + MGET_CHUNK_SIZE]
+            response = app.es.mget(index=app.es_index, body={'ids': chunk},
+                                   **params)
+            current = dict((doc['_id'], document_digest(doc))
+                           for doc in response['docs'])
+            changed.update(keys[docid] for docid in chunk
+                           if current.get(docid) != documents[keys[docid]])
+    return changed
+
+
+def copy_static(source, destination):
+    if os.path.exists(destination):
+        source_stat = os.stat(source)
+        destination_stat = os.stat(destination)
+        if source_stat.st_size == destination_stat.st_size and \
+                source_stat.st_mtime == destination_stat.st_mtime:
+            return
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copy2(source, destination)
+
+
+def remove_page(output_dir, url):
+    path = output_path(output_dir, url)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def build_site(app, output_dir, workers=DEFAULT_WORKERS, incremental=False):
+    """
+    Write a static copy of the site to `output_dir`. Static files are
+    copied as they are; pages and lookup URLs are rendered by `workers`
+    threads. Returns the error messages for pages that could not be built.
+
+    With `incremental`, only pages whose templates, query files, searches
+    or documents changed since the last build are rendered again.
+    """
+    root_dir = app.root_dir
+    output_dir = os.path.abspath(output_dir)
+    pages = []
+    for path in site_files(root_dir):
+        source = os.path.join(root_dir, *path[1:].split('/'))
+        if os.path.abspath(source).startswith(output_dir + os.sep):
+            continue
+        if path.endswith('.html'):
+            pages.append(page_url(path))
+        else:
+            copy_static(source, output_path(output_dir, path))
+    pages.extend(lookup_urls(app))
+
+    manifest = BuildManifest.for_output(output_dir)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        if incremental:
+            for url in set(manifest.pages) - set(pages):
+                remove_page(output_dir, url)
+                manifest.remove(url)
+            stale = set(manifest.stale_pages(
+                pages, manifest.changed_files(),
+                changed_searches(app, manifest.searches, executor),
+                changed_documents(app, manifest.documents)))
+            stale = [url for url in pages if url in stale or
+                     not os.path.exists(output_path(output_dir, url))]
+        else:
+            manifest.clear()
+            stale = pages
+
+        results = executor.map(lambda url: render_page(app, url, output_dir),
+                               stale)
+        errors = []
+        for url, (error, dependencies) in zip(stale, results):
+            if error:
+                errors.append(error)
+                manifest.remove(url)
+            else:
+                manifest.add(url, dependencies)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest.save()
+    sys.stdout.write("built %s of %s pages in %s\n" % (
+        len(stale) - len(errors), len(pages), output_dir))
+    return errors
+
+
 def build_with_cli_args(args, config):
-    # TODO this function should create a static version of the site
-    pass
+    from .wsgi import app_with_config
+
+    config['production'] = True
+    app = app_with_config(config)
+    output_dir = getattr(args, 'output', None) or \
+        os.path.join(config['location'], DEFAULT_OUTPUT)
+    errors = build_site(app, output_dir,
+                        workers=getattr(args, 'workers', DEFAULT_WORKERS),
+                        incremental=getattr(args, 'incremental', False))
+    for error in errors:
+        sys.stderr.write("%s\n" % error)
+    if errors:
+        sys.exit(1)
@@ -7,6 +7,7 @@ import logging
 import sheer.indexer
 import sheer.server
 import sheer.builder
+import sheer.sitemap
 
 from sheer.utility import parse_es_hosts
 
@@ -15,6 +16,13 @@ ELASTICSEARCH_HOSTS = os.environ.get('SHEER_ELASTICSEARCH_HOSTS',
                                      'localhost:9200')
 ELASTICSEARCH_INDEX = os.environ.get('SHEER_ELASTICSEARCH_INDEX', 'content')
 DEBUG = bool(os.environ.get('SHEER_DEBUG', False))
+PRODUCTION = bool(os.environ.get('SHEER_PRODUCTION', False))
+BYTECODE_CACHE = os.environ.get('SHEER_BYTECODE_CACHE')
+DEFER_QUERIES = bool(os.environ.get('SHEER_DEFER_QUERIES', False))
+RESULT_CACHE_SIZE = int(os.environ.get('SHEER_RESULT_CACHE_SIZE', 0))
+SEARCH_TIMEOUT = os.environ.get('SHEER_SEARCH_TIMEOUT')
+STALE_AFTER = os.environ.get('SHEER_STALE_AFTER')
+LEARN_SOURCE_FIELDS = bool(os.environ.get('SHEER_LEARN_SOURCE_FIELDS', False))
 
 def run_cli():
 
@@ -29,6 +37,32 @@ def run_cli():
                               help="Recreate the index and reindex all content.")
     index_parser.add_argument('--processors', '-p', nargs='*',
                               help='Content processors to index.')
+    index_parser.add_argument('--workers', '-w', type=int, default=1,
+                              help="Number of threads sending documents to Elasticsearch. Default is 1.")
+    index_parser.add_argument('--chunk-size', type=int,
+                              help="Number of documents in each bulk request. Default is 500.")
+    index_parser.add_argument('--max-chunk-bytes', type=int,
+                              help="Largest bulk request to send, in bytes. Default is 100MB.")
+    index_parser.add_argument('--parse-workers', type=int, default=1,
+                              help="Number of processes parsing markdown files for each directory. Default is 1.")
+    index_parser.add_argument('--max-body-bytes', type=int,
+                              help="Cut the text of markdown files off after this many bytes.")
+    index_parser.add_argument('--processor-concurrency', type=int, default=1,
+                              help="Number of content processors to run at once. Default is 1.")
+    index_parser.add_argument('--keep-indices', type=int, default=1,
+                              help="Number of old indices to keep after a --reindex. Default is 1.")
+    index_parser.add_argument('--keep-index-settings', action='store_true',
+                              help="Leave refreshes and replicas on while a --reindex loads documents.")
+    index_parser.add_argument('--bulk-load-settings', action='store_true',
+                              help="Turn refreshes and replicas off while loading documents into "
+                                   "the live index. --reindex always does.")
+    index_parser.add_argument('--async-translog', action='store_true',
+                              help="Fsync the translog in the background while bulk-load settings "
+                                   "are on.")
+    index_parser.add_argument('--watch', action='store_true',
+                              help="After indexing, keep indexing markdown files as they change.")
+    index_parser.add_argument('--incremental', action='store_true',
+                              help="Only send documents that changed since the last incremental run, and delete ones that are gone.")
     index_parser.set_defaults(func=sheer.indexer.index_location)
 
     server_parser=subparsers.add_parser('serve', help= "Serve content from Elasticsearch, using configuration and templates at location.")
@@ -37,11 +71,40 @@ def run_cli():
             default= '7000', help="Port to run the web server on.")
     server_parser.add_argument('--addr', '-a',
             default= '0.0.0.0', help="Address to run the web server on.")
+    server_parser.add_argument('--production', action='store_true', default=PRODUCTION,
+            help="Never check compiled templates for changes on disk. You can also set the SHEER_PRODUCTION environment variable.")
+    server_parser.add_argument('--bytecode-cache', default=BYTECODE_CACHE,
+            help="Directory for compiled template bytecode, shared by all workers. You can also set the SHEER_BYTECODE_CACHE environment variable.")
+    server_parser.add_argument('--defer-queries', action='store_true', default=DEFER_QUERIES,
+            help="Send all of a page's searches in one _msearch request. You can also set the SHEER_DEFER_QUERIES environment variable.")
+    server_parser.add_argument('--result-cache-size', type=int, default=RESULT_CACHE_SIZE,
+            help="Number of search results to keep in memory until the next 'sheer index'. Default is 0 (off). You can also set the SHEER_RESULT_CACHE_SIZE environment variable.")
+    server_parser.add_argument('--search-timeout', type=float, default=SEARCH_TIMEOUT,
+            help="Seconds to wait for each Elasticsearch search or get. You can also set the SHEER_SEARCH_TIMEOUT environment variable.")
+    server_parser.add_argument('--stale-after', type=float, default=STALE_AFTER,
+            help="Seconds to wait for a search before serving its last good results, refreshing them in the background. You can also set the SHEER_STALE_AFTER environment variable.")
+    server_parser.add_argument('--learn-source-fields', action='store_true', default=LEARN_SOURCE_FIELDS,
+            help="Record which fields templates read from each query's hits in _settings/source_fields.json. You can also set the SHEER_LEARN_SOURCE_FIELDS environment variable.")
 
     build_parser=subparsers.add_parser('build', help='Generate a static version of this site.')
+    build_parser.add_argument('--output', '-o',
+            help="Directory to write the site to. Default is _site in the site directory.")
+    build_parser.add_argument('--workers', '-w', type=int, default=sheer.builder.DEFAULT_WORKERS,
+            help="Number of pages to render at once. Default is 4.")
+    build_parser.add_argument('--incremental', action='store_true', default=False,
+            help="Only render the pages whose templates, queries or content changed since the last build.")
     build_parser.set_defaults(func=sheer.builder.build_with_cli_args)
 
-    for p in [parser, index_parser, server_parser]:
+    sitemap_parser = subparsers.add_parser('sitemap', help='Write a sitemap index and sitemaps for every document with a permalink.')
+    sitemap_parser.add_argument('--base-url', '-b', required=True,
+            help="URL the site is served from, such as https://www.example.com/")
+    sitemap_parser.add_argument('--output', '-o',
+            help="Directory to write the sitemaps to. Default is _site in the site directory.")
+    sitemap_parser.add_argument('--max-urls', type=int, default=sheer.sitemap.MAX_URLS_PER_SITEMAP,
+            help="Most URLs to put in one sitemap file. Default is 50000.")
+    sitemap_parser.set_defaults(func=sheer.sitemap.sitemap_with_cli_args)
+
+    for p in [parser, index_parser, server_parser, build_parser, sitemap_parser]:
         p.add_argument('--debug', help="Print debugging output to the console.", action='store_true', default=DEBUG)
         p.add_argument('--location', '-l', default=LOCATION, help="Directory you want to operate on. You can also set the SHEER_LOCATION environment variable.")
         p.add_argument('--elasticsearch', '-e', default=ELASTICSEARCH_HOSTS, help="Elasticsearch host:port pairs. Separate hosts with commas. Default is localhost:9200. You can also set the SHEER_ELASTICSEARCH_HOSTS environment variable.")
@@ -0,0 +1,183 @@
+import os
+import json
+import codecs
+import hashlib
+
+import flask
+
+from .incremental import document_hash
+
+MANIFEST_FILENAME = '.sheer_build.json'
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def search_digest(response):
+    """
+    A digest of the parts of a search response a page can show, leaving
+    out timings.
+    """
+    return document_hash({'hits': response.get('hits'),
+                          'aggregations': response.get('aggregations')})
+
+
+def document_digest(response):
+    if not response or response.get('found') is False:
+        return None
+    return document_hash(response.get('_source'))
+
+
+class PageDependencies(object):
+    """
+    What went into rendering one page: the template and query files that
+    were read, and a digest of each search response and document it used.
+    """
+
+    def __init__(self):
+        self.files = set()
+        self.searches = {}
+        self.documents = {}
+
+
+def current_dependencies():
+    if not flask.has_app_context():
+        return None
+    return getattr(flask.g, 'sheer_dependencies', None)
+
+
+def record_file(path):
+    dependencies = current_dependencies()
+    if dependencies is not None and path:
+        dependencies.files.add(os.path.realpath(path))
+
+
+def record_search(key, response):
+    dependencies = current_dependencies()
+    if dependencies is not None:
+        dependencies.searches[key] = search_digest(response)
+
+
+def document_key(docid, params=None):
+    """
+    The manifest key for a document fetched with the `_source` filtering
+    in `params`: the bare id when the whole source was fetched.
+    """
+    if not params:
+        return str(docid)
+    return json.dumps([str(docid), params], sort_keys=True)
+
+
+def parse_document_key(key):
+    """
+    The `(docid, params)` a key from `document_key` was made from.
+    """
+    if key.startswith('['):
+        try:
+            docid, params = json.loads(key)
+            return docid, params
+        except ValueError:
+            pass
+    return key, {}
+
+
+def record_document(docid, response, params=None):
+    dependencies = current_dependencies()
+    if dependencies is not None:
+        key = document_key(docid, params)
+        dependencies.documents[key] = document_digest(response)
+
+
+class BuildManifest(object):
+    """
+    The dependencies of every page in a built site, kept in a JSON file in
+    the output directory so `sheer build --incremental` can tell which
+    pages need rendering again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.files = {}
+        self.searches = {}
+        self.documents = {}
+        if os.path.exists(path):
+            with codecs.open(path, 'r', 'utf-8') as manifest_file:
+                try:
+                    manifest = json.loads(manifest_file.read())
+                except ValueError:
+                    manifest = {}
+            self.pages = manifest.get('pages', {})
+            self.files = manifest.get('files', {})
+            self.searches = manifest.get('searches', {})
+            self.documents = manifest.get('documents', {})
+
+    @classmethod
+    def for_output(cls, output_dir):
+        return cls(os.path.join(output_dir, MANIFEST_FILENAME))
+
+    def clear(self):
+        self.pages = {}
+        self.files = {}
+        self.searches = {}
+        self.documents = {}
+
+    def add(self, url, dependencies):
+        for path in dependencies.files:
+            self.files[path] = file_digest(path)
+        self.searches.update(dependencies.searches)
+        self.documents.update(dependencies.documents)
+        self.pages[url] = {'files': sorted(dependencies.files),
+                           'searches': sorted(dependencies.searches),
+                           'documents': sorted(dependencies.documents)}
+
+    def remove(self, url):
+        self.pages.pop(url, None)
+
+    def stale_pages(self, urls, files, searches, documents):
+        """
+        The urls that are new, or that depend on a file, search or document
+        in the given sets of changed ones.
+        """
+        stale = []
+        for url in urls:
+            page = self.pages.get(url)
+            if page is None or \
+                    files.intersection(page['files']) or \
+                    searches.intersection(page['searches']) or \
+                    documents.intersection(page['documents']):
+                stale.append(url)
+        return stale
+
+    def changed_files(self):
+        return set(path for path, digest in self.files.items()
+                   if file_digest(path) != digest)
+
+    def prune(self):
+        # Forget anything no page depends on any more
+        used = {'files': set(), 'searches': set(), 'documents': set()}
+        for page in self.pages.values():
+            for kind in used:
+                used[kind].update(page[kind])
+        self.files = dict((k, v) for k, v in self.files.items()
+                          if k in used['files'])
+        self.searches = dict((k, v) for k, v in self.searches.items()
+                             if k in used['searches'])
+        self.documents = dict((k, v) for k, v in self.documents.items()
+                              if k in used['documents'])
+
+    def save(self):
+        self.prune()
+        serialized = json.dumps({'pages': self.pages,
+                                 'files': self.files,
+                                 'searches': self.searches,
+                                 'documents': self.documents})
+        temporary_path = self.path + '.tmp'
+        with codecs.open(temporary_path, 'w', 'utf-8') as manifest_file:
+            manifest_file.write(serialized)
+        os.rename(temporary_path, self.path)
@@ -1,3 +1,11 @@
 
 class NoSuitableSourceFile(Exception):
     pass
+
+
+class InvalidQueryFile(Exception):
+    pass
+
+
+class ElasticsearchUnavailable(Exception):
+    pass
@@ -2,11 +2,9 @@ from urlparse import urljoin
 from flask import request
 from werkzeug.contrib.atom import AtomFeed
 import flask
-import os
 import dateutil.parser
 
 from .query import QueryFinder
-from .indexer import read_json_file
 
 PARAM_TOKEN = '$$'
 ALLOWED_FEED_PARAMS = ('feed_title', 'feed_url')
@@ -22,10 +20,8 @@ def make_external(url):
 
 def get_feed_settings(name):
     app = flask.current_app
-    queries_dir = os.path.join(app.root_dir, '_queries')
-    query_path = os.path.join(queries_dir, '{0}.json'.format(name))
-    if os.path.exists(query_path):
-        query_file = read_json_file(query_path)
+    query_file = app.query_registry.get(name)
+    if query_file:
         return query_file.get('feed')
 
 
@@ -0,0 +1,103 @@
+import os
+import json
+import codecs
+import hashlib
+import threading
+
+STATE_FILENAME = '.sheer_index_state.json'
+
+
+def document_hash(document):
+    serialized = json.dumps(document, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+class ProcessorState(object):
+    """
+    The content hashes of the documents one processor indexed last time,
+    and of the ones it is indexing now.
+    """
+
+    def __init__(self, index_state, index_name, processor_name, previous):
+        self.index_state = index_state
+        self.index_name = index_name
+        self.processor_name = processor_name
+        self.previous = previous
+        self.current = {}
+        self.unchanged = 0
+
+    def changed(self, documents):
+        """
+        Yield only the documents that are new or have changed since the last
+        run. Documents without an `_id` can't be tracked, so they are
+        always sent.
+        """
+        for document in documents:
+            docid = document.get('_id')
+            if docid is None:
+                yield document
+                continue
+            docid = str(docid)
+            digest = document_hash(document)
+            self.current[docid] = digest
+            if self.previous.get(docid) == digest:
+                self.unchanged += 1
+            else:
+                yield document
+
+    def removed(self):
+        """
+        The ids of documents indexed last time that weren't seen this time.
+        """
+        return [docid for docid in self.previous if docid not in self.current]
+
+    def commit(self):
+        self.index_state.update(self.index_name, self.processor_name,
+                                self.current)
+
+
+class IndexState(object):
+    """
+    Content hashes of indexed documents, by index and processor, kept in a
+    JSON file so the next `sheer index --incremental` can skip documents
+    that haven't changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with codecs.open(path, 'r', 'utf-8') as state_file:
+                try:
+                    self.hashes = json.loads(state_file.read())
+                except ValueError:
+                    self.hashes = {}
+
+    @classmethod
+    def for_location(cls, location):
+        return cls(os.path.join(location, STATE_FILENAME))
+
+    def processor(self, index_name, processor_name):
+        previous = self.hashes.get(index_name, {}).get(processor_name, {})
+        return ProcessorState(self, index_name, processor_name, previous)
+
+    def update(self, index_name, processor_name, hashes):
+        with self._lock:
+            self.hashes.setdefault(index_name, {})[processor_name] = hashes
+
+    def clear(self, index_name, processor_names=None):
+        with self._lock:
+            if processor_names is None:
+                self.hashes.pop(index_name, None)
+            else:
+                for name in processor_names:
+                    self.hashes.get(index_name, {}).pop(name, None)
+
+    def save(self):
+        with self._lock:
+            serialized = json.dumps(self.hashes)
+        temporary_path = self.path + '.tmp'
+        with codecs.open(temporary_path, 'w', 'utf-8') as state_file:
+            state_file.write(serialized)
+        os.rename(temporary_path, self.path)
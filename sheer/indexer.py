@@ -1,17 +1,26 @@
 import os
+import re
 import sys
+import time
 import codecs
+import datetime
 from collections import OrderedDict
 import json
 
 import glob
 import importlib
+import traceback
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, parallel_bulk
 
 from sheer.utility import add_site_libs
+from sheer.incremental import IndexState
+from sheer.watcher import ChangeIndexer, make_watcher, watch
 from sheer.processors.helpers import IndexHelper
+from sheer.mappings import GENERATION_META_KEY, index_mapping, index_meta
 
 DO_NOT_INDEX = ['_settings/',
                 '_layouts/',
@@ -20,6 +29,21 @@ DO_NOT_INDEX = ['_settings/',
                 '_lib/',
                 '_tests/']
 
+FILESYSTEM_PROCESSOR = 'sheer.processors.filesystem'
+
+# How many failed documents to describe when a bulk load has errors
+MAX_REPORTED_FAILURES = 10
+
+# A full reindex loads `<index>-<timestamp>` and then points the alias
+# `<index>` at it.
+VERSIONED_INDEX_FORMAT = '%Y%m%d%H%M%S%f'
+DEFAULT_KEEP_INDICES = 1
+
+# Index settings while documents are being loaded
+BULK_LOAD_SETTINGS = {'index.refresh_interval': '-1',
+                      'index.number_of_replicas': 0}
+ASYNC_TRANSLOG_SETTINGS = {'index.translog.durability': 'async'}
+
 
 def read_json_file(path):
         if os.path.exists(path):
@@ -48,7 +72,154 @@ class ContentProcessor(object):
             return None
 
 
-def index_processor(es, index_name, processor, reindex=False):
+def bump_index_generation(es, index_name):
+    """
+    Store a new generation marker in the `_meta` of the index mapping. Running
+    Sheer apps compare it with the generation their caches were built under.
+    """
+    generation = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    # put_mapping replaces `_meta` as a whole, so keep what settings.json
+    # put there.
+    meta = index_meta(es, index_name)
+    meta[GENERATION_META_KEY] = generation
+    es.indices.put_mapping(index=index_name, body={'_meta': meta})
+    return generation
+
+
+def versioned_index_name(alias):
+    return '%s-%s' % (alias, datetime.datetime.utcnow().strftime(
+        VERSIONED_INDEX_FORMAT))
+
+
+def versioned_indices(es, alias):
+    """
+    The names of the versioned indices built for `alias`, newest first.
+    """
+    pattern = re.compile(r'^%s-\d{20}$' % re.escape(alias))
+    indices = es.indices.get(index='%s-*' % alias)
+    return sorted((name for name in indices if pattern.match(name)),
+                  reverse=True)
+
+
+def create_index(es, index_name, settings_path):
+    if os.path.exists(settings_path):
+        with open(settings_path, 'r') as f:
+            es.indices.create(index=index_name, body=f.read())
+    else:
+        es.indices.create(index=index_name)
+
+
+@contextlib.contextmanager
+def bulk_load_settings(es, index_name, async_translog=False):
+    """
+    Turn off refreshes and replicas for `index_name` while documents are
+    loaded into it, then put back the settings it had and refresh it, even
+    if loading fails.
+
+    With `async_translog`, the translog is also only fsynced in the
+    background, so a crashed node can lose the last few seconds of writes.
+    """
+    bulk_settings = dict(BULK_LOAD_SETTINGS)
+    if async_translog:
+        bulk_settings.update(ASYNC_TRANSLOG_SETTINGS)
+
+    current = es.indices.get_settings(index=index_name, flat_settings=True)
+    settings = {}
+    for index_settings in getattr(current, 'body', current).values():
+        settings = index_settings.get('settings', {})
+    # Settings that weren't set are put back to their defaults with None
+    restore = dict((key, settings.get(key)) for key in bulk_settings)
+
+    es.indices.put_settings(index=index_name, settings=bulk_settings)
+    try:
+        yield
+    finally:
+        es.indices.put_settings(index=index_name, settings=restore)
+        es.indices.refresh(index=index_name)
+
+
+def swap_alias(es, alias, index_name):
+    """
+    Point `alias` at `index_name` and nothing else, in one atomic update. If
+    `alias` is still a plain index from before Sheer used aliases, that
+    index is deleted in the same update.
+    """
+    actions = []
+    if es.indices.exists_alias(name=alias):
+        for old_index in es.indices.get_alias(name=alias):
+            if old_index != index_name:
+                actions.append({'remove': {'index': old_index,
+                                           'alias': alias}})
+    elif es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    es.indices.update_aliases(actions=actions)
+
+
+def prune_indices(es, alias, keep=DEFAULT_KEEP_INDICES):
+    """
+    Delete the versioned indices for `alias`, other than the one it points
+    at and the `keep` newest of the rest.
+    """
+    live = set()
+    if es.indices.exists_alias(name=alias):
+        live = set(es.indices.get_alias(name=alias))
+    old_indices = [name for name in versioned_indices(es, alias)
+                   if name not in live]
+    for name in old_indices[keep:]:
+        print("deleting old index %s" % name)
+        es.indices.delete(index=name)
+
+
+def bulk_options(chunk_size=None, max_chunk_bytes=None):
+    options = {}
+    if chunk_size:
+        options['chunk_size'] = chunk_size
+    if max_chunk_bytes:
+        options['max_chunk_bytes'] = max_chunk_bytes
+    return options
+
+
+def parallel_index(es, documents, workers, **options):
+    """
+    Send `documents` to Elasticsearch in chunks from `workers` threads,
+    reading them from the iterator as the chunks are sent. Returns the
+    number of documents indexed and a list of the failed bulk items.
+    """
+    indexed = 0
+    failures = []
+    for ok, item in parallel_bulk(es, documents, thread_count=workers,
+                                  raise_on_error=False,
+                                  raise_on_exception=False, **options):
+        if ok:
+            indexed += 1
+        else:
+            failures.append(item)
+    return indexed, failures
+
+
+def report_failures(processor, failures):
+    sys.stderr.write("failed to index %s documents for %s\n" %
+                     (len(failures), processor.name))
+    for item in failures[:MAX_REPORTED_FAILURES]:
+        for action, details in item.items():
+            sys.stderr.write("  %s %s: %s\n" % (action, details.get('_id'),
+                                                details.get('error')))
+
+
+def delete_documents(es, index_name, docids):
+    """
+    Delete the documents with the given ids, ignoring any that are already
+    gone. Returns the number deleted.
+    """
+    actions = ({'_op_type': 'delete', '_index': index_name, '_id': docid}
+               for docid in docids)
+    deleted, errors = bulk(es, actions, raise_on_error=False)
+    return deleted
+
+
+def index_processor(es, index_name, processor, reindex=False, workers=1,
+                    chunk_size=None, max_chunk_bytes=None, state=None):
     """
     Index all the documents provided by the given content processor for
     the given index in the given Elasticsearch instance.
@@ -56,11 +227,18 @@ def index_processor(es, index_name, processor, reindex=False):
     If reindex=True and the processor already exists the mapping in
     Elasticsearch will be destroyed and recreated and all documents will
     be created anew.
+
+    With more than one worker, documents are sent in chunks of
+    `chunk_size` documents (or `max_chunk_bytes` bytes) from that many
+    threads at once.
+
+    Given a ProcessorState, only new and changed documents are sent, and
+    documents the processor no longer provides are deleted.
     """
     # Get existing mapping
     try:
         mapping = es.indices.get_mapping(index=index_name)
-        has_mapping = processor.name in mapping.get(index_name, {}).get('mappings', {})
+        has_mapping = processor.name in index_mapping(mapping, index_name).get('mappings', {})
     except:
         has_mapping = False
         mapping = {}
@@ -94,8 +272,18 @@ def index_processor(es, index_name, processor, reindex=False):
         sys.stderr.write("error making connection for %s" % processor.name)
         index_success = False
 
+    if state is not None:
+        document_iterator = state.changed(document_iterator)
+
+    options = bulk_options(chunk_size, max_chunk_bytes)
+    started = time.time()
     try:
-        result = bulk(es, document_iterator)
+        if workers > 1:
+            indexed, failures = parallel_index(es, document_iterator,
+                                               workers, **options)
+        else:
+            # bulk raises BulkIndexError itself if any document fails
+            indexed, failures = bulk(es, document_iterator, **options)[0], []
     except ValueError:
         # There may be a ValueError (or JSONDecodeError, a subclass of
         # ValueError) raised by json.loads() with the API's supposedly JSON
@@ -103,10 +291,79 @@ def index_processor(es, index_name, processor, reindex=False):
         sys.stderr.write("error reading documents for %s" % processor.name)
         index_success = False
     else:
-        sys.stdout.write("indexed %s %s \n" % (result[0], processor.name))
+        elapsed = max(time.time() - started, 0.001)
+        sys.stdout.write("indexed %s %s (%.0f docs/sec) \n" %
+                         (indexed, processor.name, indexed / elapsed))
+        if failures:
+            report_failures(processor, failures)
+            index_success = False
+
+    # Only remember what was indexed if all of it was
+    if state is not None and index_success:
+        deleted = delete_documents(es, index_name, state.removed())
+        sys.stdout.write("skipped %s unchanged and deleted %s removed %s \n" %
+                         (state.unchanged, deleted, processor.name))
+        state.commit()
     return index_success
 
 
+def index_processors(es, index_name, processors, concurrency=1,
+                     index_state=None, state_index=None, **kwargs):
+    """
+    Run `index_processor` for each processor, up to `concurrency` of them at
+    a time, and return the names of the ones that failed in the order the
+    processors were given.
+
+    With an IndexState, each processor indexes incrementally. Its hashes are
+    kept under `state_index` (the alias, when loading a versioned index),
+    which defaults to `index_name`.
+    """
+    def index(processor):
+        state = None
+        if index_state is not None:
+            state = index_state.processor(state_index or index_name,
+                                          processor.name)
+        return index_processor(es, index_name, processor, state=state,
+                               **kwargs)
+
+    if concurrency <= 1:
+        return [processor.name for processor in processors
+                if not index(processor)]
+
+    def run(processor):
+        try:
+            return index(processor)
+        except Exception:
+            sys.stderr.write("error indexing %s\n%s" %
+                             (processor.name, traceback.format_exc()))
+            return False
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, processors))
+    return [processor.name for processor, index_success
+            in zip(processors, results) if not index_success]
+
+
+def watch_processors(es, index_name, processors, max_body_bytes=None):
+    """
+    Keep indexing the files in the directories of the given filesystem
+    processors as they are created, changed and deleted, until interrupted.
+    """
+    directories = [processor.kwargs['directory'] for processor in processors
+                   if processor.processor_name == FILESYSTEM_PROCESSOR]
+    if not directories:
+        sys.exit("There are no filesystem content processors to watch")
+
+    print("watching %s" % ", ".join(directories))
+    change_indexer = ChangeIndexer(
+        es, index_name, directories, max_body_bytes,
+        on_batch=lambda: bump_index_generation(es, index_name))
+    try:
+        watch(make_watcher(directories), change_indexer)
+    except KeyboardInterrupt:
+        pass
+
+
 def index_location(args, config):
 
     path = config['location']
@@ -125,19 +382,28 @@ def index_location(args, config):
     es = Elasticsearch(config["elasticsearch"])
     index_name = config["index"]
 
+    # Content hashes from the last run, so unchanged documents aren't resent
+    index_state = None
+    if getattr(args, 'incremental', False):
+        index_state = IndexState.for_location(path)
+        if args.reindex:
+            index_state.clear(index_name, args.processors or None)
+
     # If we're given args.reindex and NOT given a list of processors to reindex,
-    # we're expected to reindex everything. Delete the existing index.
-    if not args.processors and args.reindex and es.indices.exists(index_name):
-        print("reindexing %s" % index_name)
-        es.indices.delete(index_name)
+    # we're expected to reindex everything. That goes into a new index, and
+    # the site keeps serving the current one until it's done.
+    full_reindex = args.reindex and not args.processors
+    target_index = index_name
+    if full_reindex:
+        target_index = versioned_index_name(index_name)
+        print("reindexing %s into %s" % (index_name, target_index))
+        create_index(es, target_index, settings_path)
 
     # If the index doesn't exist, create it.
-    if not es.indices.exists(index_name):
-        if os.path.exists(settings_path):
-            with open(settings_path, 'r') as f:
-                es.indices.create(index=index_name, body=f.read())
-        else:
-            es.indices.create(index=index_name)
+    elif not es.indices.exists(index_name):
+        if index_state is not None:
+            index_state.clear(index_name)
+        create_index(es, index_name, settings_path)
 
     processors = []
     processor_settings = read_json_file(processors_path)
@@ -161,7 +427,9 @@ def index_location(args, config):
         processor_name = f[processor_name_starts:-1]
         processor_args = dict(directory=f,
                               site_root=path,
-                              processor="sheer.processors.filesystem")
+                              workers=getattr(args, 'parse_workers', 1),
+                              max_body_bytes=getattr(args, 'max_body_bytes', None),
+                              processor=FILESYSTEM_PROCESSOR)
         processors.append(ContentProcessor(processor_name, **processor_args))
 
     # If any specific content processors were selected, we run them. Otherwise
@@ -170,15 +438,56 @@ def index_location(args, config):
     if args.processors and len(args.processors) > 0:
         selected_processors = [p for p in processors if p.name in args.processors]
 
-    failed_processors = []
-    for processor in selected_processors:
-        index_sucess = index_processor(es,
-                                       index_name,
-                                       processor,
-                                       reindex=args.reindex)
-        if not index_sucess:
-            failed_processors.append(processor.name)
+    def run_processors():
+        return index_processors(
+            es, target_index, selected_processors,
+            concurrency=getattr(args, 'processor_concurrency', 1),
+            index_state=index_state,
+            state_index=index_name,
+            reindex=args.reindex,
+            workers=getattr(args, 'workers', 1),
+            chunk_size=getattr(args, 'chunk_size', None),
+            max_chunk_bytes=getattr(args, 'max_chunk_bytes', None))
+
+    # A new versioned index isn't searched until the alias moves to it, so
+    # it's always loaded with bulk settings; the live index only when asked.
+    if full_reindex:
+        use_bulk_settings = not getattr(args, 'keep_index_settings', False)
+    else:
+        use_bulk_settings = getattr(args, 'bulk_load_settings', False)
+
+    if use_bulk_settings:
+        with bulk_load_settings(es, target_index,
+                                async_translog=getattr(args, 'async_translog', False)):
+            failed_processors = run_processors()
+    else:
+        failed_processors = run_processors()
+
+    if index_state is not None:
+        if full_reindex and failed_processors:
+            # The alias still points at the old index, which doesn't have
+            # what this run indexed.
+            index_state.clear(index_name)
+        index_state.save()
+
+    # Even a partly failed run has changed the index contents.
+    bump_index_generation(es, target_index)
+
+    if full_reindex:
+        if failed_processors:
+            sys.stderr.write("%s was not switched to %s, since indexing "
+                             "failed\n" % (index_name, target_index))
+        else:
+            swap_alias(es, index_name, target_index)
+            print("%s now points to %s" % (index_name, target_index))
+            prune_indices(es, index_name,
+                          getattr(args, 'keep_indices', DEFAULT_KEEP_INDICES))
+
     # Exit with an error code != 0 if there were any issues with indexing
     if failed_processors:
         sys.exit("Indexing the following processor(s) failed: {}".format(
             ", ".join(failed_processors)))
+
+    if getattr(args, 'watch', False):
+        watch_processors(es, index_name, selected_processors,
+                         getattr(args, 'max_body_bytes', None))
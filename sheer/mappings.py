@@ -0,0 +1,239 @@
+import re
+import time
+import logging
+import datetime
+import threading
+
+import dateutil.parser
+
+logger = logging.getLogger(__name__)
+
+GENERATION_META_KEY = 'sheer_generation'
+DEFAULT_MAPPING_TTL = 300
+# How often a MappingRegistry or ResultCache asks Elasticsearch for the
+# index generation
+DEFAULT_GENERATION_CHECK_INTERVAL = 1
+
+SIMPLE_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}:\d{2})?$')
+
+
+def parse_date(value):
+    # Plain ISO dates and datetimes are what we index; skip dateutil's
+    # general-purpose parser for those.
+    if isinstance(value, str) and SIMPLE_ISO_DATE.match(value):
+        return datetime.datetime.fromisoformat(value)
+    return dateutil.parser.parse(value)
+
+
+TYPE_COERCERS = {'string': str,
+                 'text': str,
+                 'keyword': str,
+                 'date': parse_date,
+                 'dict': dict,
+                 'float': float,
+                 'long': float,
+                 'integer': int,
+                 'boolean': bool}
+
+
+def coercer_for_datatype(datatype):
+    if datatype is None:
+        return None
+    return TYPE_COERCERS.get(datatype, str)
+
+
+def apply_coercer(value, coercer):
+    if coercer is None or value is None:
+        return value
+
+    if type(value) == list:
+        if value and type(value[0]) == list:
+            return [[coercer(y) for y in v] for v in value]
+        else:
+            return [coercer(v) for v in value] or ""
+    else:
+        return coercer(value)
+
+
+def index_mapping(mapping_dict, es_index):
+    """
+    The mapping of `es_index` from a `get_mapping` response. When `es_index`
+    is an alias the response is keyed by the index it points to instead.
+    """
+    if not mapping_dict:
+        return {}
+    if es_index in mapping_dict:
+        return mapping_dict[es_index]
+    if len(mapping_dict) == 1:
+        return list(mapping_dict.values())[0]
+    return {}
+
+
+def compile_coercers(mapping_dict, es_index, hit_type):
+    """
+    Build a field name -> coercer table for one document type, so values
+    can be coerced without walking the mapping on every attribute access.
+    """
+    try:
+        properties = index_mapping(mapping_dict, es_index)["mappings"][hit_type]["properties"]
+    except (KeyError, TypeError):
+        return {}
+
+    coercers = {}
+    for fieldname, field_mapping in properties.items():
+        if 'type' in field_mapping:
+            coercers[fieldname] = coercer_for_datatype(field_mapping['type'])
+    return coercers
+
+
+def generation_from_mapping(mapping_dict):
+    """
+    Return the index generation marker stored in the `_meta` of the
+    mapping returned by `get_mapping`, or None if the index has none.
+    """
+    for index_mapping in (mapping_dict or {}).values():
+        meta = index_mapping.get('mappings', {}).get('_meta', {})
+        if GENERATION_META_KEY in meta:
+            return meta[GENERATION_META_KEY]
+
+
+def index_meta(es, es_index):
+    """
+    Fetch the `_meta` of an index's mapping, or an empty dict.
+    """
+    mapping = es.indices.get_mapping(index=es_index,
+                                     filter_path='*.mappings._meta')
+    mapping = getattr(mapping, 'body', mapping)
+    if not isinstance(mapping, dict):
+        return {}
+    for index_mapping in mapping.values():
+        return dict(index_mapping.get('mappings', {}).get('_meta', {}))
+    return {}
+
+
+def index_generation(es, es_index):
+    """
+    Fetch just the generation marker of an index from Elasticsearch.
+    """
+    mapping = es.indices.get_mapping(index=es_index,
+                                     filter_path='*.mappings._meta')
+    return generation_from_mapping(getattr(mapping, 'body', mapping))
+
+
+class MappingRegistry(object):
+    """
+    Holds the mapping for an index so that it is fetched from Elasticsearch
+    once and shared by every QueryHit, rather than once per hit.
+
+    The mapping is reloaded when `ttl` seconds have passed since it was
+    fetched, when `invalidate` is called, or when the index generation
+    that `sheer index` writes on completion changes. The generation is
+    checked at most every `check_interval` seconds, by one thread at a
+    time and outside the lock, and can also be reported by a caller that
+    read it through `observe_generation`.
+    """
+
+    def __init__(self, es, es_index, ttl=DEFAULT_MAPPING_TTL,
+                 check_interval=DEFAULT_GENERATION_CHECK_INTERVAL,
+                 clock=time.time):
+        self.es = es
+        self.es_index = es_index
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.clock = clock
+        self.loads = 0
+        self.hits = 0
+        self.generation = None
+        self._mapping = None
+        self._coercers = {}
+        self._loaded_at = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _expired(self):
+        if self._mapping is None:
+            return True
+        if self.ttl is None:
+            return False
+        return self.clock() - self._loaded_at >= self.ttl
+
+    def _load(self):
+        self.loads += 1
+        try:
+            mapping = self.es.indices.get_mapping(index=self.es_index)
+        except Exception:
+            mapping = {}
+        self._mapping = mapping or {}
+        self._coercers = {}
+        self._loaded_at = self._checked_at = self.clock()
+        self.generation = generation_from_mapping(self._mapping)
+
+    def _claim_generation_check(self):
+        if self.check_interval is None:
+            return False
+        now = self.clock()
+        if now - self._checked_at < self.check_interval:
+            return False
+        # Other threads carry on with the current mapping meanwhile
+        self._checked_at = now
+        return True
+
+    def _generation_changed(self):
+        try:
+            generation = index_generation(self.es, self.es_index)
+        except Exception:
+            logger.warning("could not read the generation of %s",
+                           self.es_index, exc_info=True)
+            return False
+        return self.observe_generation(generation)
+
+    def get(self):
+        with self._lock:
+            if self._expired():
+                self._load()
+                return self._mapping
+            self.hits += 1
+            mapping = self._mapping
+            check = self._claim_generation_check()
+        if check and self._generation_changed():
+            return self.get()
+        return mapping
+
+    def coercers_for(self, hit_type):
+        """
+        Return the compiled coercer table for `hit_type`, compiling it the
+        first time the type is seen under the current mapping.
+        """
+        coercers = self._coercers.get(hit_type)
+        if coercers is not None:
+            return coercers
+        # Compiled and published under the lock _load swaps the mapping
+        # and table under, so a table never mixes two mappings.
+        with self._lock:
+            if self._mapping is None:
+                self._load()
+            coercers = self._coercers.get(hit_type)
+            if coercers is None:
+                coercers = compile_coercers(self._mapping, self.es_index,
+                                            hit_type)
+                self._coercers[hit_type] = coercers
+            return coercers
+
+    def invalidate(self):
+        with self._lock:
+            self._mapping = None
+
+    def observe_generation(self, generation):
+        """
+        Drop the cached mapping if `generation` differs from the generation
+        the mapping was loaded under. Returns True if it did.
+        """
+        if self._mapping is not None and generation != self.generation:
+            self.invalidate()
+            return True
+        return False
+
+    def stats(self):
+        return {'loads': self.loads,
+                'hits': self.hits,
+                'generation': self.generation}
@@ -1,14 +1,68 @@
 import os.path
 import json
 import glob
+import functools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from sheer.reader import document_from_path
 
+# Files each worker process parses at a time
+DEFAULT_BATCH_SIZE = 64
+
+
+def worker_context():
+    """
+    Start workers from a fresh server process rather than forking this
+    one, which may be running indexer threads and holding their locks.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def parse_batch(paths, max_body_bytes=None):
+    return [document_from_path(path, max_body_bytes) for path in paths]
+
+
+def parallel_documents(paths, workers, batch_size=DEFAULT_BATCH_SIZE,
+                       max_body_bytes=None):
+    """
+    Parse the files at `paths` on a pool of `workers` processes, and yield
+    the documents in the same order. Files are handed out `batch_size` at a
+    time, and at most two batches per worker are parsed ahead of what has
+    been read, so documents stream out as they would from a single process.
+    """
+    batches = (paths[i:i + batch_size]
+               for i in range(0, len(paths), batch_size))
+    parse = functools.partial(parse_batch, max_body_bytes=max_body_bytes)
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=worker_context()) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(parse, batch))
+            if len(pending) >= workers * 2:
+                for document in pending.popleft().result():
+                    yield document
+        while pending:
+            for document in pending.popleft().result():
+                yield document
+
 
 def documents(name, **kwargs):
     directory = kwargs['directory']
-    for doc_path in glob.glob(directory+'*.md'):
-        yield document_from_path(doc_path)
+    workers = int(kwargs.get('workers') or 1)
+    max_body_bytes = kwargs.get('max_body_bytes')
+    paths = glob.glob(directory+'*.md')
+    if workers > 1 and len(paths) > 1:
+        batch_size = int(kwargs.get('batch_size') or DEFAULT_BATCH_SIZE)
+        for document in parallel_documents(paths, workers, batch_size,
+                                           max_body_bytes):
+            yield document
+    else:
+        for doc_path in paths:
+            yield document_from_path(doc_path, max_body_bytes)
         
 
 def mappings(name, **kwargs):
@@ -1,6 +1,7 @@
 from elasticsearch import Elasticsearch
 
 from sheer.query import QueryHit
+from sheer.mappings import MappingRegistry
 
 
 class IndexHelper(object):
@@ -15,8 +16,9 @@ class IndexHelper(object):
     def configure(self, config):
         self.es = Elasticsearch(config["elasticsearch"])
         self.index_name = config['index']
+        self.mappings = MappingRegistry(self.es, self.index_name)
 
     def get_document(self, doctype, docid):
         # Modern Elasticsearch doesn't use doc_type in get
         raw_results = self.es.get(index=self.index_name, id=docid)
-        return QueryHit(raw_results, es=self.es, es_index=self.index_name)
+        return QueryHit(raw_results, mappings=self.mappings)
@@ -1,12 +1,15 @@
 import os
+import base64
 import codecs
 import logging
 import json
+import glob
+import time
+import threading
+from collections import OrderedDict
 
 import flask
 
-import dateutil.parser
-
 from time import mktime, strptime
 import datetime
 
@@ -14,8 +17,17 @@ from urllib.parse import urlencode as url_encode
 from werkzeug.datastructures import MultiDict
 
 from sheer.decorators import memoized
+from sheer.exceptions import InvalidQueryFile
 from sheer.utility import find_in_search_path
 from sheer.filters import filter_dsl_from_multidict
+from sheer.mappings import (DEFAULT_GENERATION_CHECK_INTERVAL, MappingRegistry,
+                            apply_coercer, coercer_for_datatype,
+                            index_generation, index_mapping)
+from sheer.caching import LRUCache
+from sheer.dependencies import record_document, record_file, record_search
+from sheer.resilience import SEARCH_ERRORS
+from sheer.source_fields import (learning_source_fields, page_template,
+                                 resolve_source, source_params)
 
 
 ALLOWED_SEARCH_PARAMS = ('doc_type',
@@ -27,6 +39,30 @@ ALLOWED_SEARCH_PARAMS = ('doc_type',
                          'suggest_field', 'suggest_mode', 'suggest_size', 'suggest_text', 'timeout',
                          'version')
 
+# Default number of buckets returned for each facet field
+DEFAULT_FACET_SIZE = 10000
+
+# Marks a response that was served from the last good copy
+STALE_KEY = 'sheer_stale'
+
+# URL arguments holding a cursor for search_after pagination
+CURSOR_ARGS = ('after', 'before')
+
+# Search parameters that can be moved into an _msearch header or body.
+# Searches using any other parameter are sent on their own.
+MSEARCH_HEADER_PARAMS = ('allow_no_indices', 'expand_wildcards',
+                         'ignore_unavailable', 'preference', 'routing',
+                         'search_type')
+MSEARCH_BODY_PARAMS = {'explain': 'explain',
+                       'from_': 'from',
+                       'size': 'size',
+                       'sort': 'sort',
+                       'stats': 'stats',
+                       'timeout': 'timeout',
+                       'version': 'version'}
+
+logger = logging.getLogger(__name__)
+
 
 def mapping_for_type(typename, es=None, es_index=None):
     if not es:
@@ -41,6 +77,30 @@ def mapping_for_type(typename, es=None, es_index=None):
         return {}
 
 
+def mapping_registry(es=None, es_index=None):
+    """
+    Return the MappingRegistry shared by the current app, or a private one
+    for an explicitly given Elasticsearch client and index.
+    """
+    if not es:
+        return flask.current_app.mappings
+    if not es_index:
+        es_index = flask.current_app.es_index
+    return MappingRegistry(es, es_index)
+
+
+def count_es_call(kind):
+    """
+    Record an Elasticsearch round-trip in the current app's `es_calls`
+    counter, so we can check how many calls a page makes.
+    """
+    app = flask.current_app
+    if hasattr(app, 'es_calls'):
+        # Counted from every request thread and background refresh
+        with app.es_calls_lock:
+            app.es_calls[kind] += 1
+
+
 def field_or_source_value(fieldname, hit_dict):
     if 'fields' in hit_dict and fieldname in hit_dict['fields']:
         return hit_dict['fields'][fieldname]
@@ -54,7 +114,7 @@ def datatype_for_fieldname_in_mapping(fieldname, hit_type, mapping_dict):
     es_index = flask.current_app.es_index
 
     try:
-        return mapping_dict[es_index]["mappings"][hit_type]["properties"][fieldname]["type"]
+        return index_mapping(mapping_dict, es_index)["mappings"][hit_type]["properties"][fieldname]["type"]
     except KeyError:
         return None
 
@@ -63,33 +123,30 @@ def coerced_value(value, datatype):
     if datatype == None or value == None:
         return value
 
-    TYPE_MAP = {'string': str,
-                'text': str,
-                'keyword': str,
-                'date': dateutil.parser.parse,
-                'dict': dict,
-                'float': float,
-                'long': float,
-                'integer': int,
-                'boolean': bool}
-
-    coercer = TYPE_MAP.get(datatype, str)
-
-    if type(value) == list:
-        if value and type(value[0]) == list:
-            return [[coercer(y) for y in v] for v in value]
-        else:
-            return [coercer(v) for v in value] or ""
-    else:
-        return coercer(value)
+    return apply_coercer(value, coercer_for_datatype(datatype))
 
 
 class QueryHit(object):
 
-    def __init__(self, hit_dict, es=None, es_index=None):
+    def __init__(self, hit_dict, es=None, es_index=None, mappings=None,
+                 source_name=None, source_template=None):
         self.hit_dict = hit_dict
         self.type = hit_dict['_type']
-        self.mapping = mapping_for_type(self.type, es=es, es_index=es_index)
+        if mappings is None:
+            mappings = mapping_registry(es=es, es_index=es_index)
+        self.mapping = mappings.get()
+        self.coercers = mappings.coercers_for(self.type)
+        # Coerced values are kept per hit, so a template reading hit.date
+        # several times parses the date once.
+        self._coerced = {}
+        # The query or lookup the hit came from, for learning which fields
+        # its templates use, and the template to learn them under if not
+        # the page template.
+        self.source_name = source_name
+        self.source_template = source_template
+        self._learner = source_name and learning_source_fields()
+        # True if a lookup's document was served from the last good copy
+        self.stale = bool(hit_dict.get(STALE_KEY))
 
     def __str__(self):
         return str(self.hit_dict.get('_source'))
@@ -106,21 +163,36 @@ class QueryHit(object):
             return flask.url_for(rule, **build_with)
 
     def __getattr__(self, attrname):
-        value = field_or_source_value(attrname, self.hit_dict)
-        datatype = datatype_for_fieldname_in_mapping(
-            attrname, self.type, self.mapping)
-        return coerced_value(value, datatype)
+        if self._learner:
+            self._learner.record(self.source_name,
+                                 self.source_template or page_template(),
+                                 attrname)
+        return self._field_value(attrname)
+
+    def _field_value(self, fieldname):
+        try:
+            return self._coerced[fieldname]
+        except KeyError:
+            pass
+        value = field_or_source_value(fieldname, self.hit_dict)
+        value = apply_coercer(value, self.coercers.get(fieldname))
+        self._coerced[fieldname] = value
+        return value
 
     def json_compatible(self):
         hit_dict = self.hit_dict
         fields = hit_dict.get('fields') or hit_dict.get('_source', {}).keys()
-        return dict((field, getattr(self, field)) for field in fields)
+        # Serializing every field isn't a template using them, so nothing
+        # is learned here.
+        return dict((field, self._field_value(field)) for field in fields)
 
 
 class QueryResults(object):
 
-    def __init__(self, result_dict, pagenum=1):
+    def __init__(self, result_dict, pagenum=1, next_cursor=None,
+                 previous_cursor=None, source_name=None):
         self.result_dict = result_dict
+        self.source_name = source_name
         # Handle both old (int) and new (dict with 'value') formats for total
         total_value = result_dict['hits']['total']
         if isinstance(total_value, dict):
@@ -131,17 +203,22 @@ class QueryResults(object):
         if 'query' in result_dict:
             self.size = int(result_dict['query'].get('size', '10'))
             self.from_ = int(result_dict['query'].get('from', 1))
-            self.pages = self.total // self.size + \
+            # Aggregation-only searches ask for no hits at all
+            self.pages = self.size and self.total // self.size + \
                 int(self.total % self.size > 0)
         else:
             self.size, self.from_, self.pages = 10, 1, 1
 
         self.current_page = pagenum
+        self.stale = bool(result_dict.get(STALE_KEY))
+        # Only set for cursor pagination, and only if there is such a page
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
 
     def __iter__(self):
         if 'hits' in self.result_dict and 'hits' in self.result_dict['hits']:
             for hit in self.result_dict['hits']['hits']:
-                yield QueryHit(hit)
+                yield QueryHit(hit, source_name=self.source_name)
 
     def aggregations(self, fieldname):
         if "aggregations" in self.result_dict and \
@@ -159,6 +236,13 @@ class QueryResults(object):
 
         if self.pages:
             response_data['pages'] = self.pages
+
+        if self.stale:
+            response_data['stale'] = True
+        if self.next_cursor:
+            response_data['next_cursor'] = self.next_cursor
+        if self.previous_cursor:
+            response_data['previous_cursor'] = self.previous_cursor
         response_data['results'] = [
             hit.json_compatible() for hit in self.__iter__()]
         return response_data
@@ -178,23 +262,636 @@ class QueryResults(object):
         else:
             return flask.request.path
 
+    def url_for_cursor(self, after=None, before=None):
+        """
+        Returns a URL for the page after or before a cursor, dropping any
+        page number or cursor in the current URL.
+        """
+        args_dict = MultiDict(flask.request.args)
+        for key in ('page',) + CURSOR_ARGS:
+            args_dict.pop(key, None)
+        if after:
+            args_dict['after'] = after
+        elif before:
+            args_dict['before'] = before
+
+        encoded = url_encode(args_dict)
+        if encoded:
+            return "".join([flask.request.path, "?", encoded])
+        return flask.request.path
+
+    def url_for_next_page(self):
+        if self.next_cursor:
+            return self.url_for_cursor(after=self.next_cursor)
+
+    def url_for_previous_page(self):
+        if self.previous_cursor:
+            return self.url_for_cursor(before=self.previous_cursor)
+
+
+def terms_aggregations(fieldnames, size=None):
+    """
+    Build a terms aggregation for each field. `size` is either the number
+    of buckets for every field, or a dict of field name to bucket count.
+    """
+    if type(fieldnames) is str:
+        fieldnames = [fieldnames]  # so we can treat it as a list
+    if not isinstance(size, dict):
+        size = dict((fieldname, size) for fieldname in fieldnames)
+
+    aggs_dsl = {}
+    for fieldname in fieldnames:
+        aggs_dsl[fieldname] = {'terms': {
+            'field': fieldname,
+            'size': int(size.get(fieldname) or DEFAULT_FACET_SIZE)}}
+    return aggs_dsl
+
+
+def sort_clause(sort):
+    """
+    Turn a URL-style sort parameter ("date:desc,title") into the list form
+    used in a request body.
+    """
+    if isinstance(sort, (list, tuple)):
+        sort = ','.join(sort)
+    clause = []
+    for item in sort.split(','):
+        fieldname, _, order = item.partition(':')
+        clause.append({fieldname: {'order': order}} if order else fieldname)
+    return clause
+
+
+def reverse_sort_clause(clause):
+    """
+    The same sort in the opposite direction, for reading the hits before a
+    cursor.
+    """
+    reversed_clause = []
+    for item in clause:
+        if isinstance(item, dict):
+            fieldname, options = list(item.items())[0]
+            if not isinstance(options, dict):
+                options = {'order': options}
+        else:
+            fieldname, options = item, {}
+        order = options.get('order') or \
+            ('desc' if fieldname == '_score' else 'asc')
+        reversed_clause.append({fieldname: dict(
+            options, order='asc' if order == 'desc' else 'desc')})
+    return reversed_clause
+
+
+def encode_cursor(sort_values):
+    serialized = json.dumps(sort_values, separators=(',', ':'))
+    encoded = base64.urlsafe_b64encode(serialized.encode('utf-8'))
+    return encoded.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    The sort values in a cursor from a URL, or None if it isn't one.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(
+            base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+def cursor_page(response, size, direction=None):
+    """
+    Trim a response to a search for `size` + 1 hits down to `size` hits in
+    display order, and return it with the cursors for the next and
+    previous pages (None where there is no such page).
+
+    `direction` is 'after' or 'before' if the search started at a cursor.
+    Searches before a cursor run with the sort reversed, so their hits are
+    put back in order here.
+    """
+    response = dict(response)
+    hits = list(response['hits']['hits'])
+    more = len(hits) > size
+    hits = hits[:size]
+    if direction == 'before':
+        hits.reverse()
+    response['hits'] = dict(response['hits'], hits=hits)
+    if not hits:
+        return response, None, None
+
+    has_next = direction == 'before' or more
+    has_previous = direction == 'after' or (direction == 'before' and more)
+    next_cursor = encode_cursor(hits[-1]['sort']) if has_next else None
+    previous_cursor = encode_cursor(hits[0]['sort']) if has_previous else None
+    return response, next_cursor, previous_cursor
+
+
+def msearch_header_and_body(search_params):
+    """
+    Split the keyword arguments for `es.search` into an _msearch header and
+    body, or return None if some parameter only works as a URL parameter.
+    """
+    header = {'index': search_params['index']}
+    body = dict(search_params.get('body') or {})
+    for key, value in search_params.items():
+        if key in ('index', 'body', 'doc_type'):
+            # Mapping types are gone in Elasticsearch 7+.
+            continue
+        elif key in MSEARCH_HEADER_PARAMS:
+            header[key] = value
+        elif key in MSEARCH_BODY_PARAMS:
+            if key in ('size', 'from_'):
+                value = int(value)
+            elif key == 'sort':
+                value = sort_clause(value)
+            body[MSEARCH_BODY_PARAMS[key]] = value
+        else:
+            return None
+    return header, body
+
+
+def search_key(search_params):
+    return json.dumps(search_params, sort_keys=True, default=str)
+
+
+def coalesced(key, func):
+    """
+    Call `func`, unless an identical call is already running in another
+    thread, in which case wait for it and share its result.
+    """
+    single_flight = getattr(flask.current_app, 'single_flight', None)
+    if single_flight is None:
+        return func()
+    return single_flight.do(key, func)
+
+
+class ResultCache(object):
+    """
+    Search responses keyed on the normalized parameters passed to
+    `es.search`, with LRU eviction once `maxsize` responses are held.
+
+    The whole cache is dropped when the index generation that `sheer index`
+    writes on completion changes. The generation is checked at most every
+    `check_interval` seconds, and nothing is served from the cache while it
+    can't be checked.
+    """
+
+    def __init__(self, es, es_index, maxsize=256,
+                 check_interval=DEFAULT_GENERATION_CHECK_INTERVAL,
+                 mappings=None, clock=time.time):
+        self.es = es
+        self.es_index = es_index
+        self.check_interval = check_interval
+        self.mappings = mappings
+        self.clock = clock
+        self.responses = LRUCache(maxsize)
+        self.generation = None
+        self.invalidations = 0
+        self._checked_at = None
+        self._checked = False
+        self._lock = threading.Lock()
+
+    def key_for(self, search_params):
+        return search_key(search_params)
+
+    def check_generation(self):
+        """
+        Make sure the cache belongs to the current index generation. Returns
+        False if the generation could not be read.
+
+        One thread at a time reads the generation, outside the lock and
+        through the app's timeout and circuit breaker; the others go on with
+        the answer of the last check in the meantime.
+        """
+        with self._lock:
+            now = self.clock()
+            if self._checked_at is not None and \
+                    now - self._checked_at < self.check_interval:
+                return self._checked
+            self._checked_at = now
+        try:
+            generation = guarded_index_generation(self.es, self.es_index)
+        except Exception:
+            logger.warning("could not read the generation of %s",
+                           self.es_index, exc_info=True)
+            with self._lock:
+                self._checked_at = None
+                self._checked = False
+            return False
+        with self._lock:
+            self._checked = True
+            if generation != self.generation:
+                self.responses.clear()
+                self.generation = generation
+                self.invalidations += 1
+                if self.mappings is not None:
+                    self.mappings.observe_generation(generation)
+        return True
+
+    def get(self, search_params):
+        if not self.check_generation():
+            return None
+        return self.responses.get(self.key_for(search_params))
+
+    def set(self, search_params, response):
+        self.responses.set(self.key_for(search_params), response)
+
+    def stats(self):
+        stats = self.responses.stats()
+        stats['invalidations'] = self.invalidations
+        stats['generation'] = self.generation
+        return stats
+
+
+def result_cache():
+    return getattr(flask.current_app, 'result_cache', None)
+
+
+def resilience():
+    return getattr(flask.current_app, 'resilience', None)
+
+
+def search_client(es):
+    """
+    The client to send a search or get with, carrying the app's per-call
+    timeout if it has one.
+    """
+    guard = resilience()
+    if guard is None:
+        return es
+    return guard.client(es)
+
+
+def guarded_index_generation(es, es_index):
+    """
+    Read the index generation with the app's timeout, through its circuit
+    breaker.
+    """
+    guard = resilience()
+    if guard is None:
+        return index_generation(es, es_index)
+    return guard.guard(lambda: index_generation(guard.client(es), es_index))
+
+
+def resilient(key, func):
+    """
+    Return `(response, stale)` for `func()`, going through the app's
+    Resilience if it has one.
+    """
+    guard = resilience()
+    if guard is None:
+        return func(), False
+    return guard.call(key, func)
+
+
+def mark_stale(response, stale):
+    """
+    A copy of `response` marked with STALE_KEY if it was served stale, so
+    the last good copy itself is left as it was.
+    """
+    if not stale:
+        return response
+    response = dict(response)
+    response[STALE_KEY] = True
+    return response
+
+
+def send_search(es, search_params):
+    key = ('search', search_key(search_params))
+
+    def search():
+        count_es_call('search')
+        response = search_client(es).search(**search_params)
+        # A plain dict, so results can be cached and annotated
+        response = getattr(response, 'body', response)
+        cache = result_cache()
+        if cache is not None:
+            cache.set(search_params, response)
+        return response
+
+    response, stale = coalesced(key, lambda: resilient(key, search))
+    return mark_stale(response, stale)
+
+
+def send_get(es, es_index, docid, source=None):
+    params = source_params(source)
+    key = ('get', es_index, docid, search_key(params))
+
+    def get():
+        count_es_call('get')
+        response = search_client(es).get(index=es_index, id=docid, **params)
+        return getattr(response, 'body', response)
+
+    response, stale = coalesced(key, lambda: resilient(key, get))
+    record_document(docid, response, params)
+    return mark_stale(response, stale)
+
+
+class PendingSearch(object):
+
+    def __init__(self, batch, search_params, fallback=None):
+        self.batch = batch
+        self.search_params = search_params
+        self.fallback = fallback
+        self.msearch = msearch_header_and_body(search_params)
+        self.response = None
+        self.error = None
+
+    def send_alone(self):
+        try:
+            self.response = send_search(self.batch.es, self.search_params)
+        except SEARCH_ERRORS as e:
+            if self.fallback is None:
+                self.error = e
+            else:
+                logger.warning("search failed, using its fallback",
+                               exc_info=True)
+                self.response = self.fallback
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        if self.response is None and self.error is None:
+            self.batch.flush()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class SearchBatch(object):
+    """
+    Searches queued while rendering one page. The first time any of their
+    results is read, every queued search is sent in a single _msearch.
+    """
+
+    def __init__(self, es):
+        self.es = es
+        self.pending = []
+
+    def add(self, search_params, fallback=None):
+        pending = PendingSearch(self, search_params, fallback)
+        self.pending.append(pending)
+        return pending
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        batched = [p for p in pending if p.msearch is not None]
+        for search in pending:
+            if search.msearch is None:
+                search.send_alone()
+
+        if len(batched) == 1:
+            batched[0].send_alone()
+        elif batched:
+            body = []
+            for search in batched:
+                body.extend(search.msearch)
+            try:
+                responses = self.send_msearch(body)
+            except SEARCH_ERRORS:
+                logger.warning("_msearch failed, sending its searches alone",
+                               exc_info=True)
+                for search in batched:
+                    search.send_alone()
+                return
+
+            guard = resilience()
+            for search, response in zip(batched, responses):
+                if 'error' in response:
+                    # Send it again by itself, so the caller gets the same
+                    # exception (or fallback) a plain search would give.
+                    search.send_alone()
+                else:
+                    search.response = response
+                    cache = result_cache()
+                    if cache is not None:
+                        cache.set(search.search_params, response)
+                    if guard is not None:
+                        guard.remember(
+                            ('search', search_key(search.search_params)),
+                            response)
+
+    def send_msearch(self, body):
+        def msearch():
+            count_es_call('msearch')
+            response = search_client(self.es).msearch(body=body)
+            return response['responses']
+
+        guard = resilience()
+        if guard is None:
+            return msearch()
+        return guard.guard(msearch)
+
+
+def search_batch(es):
+    batch = getattr(flask.g, 'sheer_search_batch', None)
+    if batch is None or batch.es is not es:
+        batch = flask.g.sheer_search_batch = SearchBatch(es)
+    return batch
+
+
+class DeferredQueryResults(object):
+    """
+    Stands in for the QueryResults of a queued search, sending the page's
+    batch of searches when it is first used.
+    """
+
+    def __init__(self, pending, make_results):
+        self._pending = pending
+        self._make_results = make_results
+        self._results = None
+
+    def resolve(self):
+        if self._results is None:
+            response = self._pending.result()
+            record_search(search_key(self._pending.search_params), response)
+            self._results = self._make_results(response)
+        return self._results
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def json_compatible(self):
+        return self.resolve().json_compatible()
+
+
+class DeferredAggregation(object):
+    """
+    The buckets of one aggregation in a queued search, read on first use.
+    """
+
+    def __init__(self, results, fieldname):
+        self.results = results
+        self.fieldname = fieldname
+
+    def buckets(self):
+        return self.results.aggregations(self.fieldname) or []
+
+    def __iter__(self):
+        return iter(self.buckets())
+
+    def __len__(self):
+        return len(self.buckets())
+
+    def __getitem__(self, index):
+        return self.buckets()[index]
+
+    def __contains__(self, item):
+        return item in self.buckets()
+
+
+def run_search(es, search_params, make_results, fallback=None):
+    """
+    Send a search and wrap the response with `make_results`. If the app
+    defers queries, the search is queued on the request's SearchBatch and a
+    DeferredQueryResults is returned instead.
+
+    If `fallback` is given it is used as the response when Elasticsearch
+    fails.
+    """
+    cache = result_cache()
+    if cache is not None:
+        response = cache.get(search_params)
+        if response is not None:
+            record_search(search_key(search_params), response)
+            return make_results(response)
+
+    if getattr(flask.current_app, 'defer_queries', False):
+        pending = search_batch(es).add(search_params, fallback)
+        return DeferredQueryResults(pending, make_results)
+
+    try:
+        response = send_search(es, search_params)
+    except SEARCH_ERRORS:
+        if fallback is None:
+            raise
+        logger.warning("search failed, using its fallback", exc_info=True)
+        response = fallback
+    record_search(search_key(search_params), response)
+    return make_results(response)
+
+
+def load_query_file(path):
+    """
+    Read and validate a `_queries/*.json` query definition.
+    """
+    record_file(path)
+    try:
+        with codecs.open(path, 'r', 'utf-8') as query_file:
+            definition = json.loads(query_file.read(),
+                                    object_pairs_hook=OrderedDict)
+    except ValueError as e:
+        raise InvalidQueryFile("%s is not valid JSON: %s" % (path, e))
+
+    if not isinstance(definition, dict):
+        raise InvalidQueryFile("%s must contain a JSON object" % path)
+    if not isinstance(definition.get('query'), dict):
+        raise InvalidQueryFile("%s must have a \"query\" object" % path)
+    if not isinstance(definition.get('filters', []), list):
+        raise InvalidQueryFile("\"filters\" in %s must be a list" % path)
+    pagination = definition['query'].get('pagination',
+                                         definition.get('pagination'))
+    if pagination == 'cursor' and not definition.get('tiebreaker'):
+        logger.warning("%s uses cursor pagination without a \"tiebreaker\", "
+                       "so hits with the same sort values can be skipped or "
+                       "repeated between pages", path)
+    return definition
+
+
+class QueryRegistry(object):
+    """
+    The query definitions in a site's `_queries` directory. Every file is
+    read and validated once, the first time any query is asked for.
+
+    With `check_mtimes` (debug mode) each lookup stats the query's file and
+    reloads it if it changed, appeared or went away. Otherwise lookups do no
+    filesystem I/O at all.
+    """
+
+    def __init__(self, queries_dir, check_mtimes=False):
+        self.queries_dir = queries_dir
+        self.check_mtimes = check_mtimes
+        self._definitions = None
+        self._lock = threading.Lock()
+
+    def path_for(self, name):
+        return os.path.join(self.queries_dir, name + '.json')
+
+    def _load_file(self, name, path, mtime):
+        try:
+            definition = load_query_file(path)
+        except InvalidQueryFile as e:
+            logger.warning(str(e))
+            definition = e
+        self._definitions[name] = (mtime, definition)
+
+    def _load_all(self):
+        self._definitions = {}
+        for path in glob.glob(os.path.join(self.queries_dir, '*.json')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            self._load_file(name, path, os.path.getmtime(path))
+
+    def _refresh(self, name):
+        path = self.path_for(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self._definitions.pop(name, None)
+            return
+        entry = self._definitions.get(name)
+        if entry is None or entry[0] != mtime:
+            self._load_file(name, path, mtime)
+
+    def get(self, name):
+        """
+        Return the definition for the query called `name`, or None if there
+        is no such query. Raises InvalidQueryFile if its file is broken.
+        """
+        with self._lock:
+            if self._definitions is None:
+                self._load_all()
+            elif self.check_mtimes:
+                self._refresh(name)
+            entry = self._definitions.get(name)
+
+        record_file(self.path_for(name))
+        if entry is None:
+            return None
+        if isinstance(entry[1], InvalidQueryFile):
+            raise entry[1]
+        return entry[1]
+
 
 class Query(object):
 
-    def __init__(self, filename=None, json_safe=False):
+    def __init__(self, filename=None, json_safe=False, definition=None):
         # TODO: make the no filename case work
 
         app = flask.current_app
         self.es_index = app.es_index
         self.es = app.es
         self.filename = filename
+        self.name = filename and \
+            os.path.splitext(os.path.basename(filename))[0]
+        self.definition = definition
         self.__results = None
         self.json_safe = json_safe
 
-    def search_with_url_arguments(self, aggregations=None, **kwargs):
-        with open(self.filename, 'r') as f:
-            query_file = json.loads(f.read())
-        query_dict = query_file['query']
+    def search_with_url_arguments(self, aggregations=None, facets=None,
+                                  facet_size=None, **kwargs):
+        query_file = self.definition
+        if query_file is None:
+            query_file = load_query_file(self.filename)
+        if facet_size is None:
+            facet_size = query_file.get('facet_size')
+        # Copied, since the definition is shared with every other request.
+        query_dict = dict(query_file['query'])
 
         '''
         These dict constructors split the kwargs from the template into filter
@@ -206,6 +903,9 @@ class Query(object):
             if not key.startswith('filter_'))
         query_dict.update(non_filter_args)
         pagenum = 1
+        pagination = query_dict.pop('pagination',
+                                    query_file.get('pagination'))
+        cursor_direction = search_after = None
 
         request = flask.request
 
@@ -218,14 +918,18 @@ class Query(object):
         query_body = {}
 
         if aggregations:
-            aggs_dsl = {}
-            if type(aggregations) is str:
-                aggregations = [aggregations] # so we can treat it as a list
-            for fieldname in aggregations:
-                aggs_dsl[fieldname] = {'terms':
-                    {'field': fieldname, 'size': 10000}}
-            query_body['aggs'] = aggs_dsl
+            query_body['aggs'] = terms_aggregations(aggregations, facet_size)
         else:
+            for direction in CURSOR_ARGS:
+                if direction in args_flat:
+                    pagination = 'cursor'
+                    search_after = decode_cursor(args_flat.pop(direction))
+                    if search_after is not None:
+                        cursor_direction = direction
+            if pagination == 'cursor':
+                # Cursors replace page numbers entirely
+                args_flat.pop('page', None)
+
             if 'page' in args_flat:
                 args_flat['from_'] = int(
                     query_dict.get('size', '10')) * (int(args_flat['page']) - 1)
@@ -244,17 +948,72 @@ class Query(object):
                 for json_filter in query_file['filters']:
                     query_body['query']['bool']['filter'].append(json_filter)
 
+            # Facets are counted over the same filtered hits, in the same
+            # request.
+            if facets:
+                query_body['aggs'] = terms_aggregations(facets, facet_size)
+
+            source = resolve_source(self.name, query_file.get('_source'))
+            if source is not None:
+                query_body['_source'] = source
+
         final_query_dict = dict((k, v)
                                 for (k, v) in query_dict.items() if k in ALLOWED_SEARCH_PARAMS)
         final_query_dict['index'] = self.es_index
         final_query_dict['body'] = query_body
-        response = self.es.search(**final_query_dict)
-        response['query'] = query_dict
-        return QueryResults(response, pagenum)
 
-    def possible_values_for(self, field, **kwargs):
-        results = self.search_with_url_arguments(aggregations=[field], **kwargs)
-        return results.aggregations(field)
+        cursor_size = None
+        if pagination == 'cursor' and not aggregations:
+            # search_after on the query's sort, asking for one extra hit to
+            # find out whether there is a next page.
+            cursor_size = int(query_dict.get('size', '10'))
+            sort = sort_clause(query_dict['sort']) \
+                if query_dict.get('sort') else []
+            if query_file.get('tiebreaker'):
+                sort.append(query_file['tiebreaker'])
+            sort = sort or ['_doc']
+            if search_after is not None and len(search_after) != len(sort):
+                # From an older version of the query, or made up
+                cursor_direction = None
+            if cursor_direction == 'before':
+                sort = reverse_sort_clause(sort)
+            query_body['sort'] = sort
+            if cursor_direction is not None:
+                query_body['search_after'] = search_after
+            final_query_dict.pop('sort', None)
+            final_query_dict.pop('from_', None)
+            final_query_dict['size'] = cursor_size + 1
+
+        def make_results(response):
+            if cursor_size is not None:
+                response, next_cursor, previous_cursor = cursor_page(
+                    response, cursor_size, cursor_direction)
+                response['query'] = query_dict
+                return QueryResults(response, pagenum, next_cursor,
+                                    previous_cursor, source_name=self.name)
+            # Copied, since the response may be shared through the cache
+            response = dict(response)
+            response['query'] = query_dict
+            return QueryResults(response, pagenum, source_name=self.name)
+
+        return run_search(self.es, final_query_dict, make_results)
+
+    def possible_values_for(self, field, facet_size=None, **kwargs):
+        return self.possible_values_for_fields(
+            [field], facet_size=facet_size, **kwargs)[field]
+
+    def possible_values_for_fields(self, fields, facet_size=None, **kwargs):
+        """
+        Return a dict of field name to terms buckets for every field in
+        `fields`, all from a single search.
+        """
+        kwargs.setdefault('size', 0)
+        results = self.search_with_url_arguments(
+            aggregations=fields, facet_size=facet_size, **kwargs)
+        if isinstance(results, DeferredQueryResults):
+            return dict((field, DeferredAggregation(results, field))
+                        for field in fields)
+        return dict((field, results.aggregations(field)) for field in fields)
 
     @property
     def results(self):
@@ -271,19 +1030,20 @@ class QueryFinder(object):
         app = flask.current_app
         self.es = app.es
         self.es_index = app.es_index
-        self.queries_dir = os.path.join(app.root_dir, '_queries')
+        self.registry = app.query_registry
+        self.queries_dir = self.registry.queries_dir
 
     def __getattr__(self, name):
-        query_filename = name + ".json"
-        query_file_path = os.path.join(self.queries_dir, query_filename)
+        definition = self.registry.get(name)
 
-        if os.path.exists(query_file_path):
-            query = Query(query_file_path, self.es_index)
+        if definition is not None:
+            query = Query(self.registry.path_for(name), self.es_index,
+                          definition=definition)
             return query
 
 
 class QueryJsonEncoder(json.JSONEncoder):
-    query_classes = [QueryResults, QueryHit]
+    query_classes = [QueryResults, QueryHit, DeferredQueryResults]
 
     def default(self, obj):
         if type(obj) in (datetime.datetime, datetime.date):
@@ -301,29 +1061,27 @@ def add_query_utilities(app):
         docid = hit._id
 
         # Modern Elasticsearch uses the search API with more_like_this query
-        try:
-            query_body = {
-                "query": {
-                    "more_like_this": {
-                        "fields": ["_all"],
-                        "like": [{"_index": es_index, "_id": docid}],
-                        "min_term_freq": 1,
-                        "min_doc_freq": 1
-                    }
+        query_body = {
+            "query": {
+                "more_like_this": {
+                    "fields": ["_all"],
+                    "like": [{"_index": es_index, "_id": docid}],
+                    "min_term_freq": 1,
+                    "min_doc_freq": 1
                 }
             }
-            query_body["query"]["more_like_this"].update(kwargs)
-            raw_results = es.search(index=es_index, body=query_body)
-            return QueryResults(raw_results)
-        except Exception as e:
-            # Return empty results on error
-            return QueryResults({"hits": {"total": 0, "hits": []}})
+        }
+        query_body["query"]["more_like_this"].update(kwargs)
+        # Return empty results if Elasticsearch fails; the error is logged
+        return run_search(es, dict(index=es_index, body=query_body),
+                          QueryResults,
+                          fallback={"hits": {"total": 0, "hits": []}})
 
     def get_document(doctype, docid):
         es = flask.current_app.es
         es_index = app.es_index
         # Modern Elasticsearch doesn't use doc_type in get
-        raw_results = es.get(index=es_index, id=docid)
+        raw_results = send_get(es, es_index, docid)
         return QueryHit(raw_results)
 
     @app.context_processor
@@ -1,20 +1,133 @@
 import re
+import mmap
 import yaml
 import codecs
+import logging
 import datetime
 import os.path
 
-FRONTMATTER = re.compile(r'^\s*---(.*)---\s*$', flags=re.MULTILINE | re.S)
+from yaml.nodes import ScalarNode
+from yaml.resolver import Resolver
+from yaml.constructor import ConstructorError, SafeConstructor
+
+try:
+    from yaml import CSafeLoader as FrontmatterLoader
+except ImportError:
+    from yaml import SafeLoader as FrontmatterLoader
+
+logger = logging.getLogger(__name__)
+
+FRONTMATTER_DELIMITER = '---'
+LEADING_WHITESPACE = re.compile(r'\s*')
+# What may follow a closing delimiter: the rest of its line, and any blank
+# lines up to the last line break before the text.
+DELIMITER_LINE_END = re.compile(r'\s*$', flags=re.MULTILINE)
+
+# The same, for finding frontmatter in the undecoded bytes of a file
+BYTES_SYNTAX = (FRONTMATTER_DELIMITER.encode('ascii'),
+                re.compile(br'\s*'),
+                re.compile(br'\s*$', flags=re.MULTILINE),
+                b'\n')
+
+# How much of a file read_frontmatter reads at a time
+FRONTMATTER_CHUNK_SIZE = 4096
+
+# A `key: value` line whose value is a plain scalar
+SIMPLE_LINE = re.compile(r'^([A-Za-z_][\w-]*):[ \t]+([^\s\'"\[\]{}>|*&!%@`#?,-][^#]*?)[ \t]*$')
+
+scalar_resolver = Resolver()
+scalar_constructor = SafeConstructor()
 
 # TODO this will get moved to the filesystem processor module
 
 
+def frontmatter_bounds(data, syntax=(FRONTMATTER_DELIMITER,
+                                     LEADING_WHITESPACE,
+                                     DELIMITER_LINE_END, '\n')):
+    """
+    Find the frontmatter in `data`, which runs from an opening `---` at the
+    start of the file to the first line that starts with `---` and has
+    nothing else on it. Returns the offsets where the frontmatter starts
+    and ends and where the text starts, or None if there is none.
+
+    `data` can be a string, or with BYTES_SYNTAX, bytes or an mmap.
+    """
+    delimiter, leading_whitespace, line_end, newline = syntax
+    start = leading_whitespace.match(data).end()
+    if data[start:start + len(delimiter)] != delimiter:
+        return None
+
+    start += len(delimiter)
+    position = start
+    while True:
+        closing = data.find(newline + delimiter, position)
+        if closing == -1:
+            return None
+        closing += 1
+        end = line_end.match(data, closing + len(delimiter))
+        if end:
+            return start, closing, end.end()
+        position = closing
+
+
 def extract_frontmatter(data):
-    match = FRONTMATTER.match(data)
-    if match:
-        return match.groups(1)[0], data[match.end():]
+    """
+    Split `data` into its frontmatter and text.
+    """
+    bounds = frontmatter_bounds(data)
+    if bounds is None:
+        return None, data
+    start, end, text_start = bounds
+    return data[start:end], data[text_start:]
+
+
+def plain_scalar(value):
+    """
+    Construct `value` the way YAML would a plain scalar. Raises a YAMLError
+    for values YAML can't construct on their own, like `=` or `<<`.
+    """
+    tag = scalar_resolver.resolve(ScalarNode, value, (True, False))
+    constructor = scalar_constructor.yaml_constructors.get(tag)
+    if constructor is None:
+        raise ConstructorError(None, None, "could not determine a "
+                               "constructor for the tag %r" % tag)
+    return constructor(scalar_constructor, ScalarNode(tag, value))
+
+
+def simple_frontmatter(frontmatter):
+    """
+    Parse frontmatter made only of `key: value` lines with plain values,
+    the same way YAML would, without going through a YAML parser. Returns
+    None if the frontmatter is anything more complicated.
+    """
+    document = {}
+    for line in frontmatter.splitlines():
+        if not line.strip():
+            continue
+        # YAML doesn't allow tabs in most of the places they could be here
+        if '\t' in line:
+            return None
+        match = SIMPLE_LINE.match(line)
+        if not match:
+            return None
+        key, value = match.groups()
+        if ': ' in value or value.endswith(':'):
+            return None
+        try:
+            if type(plain_scalar(key)) is not str:
+                return None
+            document[key] = plain_scalar(value)
+        except yaml.YAMLError:
+            # Left to YAML, to fail with its own error
+            return None
+    return document
+
 
-    return None, data
+def parse_frontmatter(frontmatter):
+    document = simple_frontmatter(frontmatter)
+    if document is None:
+        document = yaml.load(frontmatter, Loader=FrontmatterLoader)
+    return document
 
 
 def json_safe_dates(document):
@@ -37,22 +150,116 @@ def annotations_from_filename(name):
     return values
 
 
-def document_from_str(data):
-    frontmatter, text = extract_frontmatter(data)
+def document_from_parts(frontmatter, text):
     if frontmatter:
-        document = yaml.load(frontmatter)
-        document['text'] = text
-
+        document = parse_frontmatter(frontmatter) or {}
     else:
-        document = {'text': data}
-
+        document = {}
+    document['text'] = text
     return document
 
 
-def document_from_path(path):
+def document_from_str(data):
+    return document_from_parts(*extract_frontmatter(data))
+
+
+def decode_text(data, start, max_bytes=None):
+    """
+    Decode `data` from `start` as UTF-8, stopping after `max_bytes` bytes
+    (and before any character that limit cuts in half).
+    """
+    end = len(data)
+    if max_bytes is not None:
+        end = min(end, start + max_bytes)
+    with memoryview(data) as view:
+        with view[start:end] as text:
+            if end < len(data):
+                decoder = codecs.getincrementaldecoder('utf-8')()
+                return decoder.decode(text, final=False)
+            return str(text, 'utf-8')
+
+
+def read_document(path, max_body_bytes=None, mapped=True):
+    """
+    Read the frontmatter and text of the file at `path`. The file is
+    memory-mapped, and only the frontmatter and text are decoded, so a
+    large file is held in memory once. With `max_body_bytes`, the text is
+    cut off after that many bytes and the rest of the file is never read.
+
+    A mapped file that shrinks while it is read kills the process with
+    SIGBUS, so files that may be changing are read with `mapped` off.
+    """
+    with open(path, 'rb') as docfile:
+        if os.fstat(docfile.fileno()).st_size == 0:
+            return None, u''
+        if mapped:
+            data = mmap.mmap(docfile.fileno(), 0, access=mmap.ACCESS_READ)
+            bounds = frontmatter_bounds(data, BYTES_SYNTAX)
+        else:
+            data, bounds = read_frontmatter_bytes(docfile)
+            text_start = bounds[2] if bounds is not None else 0
+            if max_body_bytes is None:
+                data += docfile.read()
+            else:
+                # One byte more than is kept, to tell whether it was cut off
+                wanted = text_start + max_body_bytes + 1 - len(data)
+                if wanted > 0:
+                    data += docfile.read(wanted)
+        try:
+            frontmatter, text_start = None, 0
+            if bounds is not None:
+                start, end, text_start = bounds
+                frontmatter = data[start:end].decode('utf-8')
+            if max_body_bytes is not None and \
+                    len(data) - text_start > max_body_bytes:
+                logger.warning("truncating %s to %s bytes", path,
+                               max_body_bytes)
+            return frontmatter, decode_text(data, text_start, max_body_bytes)
+        finally:
+            if mapped:
+                data.close()
+
+
+def read_frontmatter_bytes(docfile, chunk_size=FRONTMATTER_CHUNK_SIZE):
+    """
+    Read `docfile` a chunk at a time until the end of its frontmatter, or
+    until it turns out not to have any. Returns the bytes read and the
+    frontmatter's bounds in them, or None for the bounds.
+    """
+    delimiter = BYTES_SYNTAX[0]
+    data = b''
+    while True:
+        chunk = docfile.read(chunk_size)
+        data += chunk
+        opening = data.lstrip()
+        if len(opening) >= len(delimiter) and \
+                not opening.startswith(delimiter):
+            return data, None
+        bounds = frontmatter_bounds(data, BYTES_SYNTAX)
+        # A delimiter at the very end of the chunk might go on in the
+        # next one
+        if bounds is not None and (bounds[2] < len(data) or not chunk):
+            return data, bounds
+        if not chunk:
+            return data, None
+
+
+def read_frontmatter(path, chunk_size=FRONTMATTER_CHUNK_SIZE):
+    """
+    Read only the frontmatter of the file at `path`, without its text.
+    """
+    with open(path, 'rb') as docfile:
+        data, bounds = read_frontmatter_bytes(docfile, chunk_size)
+    if bounds is None:
+        return None
+    start, end, text_start = bounds
+    return data[start:end].decode('utf-8')
+
+
+def document_from_path(path, max_body_bytes=None, mapped=True):
     name = os.path.basename(path)
-    with codecs.open(path, 'r', 'utf-8') as docfile:
-        document = annotations_from_filename(name)
-        document.update(document_from_str(docfile.read()))
-        document = json_safe_dates(document)
-        return document
+    document = annotations_from_filename(name)
+    document.update(document_from_parts(
+        *read_document(path, max_body_bytes, mapped)))
+    document = json_safe_dates(document)
+    return document
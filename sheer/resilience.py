@@ -0,0 +1,230 @@
+import time
+import logging
+import threading
+
+import flask
+
+from elasticsearch.exceptions import ApiError, TransportError
+
+from sheer.caching import LRUCache
+from sheer.exceptions import ElasticsearchUnavailable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_LAST_GOOD_SIZE = 256
+
+# What a failed search or get can raise; anything else is a bug.
+SEARCH_ERRORS = (ApiError, TransportError, ElasticsearchUnavailable)
+
+
+def is_outage(error):
+    """
+    True if `error` means Elasticsearch is down or struggling, rather than
+    that the request itself was bad (a missing document, a broken query).
+    """
+    if isinstance(error, (TransportError, ElasticsearchUnavailable)):
+        return True
+    if isinstance(error, ApiError):
+        status = error.status_code
+        return isinstance(status, int) and (status >= 500 or status == 429)
+    return False
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to Elasticsearch for `reset_timeout` seconds once
+    `failure_threshold` calls in a row have failed. After that one trial
+    call is let through; if it succeeds the breaker closes again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """
+        True while calls are being refused, without using up the trial call.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN:
+                return self.clock() - self._opened_at < self.reset_timeout
+            return True
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    self.clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Elasticsearch calls failing, stopping "
+                                   "them for %s seconds", self.reset_timeout)
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+    def stats(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'rejected': self.rejected}
+
+
+class _Refresh(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Resilience(object):
+    """
+    Guards searches and document gets against a slow or failing cluster.
+
+    Every call gets `timeout` seconds, and calls go through a
+    CircuitBreaker. The last good response for each key is kept; when a
+    call fails because of an outage, or the breaker is open, that response
+    is served instead and reported as stale.
+
+    With `stale_after`, a call that already has a last good response waits
+    at most that many seconds before serving it, and the call carries on
+    in the background to refresh it.
+    """
+
+    def __init__(self, timeout=None, stale_after=None,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 last_good_size=DEFAULT_LAST_GOOD_SIZE, clock=time.time):
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock)
+        self.last_good = LRUCache(last_good_size)
+        self.stale_served = 0
+        self._refreshing = {}
+        self._lock = threading.Lock()
+
+    def client(self, es):
+        if self.timeout is None:
+            return es
+        return es.options(request_timeout=self.timeout)
+
+    def guard(self, func):
+        """
+        Run `func` through the circuit breaker, without any stale response
+        to fall back on.
+        """
+        if not self.breaker.allow():
+            raise ElasticsearchUnavailable("Elasticsearch calls are paused "
+                                           "after repeated failures")
+        try:
+            result = func()
+        except Exception as e:
+            if is_outage(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def remember(self, key, response):
+        self.last_good.set(key, response)
+
+    def call(self, key, func):
+        """
+        Return `(response, stale)` for `func()`, where `stale` is True if
+        the last good response for `key` was served instead.
+        """
+        last_good = self.last_good.get(key)
+        if last_good is not None and self.stale_after is not None:
+            return self._call_with_deadline(key, func, last_good)
+
+        try:
+            response = self.guard(func)
+        except SEARCH_ERRORS as e:
+            if not is_outage(e):
+                raise
+            return self._serve_stale(key, last_good, e)
+        self.remember(key, response)
+        return response, False
+
+    def _serve_stale(self, key, last_good, error):
+        if last_good is None:
+            raise error
+        logger.warning("serving a stale response for %s: %s", key, error)
+        self.stale_served += 1
+        return last_good, True
+
+    def _refresh(self, key, func, refresh, app):
+        try:
+            if app is None:
+                refresh.result = self.guard(func)
+            else:
+                with app.app_context():
+                    refresh.result = self.guard(func)
+            self.remember(key, refresh.result)
+        except Exception as e:
+            refresh.error = e
+        finally:
+            with self._lock:
+                del self._refreshing[key]
+            refresh.done.set()
+
+    def _call_with_deadline(self, key, func, last_good):
+        if self.breaker.is_open():
+            return self._serve_stale(
+                key, last_good, ElasticsearchUnavailable("circuit open"))
+
+        with self._lock:
+            refresh = self._refreshing.get(key)
+            if refresh is None:
+                refresh = self._refreshing[key] = _Refresh()
+                app = None
+                if flask.has_app_context():
+                    app = flask.current_app._get_current_object()
+                thread = threading.Thread(target=self._refresh,
+                                          args=(key, func, refresh, app))
+                thread.daemon = True
+                thread.start()
+
+        if not refresh.done.wait(self.stale_after):
+            return self._serve_stale(key, last_good, ElasticsearchUnavailable(
+                "no response within %s seconds" % self.stale_after))
+        if refresh.error is not None:
+            if not is_outage(refresh.error):
+                raise refresh.error
+            return self._serve_stale(key, last_good, refresh.error)
+        return refresh.result, False
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats['stale_served'] = self.stale_served
+        stats['refreshing'] = len(self._refreshing)
+        return stats
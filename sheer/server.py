@@ -8,5 +8,12 @@ from .wsgi import app_with_config
 
 def serve_wsgi_app_with_cli_args(args, config):
 
+        config['production'] = args.production
+        config['bytecode_cache'] = args.bytecode_cache
+        config['defer_queries'] = args.defer_queries
+        config['result_cache_size'] = args.result_cache_size
+        config['search_timeout'] = args.search_timeout
+        config['stale_after'] = args.stale_after
+        config['learn_source_fields'] = args.learn_source_fields
         application = app_with_config(config)
         application.run(host=args.addr, port=int(args.port))
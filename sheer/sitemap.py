@@ -0,0 +1,237 @@
+import os
+import sys
+import logging
+import datetime
+import itertools
+from xml.sax.saxutils import escape
+
+import flask
+import dateutil.parser
+
+from elasticsearch.exceptions import ApiError
+from elasticsearch.helpers import scan
+
+from .builder import DEFAULT_OUTPUT
+
+logger = logging.getLogger(__name__)
+
+# The most URLs the sitemap protocol allows in one file
+MAX_URLS_PER_SITEMAP = 50000
+DEFAULT_PAGE_SIZE = 1000
+DATE_FIELD = 'date'
+POINT_IN_TIME_KEEP_ALIVE = '1m'
+
+SITEMAP_INDEX_FILENAME = 'sitemap.xml'
+SITEMAP_FILENAME_FORMAT = 'sitemap-%s.xml'
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+URLSET_START = \
+    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_END = '</urlset>\n'
+SITEMAPINDEX_START = \
+    '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+SITEMAPINDEX_END = '</sitemapindex>\n'
+
+
+def point_in_time_hits(es, pit_id, query, source, page_size):
+    """
+    Page through every hit for `query` in a point in time with
+    `search_after`, closing the point in time when done.
+    """
+    search_after = None
+    try:
+        while True:
+            body = {'size': page_size,
+                    'query': query,
+                    '_source': source,
+                    'pit': {'id': pit_id,
+                            'keep_alive': POINT_IN_TIME_KEEP_ALIVE},
+                    'sort': [{'_shard_doc': 'asc'}]}
+            if search_after is not None:
+                body['search_after'] = search_after
+            response = es.search(body=body)
+            hits = response['hits']['hits']
+            if not hits:
+                return
+            for hit in hits:
+                yield hit
+            # The id can change between pages
+            pit_id = response.get('pit_id', pit_id)
+            search_after = hits[-1]['sort']
+    finally:
+        try:
+            es.close_point_in_time(id=pit_id)
+        except ApiError:
+            logger.debug("could not close point in time", exc_info=True)
+
+
+def document_hits(es, es_index, source=False, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Every document in the index, with only the `source` fields. Uses a
+    point in time where the cluster has them, and a scroll otherwise.
+
+    Elasticsearch 7+ has no mapping types and the indexer doesn't write a
+    type field, so documents can't be told apart by type.
+    """
+    query = {'match_all': {}}
+    try:
+        pit_id = es.open_point_in_time(
+            index=es_index, keep_alive=POINT_IN_TIME_KEEP_ALIVE)['id']
+    except ApiError:
+        logger.info("point in time not supported, scrolling instead")
+        return scan(es, index=es_index, size=page_size,
+                    query={'query': query, '_source': source})
+    return point_in_time_hits(es, pit_id, query, source, page_size)
+
+
+def count_documents(app):
+    # Every permalink lookup lists every document
+    count = app.es.count(index=app.es_index)['count']
+    return count * len(app.permalinks_by_type)
+
+
+def lastmod(hit, date_field=DATE_FIELD):
+    value = hit.get('_source', {}).get(date_field)
+    if not value:
+        return None
+    try:
+        if not isinstance(value, datetime.date):
+            value = dateutil.parser.parse(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return value.strftime('%Y-%m-%d')
+
+
+def sitemap_entries(app, date_field=DATE_FIELD, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Yield `(url, lastmod)` for every document with a permalink. Needs a
+    request context to build external URLs in.
+    """
+    for _, lookup_name in sorted(app.permalinks_by_type.items()):
+        for hit in document_hits(app.es, app.es_index, source=[date_field],
+                                 page_size=page_size):
+            url = flask.url_for(lookup_name, id=hit['_id'], _external=True)
+            yield url, lastmod(hit, date_field)
+
+
+def url_element(url, modified=None):
+    if modified:
+        return '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+            escape(url), modified)
+    return '<url><loc>%s</loc></url>\n' % escape(url)
+
+
+def urlset(entries):
+    yield XML_HEADER
+    yield URLSET_START
+    for url, modified in entries:
+        yield url_element(url, modified)
+    yield URLSET_END
+
+
+def sitemap_index(sitemap_urls):
+    yield XML_HEADER
+    yield SITEMAPINDEX_START
+    for url in sitemap_urls:
+        yield '<sitemap><loc>%s</loc></sitemap>\n' % escape(url)
+    yield SITEMAPINDEX_END
+
+
+def write_sitemaps(entries, output_dir, base_url,
+                   max_urls=MAX_URLS_PER_SITEMAP):
+    """
+    Write `entries` to numbered sitemap files of at most `max_urls` URLs
+    each, one at a time, then a sitemap index listing them. Returns the
+    number of sitemap files.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    shards = 0
+    count = 0
+    sitemap_file = None
+    try:
+        for url, modified in entries:
+            if sitemap_file is None or count == max_urls:
+                if sitemap_file is not None:
+                    sitemap_file.write(URLSET_END)
+                    sitemap_file.close()
+                shards += 1
+                count = 0
+                sitemap_file = open(os.path.join(
+                    output_dir, SITEMAP_FILENAME_FORMAT % shards), 'w')
+                sitemap_file.write(XML_HEADER + URLSET_START)
+            sitemap_file.write(url_element(url, modified))
+            count += 1
+        if sitemap_file is not None:
+            sitemap_file.write(URLSET_END)
+    finally:
+        if sitemap_file is not None:
+            sitemap_file.close()
+
+    base_url = base_url.rstrip('/') + '/'
+    sitemap_urls = [base_url + SITEMAP_FILENAME_FORMAT % number
+                    for number in range(1, shards + 1)]
+    with open(os.path.join(output_dir, SITEMAP_INDEX_FILENAME), 'w') as f:
+        f.writelines(sitemap_index(sitemap_urls))
+    return shards
+
+
+def written_sitemap(app, filename):
+    """
+    The path of `filename` among the sitemaps `sheer sitemap` wrote to the
+    site's output directory, or None if there is no such file or they
+    haven't been written.
+    """
+    output_dir = os.path.join(app.root_dir, DEFAULT_OUTPUT)
+    for name in (SITEMAP_INDEX_FILENAME, filename):
+        if not os.path.isfile(os.path.join(output_dir, name)):
+            return None
+    return os.path.join(output_dir, filename)
+
+
+def add_sitemap_to_sheer(app):
+    # A sitemap.xml in the site itself is served instead
+    if os.path.exists(os.path.join(app.root_dir, SITEMAP_INDEX_FILENAME)):
+        return
+
+    @app.route('/sitemap.xml')
+    def sitemap():
+        written = written_sitemap(app, SITEMAP_INDEX_FILENAME)
+        if written:
+            return flask.send_file(written, mimetype='application/xml')
+        # Only a single sitemap can be streamed live, since a later one
+        # would have to read through every document before it.
+        if count_documents(app) > MAX_URLS_PER_SITEMAP:
+            logger.warning("too many documents for one sitemap, run "
+                           "`sheer sitemap` to write them to %s",
+                           DEFAULT_OUTPUT)
+            flask.abort(404)
+        sitemap_urls = [flask.url_for('sitemap_shard', number=1,
+                                      _external=True)]
+        return flask.Response(sitemap_index(sitemap_urls),
+                              mimetype='application/xml')
+
+    @app.route('/sitemap-<int:number>.xml')
+    def sitemap_shard(number):
+        written = written_sitemap(app, SITEMAP_FILENAME_FORMAT % number)
+        if written:
+            return flask.send_file(written, mimetype='application/xml')
+        if number != 1:
+            flask.abort(404)
+        entries = itertools.islice(sitemap_entries(app), MAX_URLS_PER_SITEMAP)
+        return flask.Response(flask.stream_with_context(urlset(entries)),
+                              mimetype='application/xml')
+
+
+def sitemap_with_cli_args(args, config):
+    from .wsgi import app_with_config
+
+    app = app_with_config(config)
+    output_dir = getattr(args, 'output', None) or \
+        os.path.join(config['location'], DEFAULT_OUTPUT)
+    base_url = args.base_url
+    max_urls = getattr(args, 'max_urls', MAX_URLS_PER_SITEMAP)
+    with app.test_request_context(base_url=base_url):
+        shards = write_sitemaps(sitemap_entries(app), output_dir, base_url,
+                                max_urls=max_urls)
+    sys.stdout.write("wrote %s sitemaps to %s\n" % (shards, output_dir))
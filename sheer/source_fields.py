@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import codecs
+import logging
+import threading
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+SOURCE_FIELDS_FILENAME = '_settings/source_fields.json'
+
+# A query file or lookup with "_source": "learned" only fetches the fields
+# its templates were seen using.
+LEARNED = 'learned'
+
+# What lookups' fields are learned under instead of a page template, since
+# their document is fetched before the template that shows it is picked.
+ANY_TEMPLATE = '*'
+
+# How often learned fields are written out while they keep changing
+DEFAULT_SAVE_INTERVAL = 5
+
+
+def source_params(source):
+    """
+    Keyword arguments for `es.get` that filter the document's `_source` the
+    way a search body's `_source` would.
+    """
+    if source is None:
+        return {}
+    if isinstance(source, bool):
+        return {'source': source}
+    if isinstance(source, dict):
+        params = {}
+        if source.get('includes'):
+            params['source_includes'] = source['includes']
+        if source.get('excludes'):
+            params['source_excludes'] = source['excludes']
+        return params
+    return {'source_includes': source}
+
+
+def page_template():
+    """
+    The page template being rendered, which learned fields are kept under.
+    """
+    if not flask.has_request_context():
+        return None
+    return getattr(flask.g, 'sheer_page_template', None) or flask.request.path
+
+
+class SourceFields(object):
+    """
+    The `_source` fields templates read from each query's hits, by query and
+    page template, kept in `_settings/source_fields.json`.
+
+    With `learning` on, every attribute read from a QueryHit is recorded,
+    and the file is rewritten (merged with what other processes wrote) at
+    most every `save_interval` seconds. Either way the learned fields are
+    used for queries and lookups whose `_source` is "learned".
+    """
+
+    def __init__(self, path, learning=False, save_interval=DEFAULT_SAVE_INTERVAL,
+                 clock=time.time):
+        self.path = path
+        self.learning = learning
+        self.save_interval = save_interval
+        self.clock = clock
+        self.fields = self.read()
+        self._dirty = False
+        self._saved_at = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_location(cls, location, **kwargs):
+        return cls(os.path.join(location, SOURCE_FIELDS_FILENAME), **kwargs)
+
+    def read(self):
+        fields = {}
+        if os.path.exists(self.path):
+            with codecs.open(self.path, 'r', 'utf-8') as fields_file:
+                try:
+                    learned = json.loads(fields_file.read())
+                except ValueError:
+                    logger.warning("%s is not valid JSON", self.path)
+                    learned = {}
+            for name, templates in learned.items():
+                fields[name] = dict((template, set(names))
+                                    for template, names in templates.items())
+        return fields
+
+    def record(self, name, template, fieldname):
+        if fieldname.startswith('__'):
+            # Python and Jinja probing for special methods
+            return
+        templates = self.fields.get(name)
+        if templates is not None and fieldname in templates.get(template, ()):
+            return
+        with self._lock:
+            self.fields.setdefault(name, {}).setdefault(
+                template, set()).add(fieldname)
+            self._dirty = True
+            due = self.clock() - self._saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def includes(self, name, template=None):
+        """
+        The fields to fetch for `name` when rendering `template`: those
+        learned for that template, or for every template if it hasn't been
+        seen yet. None if nothing has been learned, meaning the whole
+        `_source` is fetched.
+        """
+        with self._lock:
+            templates = self.fields.get(name)
+            if not templates:
+                return None
+            if template in templates:
+                return sorted(templates[template])
+            return sorted(set().union(*templates.values()))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._saved_at = self.clock()
+            merged = self.read()
+            for name, templates in self.fields.items():
+                for template, names in templates.items():
+                    merged.setdefault(name, {}).setdefault(
+                        template, set()).update(names)
+            self.fields = merged
+            serialized = json.dumps(
+                dict((name, dict((template, sorted(names))
+                                 for template, names in templates.items()))
+                     for name, templates in merged.items()),
+                indent=4, sort_keys=True)
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with codecs.open(temporary_path, 'w', 'utf-8') as fields_file:
+            fields_file.write(serialized)
+        os.rename(temporary_path, self.path)
+
+
+def source_fields():
+    return getattr(flask.current_app, 'source_fields', None)
+
+
+def resolve_source(name, source, template=None):
+    """
+    The `_source` filter to send for a query or lookup: its configured
+    `source`, or if that is "learned", the fields learned for `template`
+    (the page template being rendered by default).
+    """
+    if source != LEARNED:
+        return source
+    learned = source_fields()
+    if learned is None:
+        return None
+    return learned.includes(name, template or page_template())
+
+
+def learning_source_fields():
+    learned = source_fields()
+    if learned is not None and learned.learning:
+        return learned
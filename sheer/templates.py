@@ -1,7 +1,18 @@
+import os
+import time
+import codecs
 import datetime
+import threading
+
 import flask
+from flask.templating import DispatchingJinjaLoader
 from dateutil import parser
 
+from .caching import LRUCache
+from .dependencies import record_file
+
+DEFAULT_LOADER_CACHE_SIZE = 400
+
 
 def date_formatter(value, format="%Y-%m-%d"):
     if type(value) not in [datetime.datetime, datetime.date]:
@@ -10,3 +21,143 @@ def date_formatter(value, format="%Y-%m-%d"):
         dt = value
 
     return dt.strftime(format)
+
+
+def request_directory():
+    """
+    The directory part of the current request path, which is what a
+    template search path depends on.
+    """
+    if not flask.has_request_context():
+        return '/'
+    path = flask.request.path
+    return path[:path.rfind('/') + 1]
+
+
+def compile_template(environment, source, name, filename, globals=None,
+                     uptodate=None):
+    """
+    Compile a template, going through the environment's bytecode cache (if
+    one is configured) the same way Jinja's own loaders do.
+    """
+    bytecode_cache = environment.bytecode_cache
+    if bytecode_cache is not None:
+        bucket = bytecode_cache.get_bucket(environment, name or filename,
+                                           filename, source)
+        code = bucket.code
+        if code is None:
+            code = environment.compile(source, name, filename)
+            bucket.code = code
+            bytecode_cache.set_bucket(bucket)
+    else:
+        code = environment.compile(source, name, filename)
+    return environment.template_class.from_code(
+        environment, code, environment.make_globals(globals), uptodate)
+
+
+class SiteTemplateLoader(DispatchingJinjaLoader):
+    """
+    Flask's dispatching loader, with compiled `{% extends %}` and
+    `{% include %}` templates cached by the file they were loaded from.
+
+    Sheer resolves template names against a search path that depends on the
+    request directory, so Jinja's name-keyed cache is disabled and this
+    loader keeps two bounded caches instead: (directory, name) -> template,
+    and filename -> template. A layout used from many directories is
+    compiled once.
+    """
+
+    def __init__(self, app, maxsize=DEFAULT_LOADER_CACHE_SIZE):
+        super(SiteTemplateLoader, self).__init__(app)
+        self.resolved = LRUCache(maxsize)
+        self.compiled = LRUCache(maxsize)
+
+    def _is_current(self, template):
+        # Checked the same way as the app's page templates: never again
+        # once compiled in production, on every load otherwise.
+        template_cache = getattr(self.app, 'template_cache', None)
+        if template_cache is not None and template_cache.production:
+            return True
+        return template.is_up_to_date
+
+    def load(self, environment, name, globals=None):
+        key = (request_directory(), name)
+        template = self.resolved.get(key)
+        if template is None or not self._is_current(template):
+            source, filename, uptodate = self.get_source(environment, name)
+            template = self.compiled.get(filename)
+            if template is None or not self._is_current(template):
+                template = compile_template(environment, source, name,
+                                            filename, globals, uptodate)
+                self.compiled.set(filename, template)
+            self.resolved.set(key, template)
+
+        if globals:
+            template.globals.update(globals)
+        record_file(template.filename)
+        return template
+
+    def stats(self):
+        return {'resolved': self.resolved.stats(),
+                'compiled': self.compiled.stats()}
+
+
+class TemplateCache(object):
+    """
+    Compiled page templates, keyed on their resolved path.
+
+    A cached template is recompiled when its file's mtime changes. In
+    `production` mode the file is never stat'ed again once compiled.
+    """
+
+    def __init__(self, production=False):
+        self.production = production
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get_template(self, environment, path):
+        path = os.path.realpath(path)
+        record_file(path)
+        cached = self._templates.get(path)
+        if cached is not None and self.production:
+            self.hits += 1
+            return cached[1]
+
+        mtime = os.path.getmtime(path)
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            return cached[1]
+
+        started = time.time()
+        with codecs.open(path, encoding="utf-8") as template_source:
+            # Page templates stay nameless, as with render_template_string.
+            template = compile_template(environment, template_source.read(),
+                                        None, path)
+        with self._lock:
+            self.misses += 1
+            self.compile_time += time.time() - started
+            self._templates[path] = (mtime, template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'compile_time': self.compile_time,
+                'templates': len(self._templates)}
+
+
+def render_cached_template(template_path, **context):
+    app = flask.current_app
+    template = app.template_cache.get_template(app.jinja_env, template_path)
+    # Fields learned from QueryHits are kept by page template
+    root_dir = getattr(app, 'root_dir', None)
+    flask.g.sheer_page_template = os.path.relpath(template_path, root_dir) \
+        if root_dir else template_path
+    return flask.render_template(template, **context)
@@ -0,0 +1,171 @@
+import os
+import json
+import shutil
+import tempfile
+
+import mock
+import flask
+
+from .builder import build_site, output_path, site_files
+from .query import QueryResults, run_search, send_get
+from .templates import TemplateCache, render_cached_template
+
+
+class TestBuilder(object):
+
+    def setup_method(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.root_dir, '_site')
+        self.write('index.html',
+                   '{% for title in search() %}{{ title }} {% endfor %}')
+        self.write('about/index.html', 'about')
+        self.write('about/team.html', 'team')
+        self.write('blog/_single.html', 'post {{ post }}')
+        self.write('static/site.css', 'body {}')
+        self.write('broken.html', 'broken')
+        self.write('_layouts/base.html', 'layout')
+        self.write('.git/config', 'git')
+        self.write('_settings/lookups.json', json.dumps(
+            {'post': {'url': '/blog/<id>/', 'type': 'posts'}}))
+
+        self.posts = {'first': 'First', 'second': 'Second'}
+        self.post_source = None
+        self.es = mock.Mock()
+        self.es.search.side_effect = self.search
+        self.es.get.side_effect = self.get
+        self.es.mget.side_effect = self.mget
+
+        self.app = flask.Flask(__name__)
+        self.app.root_dir = self.root_dir
+        self.app.es = self.es
+        self.app.es_index = 'content'
+        self.app.template_cache = TemplateCache()
+        self.rendered = []
+
+        @self.app.context_processor
+        def add_search():
+            def search():
+                results = run_search(self.es, {'index': 'content', 'body': {}},
+                                     QueryResults)
+                return [hit['_source']['title']
+                        for hit in results.result_dict['hits']['hits']]
+            return {'search': search}
+
+        @self.app.route('/', defaults={'path': ''})
+        @self.app.route('/<path:path>')
+        def page(path):
+            if path == 'broken.html':
+                flask.abort(500)
+            if not path or path.endswith('/'):
+                path += 'index.html'
+            self.rendered.append(path)
+            return render_cached_template(os.path.join(self.root_dir, path))
+
+        @self.app.route('/blog/<id>/', endpoint='post')
+        def post(id):
+            self.rendered.append(id)
+            document = send_get(self.es, 'content', id,
+                                source=self.post_source)
+            return render_cached_template(
+                os.path.join(self.root_dir, 'blog/_single.html'),
+                post=document['_source']['title'])
+
+    def teardown_method(self):
+        shutil.rmtree(self.root_dir)
+
+    def search(self, **kwargs):
+        hits = [{'_id': docid, '_source': {'title': title}}
+                for docid, title in sorted(self.posts.items())]
+        return {'took': 1, 'hits': {'total': len(hits), 'hits': hits}}
+
+    def get(self, index, id, source_includes=None):
+        source = {'title': self.posts[id], 'body': 'About %s' % id}
+        if source_includes is not None:
+            source = dict((field, source[field]) for field in source_includes)
+        return {'_id': id, 'found': True, '_source': source}
+
+    def mget(self, index, body, **params):
+        return {'docs': [self.get(index, docid, **params)
+                         if docid in self.posts
+                         else {'_id': docid, 'found': False}
+                         for docid in body['ids']]}
+
+    def write(self, name, content):
+        path = os.path.join(self.root_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.output_dir, name)) as f:
+            return f.read()
+
+    def build(self, incremental=False):
+        self.rendered = []
+        hits = [{'_id': docid} for docid in sorted(self.posts)]
+        with mock.patch('sheer.builder.scan', return_value=hits) as scan:
+            errors = build_site(self.app, self.output_dir, workers=2,
+                                incremental=incremental)
+        assert scan.call_args[1]['query'] == {'query': {'match_all': {}}}
+        return errors
+
+    def test_private_paths_skipped(self):
+        assert list(site_files(self.root_dir)) == [
+            '/broken.html', '/index.html', '/about/index.html',
+            '/about/team.html', '/static/site.css']
+
+    def test_output_path(self):
+        assert output_path('/out', '/') == '/out/index.html'
+        assert output_path('/out', '/blog/1/') == '/out/blog/1/index.html'
+        assert output_path('/out', '/a/b.html') == '/out/a/b.html'
+
+    def test_build(self):
+        assert self.build() == ['/broken.html returned 500']
+        assert self.read('index.html') == 'First Second '
+        assert self.read('about/index.html') == 'about'
+        assert self.read('about/team.html') == 'team'
+        assert self.read('static/site.css') == 'body {}'
+        assert self.read('blog/first/index.html') == 'post First'
+        assert self.read('blog/second/index.html') == 'post Second'
+        assert not os.path.exists(os.path.join(self.output_dir, '_layouts'))
+        assert not os.path.exists(os.path.join(self.output_dir, 'broken.html'))
+
+    def test_incremental_build_renders_changed_pages(self):
+        self.build()
+        self.build(incremental=True)
+        assert self.rendered == []
+
+        self.posts['second'] = 'Second, edited'
+        self.build(incremental=True)
+        assert sorted(self.rendered) == ['index.html', 'second']
+        assert self.read('index.html') == 'First Second, edited '
+        assert self.read('blog/second/index.html') == 'post Second, edited'
+
+        self.write('about/team.html', 'the team')
+        self.build(incremental=True)
+        assert self.rendered == ['about/team.html']
+
+        self.write('blog/_single.html', 'Post: {{ post }}')
+        self.build(incremental=True)
+        assert sorted(self.rendered) == ['first', 'second']
+
+    def test_incremental_build_removes_deleted_pages(self):
+        self.build()
+        del self.posts['first']
+        self.build(incremental=True)
+        assert self.rendered == ['index.html']
+        assert not os.path.exists(
+            os.path.join(self.output_dir, 'blog/first/index.html'))
+
+    def test_incremental_build_with_filtered_lookups(self):
+        self.post_source = ['title']
+        self.build()
+        self.build(incremental=True)
+        assert self.rendered == []
+        assert self.es.mget.call_args[1]['source_includes'] == ['title']
+
+        self.posts['first'] = 'First, edited'
+        self.build(incremental=True)
+        assert sorted(self.rendered) == ['first', 'index.html']
+        assert self.read('blog/first/index.html') == 'post First, edited'
@@ -0,0 +1,26 @@
+import os
+import shutil
+import tempfile
+
+from .processors import filesystem
+
+
+class TestFilesystemProcessor(object):
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp() + '/'
+        for i in range(10):
+            name = '2014-06-%02d-post-%d.md' % (i + 1, i)
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write('Post number %d' % i)
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_parallel_parsing_matches_serial(self):
+        serial = list(filesystem.documents('posts', directory=self.directory))
+        parallel = list(filesystem.documents('posts', directory=self.directory,
+                                             workers=2, batch_size=3))
+        assert len(serial) == 10
+        assert parallel == serial
+        assert serial[0]['date'].startswith('2014-06')
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from .incremental import IndexState, STATE_FILENAME
+from .indexer import ContentProcessor, index_location, index_processor
+from .test_indexing import AttrDict
+
+
+class TestIncrementalIndexing(object):
+
+    def setup_method(self):
+        self.location = tempfile.mkdtemp()
+        self.documents = [{'_id': 'one', 'title': 'One'},
+                          {'_id': 'two', 'title': 'Two'},
+                          {'title': 'No id'}]
+        self.processor = mock.Mock(spec=ContentProcessor)
+        self.processor.name = 'posts'
+        self.processor.processor_name = 'posts_processor'
+        self.processor.mapping.return_value = {}
+        self.processor.documents.side_effect = \
+            lambda: iter([dict(d) for d in self.documents])
+        self.es = mock.Mock()
+        self.es.indices.get_mapping.return_value = {
+            'content': {'mappings': {'posts': {}}}}
+        self.sent = []
+        self.deleted = []
+
+    def teardown_method(self):
+        shutil.rmtree(self.location)
+
+    def bulk(self, es, actions, **kwargs):
+        actions = list(actions)
+        for action in actions:
+            if action.get('_op_type') == 'delete':
+                self.deleted.append(action['_id'])
+            else:
+                self.sent.append(action.get('_id'))
+        return len(actions), []
+
+    def index(self):
+        self.sent, self.deleted = [], []
+        state = IndexState.for_location(self.location)
+        with mock.patch('sheer.indexer.bulk', side_effect=self.bulk):
+            success = index_processor(self.es, 'content', self.processor,
+                                      state=state.processor('content', 'posts'))
+        state.save()
+        return success
+
+    def test_unchanged_documents_skipped(self):
+        assert self.index()
+        assert self.sent == ['one', 'two', None]
+        assert os.path.exists(os.path.join(self.location, STATE_FILENAME))
+
+        self.documents[1]['title'] = 'Two, edited'
+        self.index()
+        assert self.sent == ['two', None]
+        assert self.deleted == []
+
+    def test_removed_documents_deleted(self):
+        self.index()
+        del self.documents[0]
+        self.index()
+        assert self.sent == [None]
+        assert self.deleted == ['one']
+        self.index()
+        assert self.deleted == []
+
+    def test_state_kept_after_failure(self):
+        self.index()
+        self.documents[0]['title'] = 'One, edited'
+        with mock.patch('sheer.indexer.bulk', side_effect=ValueError):
+            state = IndexState.for_location(self.location)
+            assert not index_processor(
+                self.es, 'content', self.processor,
+                state=state.processor('content', 'posts'))
+            state.save()
+        self.index()
+        assert self.sent == ['one', None]
+
+    def test_clear(self):
+        self.index()
+        state = IndexState.for_location(self.location)
+        state.clear('content', ['posts'])
+        state.save()
+        self.index()
+        assert self.sent == ['one', 'two', None]
+
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
+    @mock.patch('sheer.indexer.Elasticsearch')
+    @mock.patch('sheer.indexer.ContentProcessor')
+    @mock.patch('sheer.indexer.read_json_file')
+    def test_reindex_then_incremental(self, mock_read_json_file,
+                                      mock_ContentProcessor,
+                                      mock_Elasticsearch,
+                                      mock_helper_Elasticsearch):
+        mock_read_json_file.side_effect = lambda path: \
+            {'posts': {'processor': 'posts_processor'}} \
+            if path.endswith('processors.json') else {}
+        mock_ContentProcessor.return_value = self.processor
+        es = mock_Elasticsearch.return_value
+        es.indices.exists.return_value = True
+        es.indices.exists_alias.return_value = False
+        es.indices.get_mapping.return_value = {}
+        es.indices.get_settings.return_value = {}
+        config = {'location': self.location, 'elasticsearch': None,
+                  'index': 'content'}
+
+        with mock.patch('sheer.indexer.bulk', side_effect=self.bulk):
+            index_location(AttrDict(processors=[], reindex=True,
+                                    incremental=True), config)
+            assert self.sent == ['one', 'two', None]
+            self.sent = []
+            index_location(AttrDict(processors=[], reindex=False,
+                                    incremental=True), config)
+        assert self.sent == [None]
+        assert self.deleted == []
+        state = IndexState.for_location(self.location)
+        assert list(state.hashes) == ['content']
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import re
 import sys
 import mock
 from io import StringIO
-from .indexer import ContentProcessor, index_location
+from .indexer import (ContentProcessor, index_location, swap_alias,
+                      prune_indices, bulk_load_settings, BULK_LOAD_SETTINGS,
+                      bump_index_generation)
+from .mappings import GENERATION_META_KEY
 from elasticsearch.exceptions import TransportError
 
 
@@ -48,13 +52,15 @@ class TestIndexing(object):
         self.mock_processor.mapping.return_value = {}
         self.mock_processor.documents.return_value = iter([self.mock_document])
 
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
     @mock.patch('sheer.indexer.bulk')
     @mock.patch('sheer.indexer.Elasticsearch')
     @mock.patch('sheer.indexer.ContentProcessor')
     @mock.patch('sheer.indexer.read_json_file')
     @mock.patch('os.path.exists')
     def test_indexing(self, mock_exists, mock_read_json_file,
-                      mock_ContentProcessor, mock_Elasticsearch, mock_bulk):
+                      mock_ContentProcessor, mock_Elasticsearch, mock_bulk,
+                      mock_helper_Elasticsearch):
         """
         `sheer index`
 
@@ -85,19 +91,24 @@ class TestIndexing(object):
         mock_es.indices.create.assert_called_with(index=self.config['index'])
         mock_bulk.assert_called_with(mock_es,
                                      self.mock_processor.documents())
+        # The live index keeps its settings
+        assert not mock_es.indices.put_settings.called
 
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
     @mock.patch('sheer.indexer.bulk')
     @mock.patch('sheer.indexer.Elasticsearch')
     @mock.patch('sheer.indexer.ContentProcessor')
     @mock.patch('sheer.indexer.read_json_file')
     @mock.patch('os.path.exists')
     def test_reindexing(self, mock_exists, mock_read_json_file,
-                        mock_ContentProcessor, mock_Elasticsearch, mock_bulk):
+                        mock_ContentProcessor, mock_Elasticsearch, mock_bulk,
+                        mock_helper_Elasticsearch):
         """
         `sheer index --reindex`
 
-        Test the re-creation of existing indexes by Sheer. For a given
-        index, if it already exists, it should be removed and recreated.
+        Test the re-creation of existing indexes by Sheer. The documents
+        should be loaded into a new index, which then replaces the existing
+        one in a single alias update.
         """
         # Mock file existing/opening/reading
         # os.path.exists is only called directly for settings.json and
@@ -109,22 +120,68 @@ class TestIndexing(object):
         mock_ContentProcessor.return_value = self.mock_processor
 
         # Here we want to test:
-        #   * Index exists -> should be deleted and recreated.
-        #   ... therefore ...
+        #   * Index exists, from before Sheer used aliases -> a new
+        #     versioned index should be created and loaded with refreshes
+        #     and replicas off, then replace the old index atomically.
         #   * Mappings don't exist for processor -> should be created
         #   * Documents don't exist for processor -> should be created
         mock_es = mock_Elasticsearch.return_value
-        mock_es.indices.exists.side_effect = [True, False]
+        mock_es.indices.exists.return_value = True
+        mock_es.indices.exists_alias.return_value = False
         mock_es.indices.get_mapping.return_value = None
+        mock_es.indices.get_settings.return_value = {'content-1': {
+            'settings': {'index.number_of_replicas': '2'}}}
 
         test_args = AttrDict(processors=[], reindex=True)
         index_location(test_args, self.config)
 
-        mock_es.indices.delete.assert_called_with(self.config['index'])
-        mock_es.indices.create.assert_called_with(index=self.config['index'])
+        new_index = mock_es.indices.create.call_args[1]['index']
+        assert re.match(r'^content-\d{20}$', new_index)
+        assert not mock_es.indices.delete.called
         mock_bulk.assert_called_with(mock_es,
                                      self.mock_processor.documents())
 
+        settings_calls = mock_es.indices.put_settings.call_args_list
+        assert settings_calls[0] == mock.call(index=new_index,
+                                              settings=BULK_LOAD_SETTINGS)
+        assert settings_calls[1] == mock.call(index=new_index, settings={
+            'index.refresh_interval': None,
+            'index.number_of_replicas': '2'})
+        mock_es.indices.refresh.assert_called_with(index=new_index)
+
+        mock_es.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove_index': {'index': 'content'}},
+            {'add': {'index': new_index, 'alias': 'content'}}])
+
+    @mock.patch('sheer.indexer.Elasticsearch')
+    def test_alias_swap_and_pruning(self, mock_Elasticsearch):
+        """
+        Test that a reindexed alias is moved off its old index, and that
+        only the newest old indices are kept.
+        """
+        mock_es = mock_Elasticsearch.return_value
+        mock_es.indices.exists_alias.return_value = True
+        mock_es.indices.get_alias.return_value = {
+            'content-20150102000000000000': {}}
+        swap_alias(mock_es, 'content', 'content-20150103000000000000')
+        mock_es.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove': {'index': 'content-20150102000000000000',
+                        'alias': 'content'}},
+            {'add': {'index': 'content-20150103000000000000',
+                     'alias': 'content'}}])
+
+        mock_es.indices.get_alias.return_value = {
+            'content-20150103000000000000': {}}
+        mock_es.indices.get.return_value = {
+            'content-20150101000000000000': {},
+            'content-20150102000000000000': {},
+            'content-20150103000000000000': {},
+            'content-archive': {}}
+        prune_indices(mock_es, 'content', keep=1)
+        mock_es.indices.delete.assert_called_once_with(
+            index='content-20150101000000000000')
+
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
     @mock.patch('sheer.indexer.bulk')
     @mock.patch('sheer.indexer.Elasticsearch')
     @mock.patch('sheer.indexer.ContentProcessor')
@@ -132,7 +189,7 @@ class TestIndexing(object):
     @mock.patch('os.path.exists')
     def test_partial_indexing(self, mock_exists, mock_read_json_file,
                               mock_ContentProcessor, mock_Elasticsearch,
-                              mock_bulk):
+                              mock_bulk, mock_helper_Elasticsearch):
         """
         `sheer index --processors posts`
 
@@ -165,6 +222,46 @@ class TestIndexing(object):
         index_location(test_args, self.config)
         mock_bulk.assert_called_with(mock_es,
                                      self.mock_processor.documents())
+        assert not mock_es.indices.put_settings.called
+
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
+    @mock.patch('sheer.indexer.bulk')
+    @mock.patch('sheer.indexer.Elasticsearch')
+    @mock.patch('sheer.indexer.ContentProcessor')
+    @mock.patch('sheer.indexer.read_json_file')
+    @mock.patch('os.path.exists')
+    def test_partial_indexing_bulk_load_settings(self, mock_exists,
+                                                 mock_read_json_file,
+                                                 mock_ContentProcessor,
+                                                 mock_Elasticsearch,
+                                                 mock_bulk,
+                                                 mock_helper_Elasticsearch):
+        """
+        `sheer index --processors posts --bulk-load-settings`
+
+        Test that the live index is only loaded with bulk-load settings
+        when asked to.
+        """
+        mock_exists.return_value = False
+        mock_read_json_file.side_effect = [self.mock_processors, {}]
+        mock_ContentProcessor.return_value = self.mock_processor
+
+        mock_es = mock_Elasticsearch.return_value
+        mock_es.indices.exists.return_value = True
+        mock_es.indices.get_mapping.return_value = True
+        mock_es.indices.get_settings.return_value = {'content': {
+            'settings': {'index.number_of_replicas': '1'}}}
+
+        test_args = AttrDict(processors=['posts'], reindex=False,
+                             bulk_load_settings=True)
+        index_location(test_args, self.config)
+
+        settings_calls = mock_es.indices.put_settings.call_args_list
+        assert settings_calls[0] == mock.call(index='content',
+                                              settings=BULK_LOAD_SETTINGS)
+        assert settings_calls[1] == mock.call(index='content', settings={
+            'index.refresh_interval': None,
+            'index.number_of_replicas': '1'})
 
     @mock.patch('sheer.indexer.bulk')
     @mock.patch('sheer.indexer.Elasticsearch')
@@ -338,3 +435,131 @@ class TestIndexing(object):
 
         # Ensure that we got the right error message.
         assert 'error reading documents' in sys.stderr.getvalue()
+
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
+    @mock.patch('sheer.indexer.parallel_bulk')
+    @mock.patch('sheer.indexer.Elasticsearch')
+    @mock.patch('sheer.indexer.ContentProcessor')
+    @mock.patch('sheer.indexer.read_json_file')
+    @mock.patch('os.path.exists')
+    def test_parallel_indexing(self, mock_exists, mock_read_json_file,
+                               mock_ContentProcessor, mock_Elasticsearch,
+                               mock_parallel_bulk, mock_helper_Elasticsearch):
+        """
+        `sheer index --workers 4 --chunk-size 100`
+
+        Test that documents are sent from several threads, and that a
+        document Elasticsearch rejects fails the run.
+        """
+        sys.stderr = StringIO()
+        mock_exists.return_value = False
+        mock_read_json_file.side_effect = [self.mock_processors, {}]
+        mock_ContentProcessor.return_value = self.mock_processor
+
+        mock_es = mock_Elasticsearch.return_value
+        mock_es.indices.exists.return_value = False
+        mock_es.indices.get_mapping.return_value = None
+        mock_parallel_bulk.return_value = iter([
+            (True, {'index': {'_id': 'a-great-post-slug'}}),
+            (False, {'index': {'_id': 'a-bad-post',
+                               'error': 'mapper_parsing_exception'}})])
+
+        test_args = AttrDict(processors=[], reindex=False, workers=4,
+                             chunk_size=100, max_chunk_bytes=None)
+        try:
+            index_location(test_args, self.config)
+        except SystemExit as s:
+            assert s.code == \
+                'Indexing the following processor(s) failed: posts'
+        else:
+            assert False, "indexing should have failed"
+
+        mock_parallel_bulk.assert_called_with(
+            mock_es, self.mock_processor.documents(), thread_count=4,
+            chunk_size=100, raise_on_error=False, raise_on_exception=False)
+        assert 'failed to index 1 documents for posts' in \
+            sys.stderr.getvalue()
+        assert 'a-bad-post: mapper_parsing_exception' in sys.stderr.getvalue()
+
+    @mock.patch('sheer.processors.helpers.Elasticsearch')
+    @mock.patch('sheer.indexer.bulk')
+    @mock.patch('sheer.indexer.Elasticsearch')
+    @mock.patch('sheer.indexer.ContentProcessor')
+    @mock.patch('sheer.indexer.read_json_file')
+    @mock.patch('os.path.exists')
+    def test_concurrent_processors(self, mock_exists, mock_read_json_file,
+                                   mock_ContentProcessor, mock_Elasticsearch,
+                                   mock_bulk, mock_helper_Elasticsearch):
+        """
+        `sheer index --processor-concurrency 2`
+
+        Test that processors run side by side, and that one failing doesn't
+        stop the others or change the exit status.
+        """
+        sys.stderr = StringIO()
+        self.mock_processors['broken'] = {'processor': 'post_processor'}
+        mock_exists.return_value = False
+        mock_read_json_file.side_effect = [self.mock_processors, {}]
+
+        mock_broken_processor = mock.Mock(spec=ContentProcessor)
+        mock_broken_processor.name = 'broken'
+        mock_broken_processor.processor_name = 'posts_processor'
+        mock_broken_processor.mapping.side_effect = RuntimeError("bad mapping")
+        mock_ContentProcessor.side_effect = [self.mock_processor,
+                                             mock_broken_processor]
+
+        mock_es = mock_Elasticsearch.return_value
+        mock_es.indices.exists.return_value = False
+        mock_es.indices.get_mapping.return_value = None
+
+        test_args = AttrDict(processors=[], reindex=False,
+                             processor_concurrency=2)
+        try:
+            index_location(test_args, self.config)
+        except SystemExit as s:
+            assert s.code == \
+                'Indexing the following processor(s) failed: broken'
+        else:
+            assert False, "indexing should have failed"
+
+        mock_bulk.assert_called_once_with(mock_es,
+                                          self.mock_processor.documents())
+        assert 'error indexing broken' in sys.stderr.getvalue()
+        assert 'bad mapping' in sys.stderr.getvalue()
+
+    def test_generation_bump_keeps_other_meta(self):
+        mock_es = mock.Mock()
+        mock_es.indices.get_mapping.return_value = {'content-1': {
+            'mappings': {'_meta': {'owner': 'web',
+                                   GENERATION_META_KEY: 'old'}}}}
+        generation = bump_index_generation(mock_es, 'content')
+        assert generation != 'old'
+        mock_es.indices.put_mapping.assert_called_once_with(
+            index='content', body={'_meta': {'owner': 'web',
+                                             GENERATION_META_KEY: generation}})
+
+    def test_bulk_load_settings_restored_on_failure(self):
+        """
+        Test that the index settings changed for a bulk load are put back,
+        and the index refreshed, when loading fails.
+        """
+        mock_es = mock.Mock()
+        mock_es.indices.get_settings.return_value = {'content': {
+            'settings': {'index.refresh_interval': '30s'}}}
+        try:
+            with bulk_load_settings(mock_es, 'content', async_translog=True):
+                raise ValueError("No JSON object could be decoded")
+        except ValueError:
+            pass
+        else:
+            assert False, "the error should not be swallowed"
+
+        mock_es.indices.put_settings.assert_any_call(index='content', settings={
+            'index.refresh_interval': '-1',
+            'index.number_of_replicas': 0,
+            'index.translog.durability': 'async'})
+        mock_es.indices.put_settings.assert_called_with(index='content', settings={
+            'index.refresh_interval': '30s',
+            'index.number_of_replicas': None,
+            'index.translog.durability': None})
+        mock_es.indices.refresh.assert_called_with(index='content')
@@ -0,0 +1,178 @@
+import datetime
+import threading
+
+import mock
+import flask
+import dateutil.parser
+
+from elasticsearch.exceptions import ConnectionError
+
+from .mappings import (MappingRegistry, GENERATION_META_KEY, compile_coercers,
+                       parse_date)
+from .query import QueryHit
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMappingRegistry(object):
+
+    def setup_method(self):
+        self.es = mock.Mock()
+        self.es.indices.get_mapping.return_value = {
+            'content': {'mappings': {
+                '_meta': {GENERATION_META_KEY: '1'},
+                'posts': {'properties': {'date': {'type': 'date'}}}}}}
+        self.clock = FakeClock()
+        self.registry = MappingRegistry(self.es, 'content', ttl=60,
+                                        clock=self.clock)
+
+    def test_mapping_is_loaded_once(self):
+        for i in range(5):
+            self.registry.get()
+        assert self.es.indices.get_mapping.call_count == 1
+        assert self.registry.stats()['loads'] == 1
+        assert self.registry.stats()['hits'] == 4
+        assert self.registry.generation == '1'
+
+    def test_mapping_reloaded_after_ttl(self):
+        self.registry.get()
+        self.clock.now = 61
+        self.registry.get()
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_mapping_reloaded_on_new_generation(self):
+        self.registry.get()
+        self.registry.observe_generation('1')
+        self.registry.get()
+        assert self.es.indices.get_mapping.call_count == 1
+        self.registry.observe_generation('2')
+        self.registry.get()
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_new_generation_checked_for(self):
+        self.registry.get()
+        self.clock.now = 0.5
+        self.registry.get()
+        assert self.es.indices.get_mapping.call_count == 1
+
+        mapping = self.es.indices.get_mapping.return_value
+        mapping['content']['mappings']['_meta'][GENERATION_META_KEY] = '2'
+        self.clock.now = 1
+        self.registry.get()
+        # The generation check, then the reload
+        assert self.es.indices.get_mapping.call_count == 3
+        assert self.registry.generation == '2'
+        self.clock.now = 1.5
+        self.registry.get()
+        assert self.es.indices.get_mapping.call_count == 3
+
+    def test_failed_generation_check_keeps_mapping(self):
+        mapping = self.registry.get()
+        self.es.indices.get_mapping.side_effect = ConnectionError('down')
+        self.clock.now = 1
+        assert self.registry.get() is mapping
+        self.clock.now = 1.5
+        assert self.registry.get() is mapping
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_hits_share_the_app_registry(self):
+        app = flask.Flask(__name__)
+        app.es = self.es
+        app.es_index = 'content'
+        app.mappings = self.registry
+        hits = [{'_type': 'posts', '_id': str(i), '_source': {}}
+                for i in range(50)]
+        with app.app_context():
+            for hit in hits:
+                QueryHit(hit)
+        assert self.es.indices.get_mapping.call_count == 1
+
+
+class TestCoercion(object):
+
+    def setup_method(self):
+        self.es = mock.Mock()
+        self.es.indices.get_mapping.return_value = {
+            'content': {'mappings': {'posts': {'properties': {
+                'date': {'type': 'date'},
+                'count': {'type': 'integer'},
+                'tags': {'type': 'keyword'}}}}}}
+        self.registry = MappingRegistry(self.es, 'content')
+        self.hit = {'_type': 'posts', '_id': '1',
+                    '_source': {'date': '2014-06-01T10:30:00',
+                                'count': '3',
+                                'tags': ['a', 'b'],
+                                'title': 'Unmapped'}}
+
+    def test_coercers_compiled_per_type(self):
+        coercers = self.registry.coercers_for('posts')
+        assert coercers is self.registry.coercers_for('posts')
+        assert set(coercers.keys()) == set(['date', 'count', 'tags'])
+        assert self.registry.coercers_for('pages') == {}
+
+    def test_coercers_never_compiled_from_a_replaced_mapping(self):
+        self.registry.get()
+        compiling = threading.Event()
+        release = threading.Event()
+
+        def slow_compile(*args):
+            compiling.set()
+            release.wait(5)
+            return compile_coercers(*args)
+
+        def reload():
+            self.registry.invalidate()
+            self.registry.get()
+
+        with mock.patch('sheer.mappings.compile_coercers',
+                        side_effect=slow_compile):
+            compiler = threading.Thread(target=self.registry.coercers_for,
+                                        args=('posts',))
+            compiler.start()
+            compiling.wait(5)
+            self.es.indices.get_mapping.return_value = {
+                'content': {'mappings': {'posts': {'properties': {
+                    'count': {'type': 'integer'}}}}}}
+            reloader = threading.Thread(target=reload)
+            reloader.start()
+            release.set()
+            compiler.join(5)
+            reloader.join(5)
+        assert set(self.registry.coercers_for('posts').keys()) == \
+            set(['count'])
+
+    def test_mapping_found_through_alias(self):
+        mapping = self.es.indices.get_mapping.return_value
+        self.es.indices.get_mapping.return_value = {
+            'content-20150101000000000000': mapping['content']}
+        registry = MappingRegistry(self.es, 'content')
+        assert set(registry.coercers_for('posts').keys()) == \
+            set(['date', 'count', 'tags'])
+
+    def test_hit_values_are_coerced(self):
+        hit = QueryHit(self.hit, mappings=self.registry)
+        assert hit.date == datetime.datetime(2014, 6, 1, 10, 30)
+        assert hit.count == 3
+        assert hit.tags == ['a', 'b']
+        assert hit.title == 'Unmapped'
+        assert hit.missing is None
+
+    def test_coerced_values_are_memoized(self):
+        hit = QueryHit(self.hit, mappings=self.registry)
+        with mock.patch('sheer.query.field_or_source_value',
+                        return_value='2014-06-01') as lookup:
+            assert hit.date is hit.date
+        assert lookup.call_count == 1
+
+    def test_parse_date_matches_dateutil(self):
+        for value in ['2014-06-01', '2014-06-01T10:30:00',
+                      '2014-06-01 10:30:00', '2014-06-01T10:30:00Z',
+                      'June 1, 2014']:
+            assert parse_date(value) == dateutil.parser.parse(value)
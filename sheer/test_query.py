@@ -0,0 +1,472 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from collections import Counter
+
+import mock
+import flask
+import pytest
+
+from elasticsearch.exceptions import ConnectionError
+
+from .caching import SingleFlight
+from .exceptions import InvalidQueryFile
+from .mappings import MappingRegistry
+from .query import (QueryRegistry, QueryFinder, DeferredQueryResults,
+                    ResultCache, decode_cursor, encode_cursor,
+                    msearch_header_and_body, reverse_sort_clause, send_get)
+from .mappings import GENERATION_META_KEY
+from .resilience import Resilience
+
+
+POSTS_QUERY = {'query': {'size': 10, 'sort': 'date:desc'},
+               'filters': [{'term': {'category': 'news'}}],
+               'feed': {'feed_title': 'Posts'}}
+
+
+class QueryTestCase(object):
+    """
+    Sets up a site with a `_queries` directory and a Flask app with a mock
+    Elasticsearch client.
+    """
+
+    def setup_method(self):
+        self.site = tempfile.mkdtemp()
+        self.queries_dir = os.path.join(self.site, '_queries')
+        os.mkdir(self.queries_dir)
+        self.write_query('posts', POSTS_QUERY)
+
+        self.es = mock.Mock()
+        self.es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+        self.es.indices.get_mapping.return_value = {}
+        self.app = flask.Flask(__name__)
+        self.app.es = self.es
+        self.app.es_index = 'content'
+        self.app.mappings = MappingRegistry(self.es, 'content')
+        self.app.query_registry = QueryRegistry(self.queries_dir)
+
+    def teardown_method(self):
+        shutil.rmtree(self.site)
+
+    def write_query(self, name, definition, mtime=None):
+        path = os.path.join(self.queries_dir, name + '.json')
+        with open(path, 'w') as f:
+            f.write(json.dumps(definition))
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+
+class TestQueryRegistry(QueryTestCase):
+
+    def test_definitions_loaded_once(self):
+        registry = QueryRegistry(self.queries_dir)
+        assert registry.get('posts')['query']['size'] == 10
+        with mock.patch('os.path.getmtime') as getmtime:
+            with mock.patch('sheer.query.load_query_file') as load:
+                registry.get('posts')
+                registry.get('missing')
+        assert not getmtime.called
+        assert not load.called
+
+    def test_changes_ignored_without_mtime_checks(self):
+        registry = QueryRegistry(self.queries_dir)
+        registry.get('posts')
+        self.write_query('posts', {'query': {'size': 5}}, mtime=1000)
+        assert registry.get('posts')['query']['size'] == 10
+
+    def test_changes_reloaded_with_mtime_checks(self):
+        registry = QueryRegistry(self.queries_dir, check_mtimes=True)
+        registry.get('posts')
+        self.write_query('posts', {'query': {'size': 5}}, mtime=1000)
+        self.write_query('pages', {'query': {}})
+        assert registry.get('posts')['query']['size'] == 5
+        assert registry.get('pages') is not None
+        os.remove(os.path.join(self.queries_dir, 'pages.json'))
+        assert registry.get('pages') is None
+
+    def test_invalid_definitions(self):
+        self.write_query('broken', {'filters': []})
+        with open(os.path.join(self.queries_dir, 'garbled.json'), 'w') as f:
+            f.write('{"query": ')
+        registry = QueryRegistry(self.queries_dir)
+        with pytest.raises(InvalidQueryFile):
+            registry.get('broken')
+        with pytest.raises(InvalidQueryFile):
+            registry.get('garbled')
+        assert registry.get('posts') is not None
+
+
+class TestQueryFinder(QueryTestCase):
+
+    def test_queries_use_registry_definitions(self):
+        with self.app.test_request_context('/?page=2'):
+            finder = QueryFinder()
+            assert finder.missing is None
+            finder.posts.search_with_url_arguments()
+            finder.posts.search_with_url_arguments()
+
+        search = self.es.search.call_args[1]
+        assert search['from_'] == 10
+        assert search['body']['query']['bool']['filter'] == \
+            [{'term': {'category': 'news'}}]
+        # The shared definition is left untouched by the searches.
+        definition = self.app.query_registry.get('posts')
+        assert 'from_' not in definition['query']
+
+    def test_listing_page_makes_one_search(self):
+        self.app.es_calls = Counter()
+        self.app.es_calls_lock = threading.Lock()
+        self.es.indices.get_mapping.return_value = {'content': {'mappings': {
+            'posts': {'properties': {'date': {'type': 'date'}}}}}}
+        self.es.search.return_value = {'hits': {'total': 20, 'hits': [
+            {'_id': str(n), '_type': 'posts',
+             '_source': {'title': 'Post %s' % n, 'date': '2014-06-0%s' % n}}
+            for n in range(1, 10)]}}
+        template = ('{% for post in queries.posts.search_with_url_arguments() %}'
+                    '{{ post.title }} {{ post.date.day }}, {% endfor %}')
+        with self.app.test_request_context('/'):
+            page = flask.render_template_string(template,
+                                                queries=QueryFinder())
+        assert page.startswith('Post 1 1, Post 2 2,')
+        assert self.app.es_calls == Counter({'search': 1})
+        assert self.es.search.call_count == 1
+        # One mapping for every hit on the page
+        assert self.es.indices.get_mapping.call_count == 1
+
+
+class TestDeferredQueries(QueryTestCase):
+
+    def setup_method(self):
+        super(TestDeferredQueries, self).setup_method()
+        self.app.defer_queries = True
+        hits = {'total': 1, 'hits': [{'_type': 'posts', '_id': '1',
+                                      '_source': {'title': 'One'}}]}
+        aggregations = {'tags': {'buckets': [{'key': 'a', 'doc_count': 1}]}}
+        self.es.msearch.return_value = {'responses': [
+            {'hits': hits},
+            {'hits': hits, 'aggregations': aggregations}]}
+
+    def test_searches_sent_as_one_msearch(self):
+        with self.app.test_request_context('/'):
+            finder = QueryFinder()
+            posts = finder.posts.search_with_url_arguments()
+            tags = finder.posts.possible_values_for('tags')
+            assert isinstance(posts, DeferredQueryResults)
+            assert not self.es.msearch.called
+
+            assert [hit.title for hit in posts] == ['One']
+            assert [bucket['key'] for bucket in tags] == ['a']
+
+        assert self.es.msearch.call_count == 1
+        assert not self.es.search.called
+        body = self.es.msearch.call_args[1]['body']
+        assert len(body) == 4
+        assert body[0] == {'index': 'content'}
+        assert body[1]['sort'] == [{'date': {'order': 'desc'}}]
+        assert body[1]['size'] == 10
+
+    def test_failed_search_sent_again_alone(self):
+        self.es.msearch.return_value = {'responses': [
+            {'error': {'type': 'search_phase_execution_exception'}},
+            {'hits': {'total': 0, 'hits': []}}]}
+        self.es.search.side_effect = ValueError('bad query')
+        with self.app.test_request_context('/'):
+            finder = QueryFinder()
+            posts = finder.posts.search_with_url_arguments()
+            finder.posts.search_with_url_arguments()
+            with pytest.raises(ValueError):
+                posts.total
+
+    def test_url_only_parameters_are_not_batched(self):
+        assert msearch_header_and_body(
+            {'index': 'content', 'body': {}, 'q': 'title:one'}) is None
+        header, body = msearch_header_and_body(
+            {'index': 'content', 'body': {'query': {}}, 'from_': '20',
+             'doc_type': 'posts', 'routing': 'a'})
+        assert header == {'index': 'content', 'routing': 'a'}
+        assert body == {'query': {}, 'from': 20}
+
+
+class TestFacets(QueryTestCase):
+
+    def setup_method(self):
+        super(TestFacets, self).setup_method()
+        self.es.search.return_value = {
+            'hits': {'total': 3, 'hits': []},
+            'aggregations': {
+                'tags': {'buckets': [{'key': 'a', 'doc_count': 2}]},
+                'category': {'buckets': [{'key': 'news', 'doc_count': 3}]}}}
+
+    def test_facets_from_one_search(self):
+        with self.app.test_request_context('/'):
+            facets = QueryFinder().posts.possible_values_for_fields(
+                ['tags', 'category'], facet_size={'tags': 50})
+
+        assert self.es.search.call_count == 1
+        search = self.es.search.call_args[1]
+        assert search['size'] == 0
+        assert search['body']['aggs'] == {
+            'tags': {'terms': {'field': 'tags', 'size': 50}},
+            'category': {'terms': {'field': 'category', 'size': 10000}}}
+        assert facets['tags'][0]['key'] == 'a'
+        assert facets['category'][0]['key'] == 'news'
+
+    def test_facets_share_the_hits_search(self):
+        with self.app.test_request_context('/?filter_tags=a'):
+            results = QueryFinder().posts.search_with_url_arguments(
+                facets=['tags'], facet_size=5)
+            assert results.aggregations('tags')[0]['key'] == 'a'
+
+        assert self.es.search.call_count == 1
+        body = self.es.search.call_args[1]['body']
+        assert body['aggs'] == {'tags': {'terms': {'field': 'tags', 'size': 5}}}
+        assert len(body['query']['bool']['filter']) == 2
+
+
+class TestCursorPagination(QueryTestCase):
+
+    def setup_method(self):
+        super(TestCursorPagination, self).setup_method()
+        self.write_query('archive', {'query': {'size': 2, 'sort': 'date:desc'},
+                                     'pagination': 'cursor',
+                                     'tiebreaker': 'slug'})
+        self.hits = [{'_id': str(n), '_type': 'posts', '_source': {},
+                      'sort': ['2014-06-0%s' % n, 'post-%s' % n]}
+                     for n in range(1, 4)]
+        self.es.search.return_value = {'hits': {'total': 7,
+                                                'hits': self.hits}}
+
+    def search(self, url):
+        with self.app.test_request_context(url):
+            results = QueryFinder().archive.search_with_url_arguments()
+            self.ids = [hit.hit_dict['_id'] for hit in results]
+            self.json = results.json_compatible()
+            urls = (results.url_for_previous_page(),
+                    results.url_for_next_page())
+        return results, urls, self.es.search.call_args[1]
+
+    def test_cursors(self):
+        assert decode_cursor(encode_cursor(['2014-06-01', 3])) == \
+            ['2014-06-01', 3]
+        assert decode_cursor('not a cursor!') is None
+        assert decode_cursor(encode_cursor({'a': 1})) is None
+
+    def test_reverse_sort_clause(self):
+        assert reverse_sort_clause(
+            [{'date': {'order': 'desc'}}, 'slug', '_score',
+             {'title': 'asc'}]) == [
+            {'date': {'order': 'asc'}}, {'slug': {'order': 'desc'}},
+            {'_score': {'order': 'asc'}}, {'title': {'order': 'desc'}}]
+
+    def test_first_page(self):
+        results, (previous_url, next_url), search = self.search('/?page=3')
+        assert search['size'] == 3
+        assert 'from_' not in search and 'sort' not in search
+        assert search['body']['sort'] == [{'date': {'order': 'desc'}}, 'slug']
+        assert 'search_after' not in search['body']
+        assert self.ids == ['1', '2']
+        assert results.previous_cursor is None
+        assert decode_cursor(results.next_cursor) == ['2014-06-02', 'post-2']
+        assert previous_url is None
+        assert next_url == '/?after=' + results.next_cursor
+        assert self.json['next_cursor'] == results.next_cursor
+
+    def test_page_after_cursor(self):
+        cursor = encode_cursor(['2014-06-02', 'post-2'])
+        self.hits.pop()
+        results, (previous_url, next_url), search = self.search(
+            '/?after=%s&filter_tags=a' % cursor)
+        assert search['body']['search_after'] == ['2014-06-02', 'post-2']
+        assert results.next_cursor is None
+        assert decode_cursor(results.previous_cursor) == \
+            ['2014-06-01', 'post-1']
+        assert previous_url.startswith('/?filter_tags=a&before=')
+
+    def test_page_before_cursor(self):
+        cursor = encode_cursor(['2014-06-04', 'post-4'])
+        results, urls, search = self.search('/?before=%s' % cursor)
+        assert search['body']['sort'] == [{'date': {'order': 'asc'}},
+                                          {'slug': {'order': 'desc'}}]
+        assert search['body']['search_after'] == ['2014-06-04', 'post-4']
+        # Fetched in reverse, shown in order
+        assert self.ids == ['2', '1']
+        assert decode_cursor(results.next_cursor) == ['2014-06-01', 'post-1']
+        assert decode_cursor(results.previous_cursor) == \
+            ['2014-06-02', 'post-2']
+
+    def test_cursor_for_another_sort_ignored(self):
+        cursor = encode_cursor(['2014-06-02'])
+        results, urls, search = self.search('/?after=%s' % cursor)
+        assert 'search_after' not in search['body']
+        assert self.ids == ['1', '2']
+        assert results.previous_cursor is None
+
+    def test_cursor_pagination_without_tiebreaker_warns(self):
+        self.write_query('untiebroken', {'query': {'sort': 'date:desc'},
+                                         'pagination': 'cursor'})
+        with mock.patch('sheer.query.logger') as logger:
+            with self.app.test_request_context('/'):
+                QueryFinder().archive
+        # Only for the query without one
+        [warning] = logger.warning.call_args_list
+        assert warning[0][1].endswith('untiebroken.json')
+
+    def test_page_numbers_without_cursor_mode(self):
+        with self.app.test_request_context('/?page=3'):
+            results = QueryFinder().posts.search_with_url_arguments()
+        search = self.es.search.call_args[1]
+        assert search['from_'] == 20
+        assert 'sort' not in search['body']
+        assert results.next_cursor is None
+
+
+class TestResultCache(QueryTestCase):
+
+    def setup_method(self):
+        super(TestResultCache, self).setup_method()
+        self.now = 0
+        self.generation = '1'
+        self.es.indices.get_mapping.side_effect = self.get_mapping
+        self.app.result_cache = ResultCache(self.es, 'content', maxsize=2,
+                                            clock=lambda: self.now)
+
+    def get_mapping(self, **kwargs):
+        return {'content': {'mappings': {
+            '_meta': {GENERATION_META_KEY: self.generation}}}}
+
+    def search(self, path='/'):
+        with self.app.test_request_context(path):
+            return QueryFinder().posts.search_with_url_arguments()
+
+    def test_repeated_searches_served_from_cache(self):
+        self.search()
+        self.search()
+        self.search('/?page=2')
+        assert self.es.search.call_count == 2
+        stats = self.app.result_cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+
+    def test_cache_dropped_on_new_generation(self):
+        self.search()
+        self.generation = '2'
+        self.search()
+        assert self.es.search.call_count == 1
+        self.now = 5
+        self.search()
+        assert self.es.search.call_count == 2
+        assert self.app.result_cache.stats()['invalidations'] == 2
+
+    def test_cache_bypassed_when_generation_unknown(self):
+        self.search()
+        self.now = 5
+        self.es.indices.get_mapping.side_effect = ValueError
+        self.search()
+        assert self.es.search.call_count == 2
+
+    def test_generation_read_with_timeout_and_breaker(self):
+        self.es.options.return_value = self.es
+        self.app.resilience = Resilience(timeout=2, failure_threshold=1)
+        self.es.indices.get_mapping.side_effect = ConnectionError('down')
+        with self.app.app_context():
+            assert not self.app.result_cache.check_generation()
+        self.es.options.assert_any_call(request_timeout=2)
+        assert not self.app.resilience.breaker.allow()
+
+    def test_generation_read_outside_the_lock(self):
+        self.search()
+        self.now = 5
+        reading = threading.Event()
+        release = threading.Event()
+
+        def slow_get_mapping(**kwargs):
+            reading.set()
+            release.wait(5)
+            return self.get_mapping()
+
+        self.es.indices.get_mapping.side_effect = slow_get_mapping
+        checker = threading.Thread(target=self.search)
+        checker.start()
+        assert reading.wait(5)
+        try:
+            reader = threading.Thread(target=self.search)
+            reader.start()
+            reader.join(2)
+            assert not reader.is_alive()
+            assert self.es.search.call_count == 1
+        finally:
+            release.set()
+            checker.join()
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_cache_is_bounded(self):
+        for page in range(1, 5):
+            self.search('/?page=%d' % page)
+        assert self.app.result_cache.stats()['size'] == 2
+        assert self.app.result_cache.stats()['evictions'] == 2
+
+
+class TestSingleFlight(QueryTestCase):
+
+    def setup_method(self):
+        super(TestSingleFlight, self).setup_method()
+        self.app.single_flight = SingleFlight()
+        self.release = threading.Event()
+
+    def blocked(self, response):
+        def call(**kwargs):
+            self.release.wait(5)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return call
+
+    def run_concurrently(self, func, count=4):
+        results = []
+
+        def worker():
+            with self.app.test_request_context('/'):
+                try:
+                    results.append(func())
+                except Exception as e:
+                    results.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while (self.app.single_flight.collapsed < count - 1 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_searches_share_one_call(self):
+        self.es.search.side_effect = self.blocked(
+            {'hits': {'total': 1, 'hits': []}})
+        results = self.run_concurrently(
+            lambda: QueryFinder().posts.search_with_url_arguments())
+        assert self.es.search.call_count == 1
+        assert [r.total for r in results] == [1, 1, 1, 1]
+        assert self.app.single_flight.stats() == {
+            'calls': 1, 'collapsed': 3, 'in_flight': 0}
+
+    def test_errors_are_shared(self):
+        self.es.get.side_effect = self.blocked(KeyError('missing'))
+        results = self.run_concurrently(
+            lambda: send_get(self.es, 'content', 'doc'))
+        assert self.es.get.call_count == 1
+        assert all(isinstance(r, KeyError) for r in results)
+
+    def test_sequential_calls_are_not_collapsed(self):
+        self.es.get.return_value = {'_id': 'doc'}
+        with self.app.test_request_context('/'):
+            send_get(self.es, 'content', 'doc')
+            send_get(self.es, 'content', 'doc')
+        assert self.es.get.call_count == 2
+        assert self.app.single_flight.collapsed == 0
@@ -1,10 +1,14 @@
 import os.path
+import tempfile
+
+import yaml
+import pytest
 
 from sheer import reader
 from sheer.utility import get_case_contents
 
 
-class testReader:
+class TestReader:
 
     def test_frontmatter_extraction(self):
         data = get_case_contents('simple_frontmatter.txt')
@@ -23,3 +27,99 @@ class testReader:
         document = reader.document_from_str(data)
         assert('Website' in document['categories'])
         assert('level playing field' in document['text'])
+
+    def test_frontmatter_ends_at_first_delimiter(self):
+        data = "---\ntitle: One\n---\nText\n\n---\n\nMore text\n"
+        frontmatter, text = reader.extract_frontmatter(data)
+        assert(frontmatter == "\ntitle: One\n")
+        assert(text == "\nText\n\n---\n\nMore text\n")
+
+    def test_unclosed_frontmatter(self):
+        data = "---\ntitle: One\n--- not a delimiter\n"
+        assert(reader.extract_frontmatter(data) == (None, data))
+
+    def test_simple_frontmatter_matches_yaml(self):
+        frontmatter = ("title: Welcome to ConsumerFinance.gov\n"
+                       "date: 2011-02-02 17:00:05\n"
+                       "published: true\n"
+                       "dsq_thread_id: 219744529\n"
+                       "\n"
+                       "url: http://www.consumerfinance.gov/?p=181\n")
+        document = reader.simple_frontmatter(frontmatter)
+        assert(document == yaml.safe_load(frontmatter))
+
+    def test_complex_frontmatter_uses_yaml(self):
+        for frontmatter in ["_id: '181'\n", "categories:\n- Website\n",
+                            "yes: no\n", "title: a # comment\n"]:
+            assert(reader.simple_frontmatter(frontmatter) is None)
+            assert(reader.parse_frontmatter(frontmatter) ==
+                   yaml.safe_load(frontmatter))
+
+    def test_unconstructable_values_raise_yaml_errors(self):
+        for frontmatter in ["title: =\n", "key: <<\n"]:
+            assert(reader.simple_frontmatter(frontmatter) is None)
+            with pytest.raises(yaml.YAMLError):
+                reader.parse_frontmatter(frontmatter)
+
+    def test_tabs_left_to_yaml(self):
+        # The pure Python loader rejects these, and libyaml doesn't
+        for frontmatter in ["title: a\tb\n", "title:\tb\n"]:
+            assert(reader.simple_frontmatter(frontmatter) is None)
+            try:
+                expected = yaml.load(frontmatter,
+                                     Loader=reader.FrontmatterLoader)
+            except yaml.YAMLError:
+                with pytest.raises(yaml.YAMLError):
+                    reader.parse_frontmatter(frontmatter)
+            else:
+                assert(reader.parse_frontmatter(frontmatter) == expected)
+
+    def test_read_document_matches_document_from_str(self):
+        path = os.path.join(os.path.dirname(reader.__file__),
+                                   'testcases', 'post.md')
+        frontmatter, text = reader.read_document(path)
+        assert(reader.document_from_parts(frontmatter, text) ==
+               reader.document_from_str(get_case_contents('post.md')))
+
+    def test_read_document_truncates_text(self):
+        with tempfile.NamedTemporaryFile(suffix='.md') as docfile:
+            docfile.write(u"---\ntitle: One\n---\nCafé au lait".encode('utf-8'))
+            docfile.flush()
+            frontmatter, text = reader.read_document(docfile.name,
+                                                     max_body_bytes=5)
+            assert(frontmatter == "\ntitle: One\n")
+            # The limit falls inside the two bytes of the e acute
+            assert(text == "\nCaf")
+            frontmatter, text = reader.read_document(docfile.name,
+                                                     max_body_bytes=6)
+            assert(text == u"\nCafé")
+
+    def test_unmapped_read_matches_mapped(self):
+        path = os.path.join(os.path.dirname(reader.__file__),
+                                   'testcases', 'post.md')
+        assert(reader.read_document(path, mapped=False) ==
+               reader.read_document(path))
+        with tempfile.NamedTemporaryFile(suffix='.md') as docfile:
+            docfile.write(u"---\ntitle: One\n---\nCafé au lait".encode('utf-8'))
+            docfile.flush()
+            for max_body_bytes in (None, 5, 6, 100):
+                assert(reader.read_document(docfile.name, max_body_bytes,
+                                            mapped=False) ==
+                       reader.read_document(docfile.name, max_body_bytes))
+        with tempfile.NamedTemporaryFile(suffix='.md') as docfile:
+            docfile.write(b"No frontmatter")
+            docfile.flush()
+            assert(reader.read_document(docfile.name, 2, mapped=False) ==
+                   (None, "No"))
+
+    def test_read_frontmatter(self):
+        with tempfile.NamedTemporaryFile(suffix='.md') as docfile:
+            docfile.write(b"---\n_id: one\n---abc\n---\nText")
+            docfile.flush()
+            # The first delimiter-looking line is cut off by the chunk
+            assert(reader.read_frontmatter(docfile.name, chunk_size=16) ==
+                   "\n_id: one\n---abc\n")
+        with tempfile.NamedTemporaryFile(suffix='.md') as docfile:
+            docfile.write(b"\n\nNo frontmatter\n---\n")
+            docfile.flush()
+            assert(reader.read_frontmatter(docfile.name, chunk_size=4) is None)
@@ -0,0 +1,156 @@
+import time
+import threading
+
+import mock
+import flask
+import pytest
+
+from elasticsearch.exceptions import ApiError, ConnectionError
+
+from .exceptions import ElasticsearchUnavailable
+from .mappings import MappingRegistry
+from .query import QueryHit, QueryResults, STALE_KEY, run_search, send_get
+from .resilience import CircuitBreaker, Resilience, is_outage
+from .test_mappings import FakeClock
+
+
+def api_error(status):
+    return ApiError('error', meta=mock.Mock(status=status), body={})
+
+
+class TestCircuitBreaker(object):
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                      clock=self.clock)
+
+    def test_opens_after_repeated_failures(self):
+        self.breaker.record_failure()
+        assert self.breaker.allow()
+        self.breaker.record_failure()
+        assert not self.breaker.allow()
+        assert self.breaker.is_open()
+        assert self.breaker.stats()['rejected'] == 1
+
+    def test_trial_call_after_reset_timeout(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 10
+        assert not self.breaker.is_open()
+        assert self.breaker.allow()
+        assert not self.breaker.allow()
+        self.breaker.record_failure()
+        assert self.breaker.is_open()
+        self.clock.now = 20
+        assert self.breaker.allow()
+        self.breaker.record_success()
+        assert self.breaker.state == CircuitBreaker.CLOSED
+
+    def test_outages_told_apart_from_bad_requests(self):
+        assert is_outage(ConnectionError('down'))
+        assert is_outage(api_error(503))
+        assert is_outage(api_error(429))
+        assert not is_outage(api_error(404))
+        assert not is_outage(ValueError())
+
+
+class TestStaleResponses(object):
+
+    def setup_method(self):
+        self.es = mock.Mock()
+        self.es.options.return_value = self.es
+        self.es.indices.get_mapping.return_value = {}
+        self.es.search.return_value = {'hits': {'total': 1, 'hits': []}}
+        self.app = flask.Flask(__name__)
+        self.app.es = self.es
+        self.app.es_index = 'content'
+        self.app.mappings = MappingRegistry(self.es, 'content')
+        self.app.resilience = Resilience(timeout=2, failure_threshold=2)
+
+    def search(self, fallback=None):
+        with self.app.app_context():
+            return run_search(self.es, {'index': 'content', 'body': {}},
+                              QueryResults, fallback=fallback)
+
+    def test_calls_carry_the_timeout(self):
+        self.search()
+        self.es.options.assert_called_with(request_timeout=2)
+
+    def test_last_good_response_served_on_outage(self):
+        assert not self.search().stale
+        self.es.search.side_effect = ConnectionError('down')
+        results = self.search()
+        assert results.stale
+        assert results.total == 1
+        assert results.json_compatible()['stale']
+        assert self.app.resilience.stats()['stale_served'] == 1
+
+    def test_breaker_stops_calls(self):
+        self.search()
+        self.es.search.side_effect = ConnectionError('down')
+        for i in range(3):
+            assert self.search().stale
+        assert self.es.search.call_count == 3
+        assert self.app.resilience.breaker.state == CircuitBreaker.OPEN
+
+    def test_outage_without_last_good_response_raises(self):
+        self.es.search.side_effect = ConnectionError('down')
+        for i in range(2):
+            with pytest.raises(ConnectionError):
+                self.search()
+        with pytest.raises(ElasticsearchUnavailable):
+            self.search()
+
+    def test_fallback_only_covers_elasticsearch_errors(self):
+        self.es.search.side_effect = api_error(500)
+        empty = {'hits': {'total': 0, 'hits': []}}
+        assert self.search(fallback=empty).total == 0
+        self.es.search.side_effect = ValueError('bug')
+        with pytest.raises(ValueError):
+            self.search(fallback=empty)
+
+    def test_missing_documents_are_not_served_stale(self):
+        self.es.get.return_value = {'_id': 'doc'}
+        with self.app.app_context():
+            send_get(self.es, 'content', 'doc')
+            self.es.get.side_effect = api_error(404)
+            with pytest.raises(ApiError):
+                send_get(self.es, 'content', 'doc')
+        assert self.app.resilience.breaker.failures == 0
+
+    def test_stale_documents_are_marked(self):
+        self.es.get.return_value = {'_id': 'doc', '_type': 'posts',
+                                    '_source': {'title': 'Doc'}}
+        with self.app.app_context():
+            hit = QueryHit(send_get(self.es, 'content', 'doc'))
+            assert not hit.stale
+            self.es.get.side_effect = ConnectionError('down')
+            hit = QueryHit(send_get(self.es, 'content', 'doc'))
+            assert hit.stale
+            assert hit.title == 'Doc'
+        # The last good copy itself isn't marked
+        key = ('get', 'content', 'doc', '{}')
+        assert STALE_KEY not in self.app.resilience.last_good.get(key)
+
+    def test_slow_search_refreshed_in_background(self):
+        self.app.resilience.stale_after = 0.01
+        self.search()
+        release = threading.Event()
+
+        def slow_search(**kwargs):
+            release.wait(5)
+            return {'hits': {'total': 2, 'hits': []}}
+
+        self.es.search.side_effect = slow_search
+        results = self.search()
+        assert results.stale
+        assert results.total == 1
+        release.set()
+        deadline = time.time() + 5
+        while self.app.resilience.stats()['refreshing'] and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        results = self.search()
+        assert not results.stale
+        assert results.total == 2
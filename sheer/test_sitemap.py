@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+
+import mock
+import flask
+
+from elasticsearch.exceptions import ApiError
+
+from .sitemap import add_sitemap_to_sheer, document_hits, write_sitemaps
+
+
+class TestSitemap(object):
+
+    def setup_method(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.es = mock.Mock()
+        self.es.open_point_in_time.return_value = {'id': 'pit-1'}
+        self.pages = [
+            [{'_id': 'first', '_source': {'date': '2014-06-01T00:00:00'},
+              'sort': [1]},
+             {'_id': 'a&b', '_source': {}, 'sort': [2]}],
+            [{'_id': 'third', '_source': {'date': 'not a date'},
+              'sort': [3]}],
+            []]
+        self.es.search.side_effect = \
+            lambda body: {'pit_id': 'pit-2',
+                          'hits': {'hits': self.pages.pop(0)}}
+        self.es.count.return_value = {'count': 3}
+
+        self.app = flask.Flask(__name__)
+        self.app.root_dir = self.output_dir
+        self.app.es = self.es
+        self.app.es_index = 'content'
+        self.app.permalinks_by_type = {'posts': 'post'}
+        self.app.add_url_rule('/blog/<id>/', 'post', lambda id: id)
+        add_sitemap_to_sheer(self.app)
+
+    def teardown_method(self):
+        shutil.rmtree(self.output_dir)
+
+    def read(self, name):
+        with open(os.path.join(self.output_dir, name)) as f:
+            return f.read()
+
+    def test_point_in_time_paging(self):
+        hits = list(document_hits(self.es, 'content', source=['date'],
+                                  page_size=2))
+        assert [hit['_id'] for hit in hits] == ['first', 'a&b', 'third']
+        bodies = [call[1]['body'] for call in self.es.search.call_args_list]
+        assert 'search_after' not in bodies[0]
+        assert bodies[1]['search_after'] == [2]
+        assert bodies[1]['pit']['id'] == 'pit-2'
+        assert bodies[0]['query'] == {'match_all': {}}
+        assert bodies[0]['_source'] == ['date']
+        assert bodies[0]['size'] == 2
+        self.es.close_point_in_time.assert_called_once_with(id='pit-2')
+
+    def test_scroll_without_point_in_time(self):
+        self.es.open_point_in_time.side_effect = ApiError(
+            'error', meta=mock.Mock(status=400), body={})
+        with mock.patch('sheer.sitemap.scan',
+                        return_value=iter([{'_id': 'first'}])) as scan:
+            hits = list(document_hits(self.es, 'content'))
+        assert hits == [{'_id': 'first'}]
+        assert scan.call_args[1]['query']['_source'] is False
+        assert scan.call_args[1]['query']['query'] == {'match_all': {}}
+
+    def test_write_sitemaps(self):
+        entries = [('http://example.com/%s/' % n, None) for n in range(5)]
+        assert write_sitemaps(iter(entries), self.output_dir,
+                              'http://example.com', max_urls=2) == 3
+        index = self.read('sitemap.xml')
+        assert '<loc>http://example.com/sitemap-3.xml</loc>' in index
+        assert 'sitemap-4.xml' not in index
+        assert self.read('sitemap-3.xml').count('<url>') == 1
+        assert self.read('sitemap-1.xml').endswith('</urlset>\n')
+
+    def test_routes(self):
+        client = self.app.test_client()
+        index = client.get('/sitemap.xml').get_data(as_text=True)
+        assert '<loc>http://localhost/sitemap-1.xml</loc>' in index
+        urls = client.get('/sitemap-1.xml').get_data(as_text=True)
+        assert '<url><loc>http://localhost/blog/first/</loc>' \
+            '<lastmod>2014-06-01</lastmod></url>' in urls
+        assert '<url><loc>http://localhost/blog/a&amp;b/</loc></url>' in urls
+        assert '<url><loc>http://localhost/blog/third/</loc></url>' in urls
+
+    def test_one_sitemap_streamed(self):
+        client = self.app.test_client()
+        assert client.get('/sitemap-2.xml').status_code == 404
+        self.es.count.return_value = {'count': 50001}
+        assert client.get('/sitemap.xml').status_code == 404
+
+    def test_written_sitemaps_served(self):
+        written = os.path.join(self.output_dir, '_site')
+        entries = [('http://example.com/%s/' % n, None) for n in range(3)]
+        write_sitemaps(iter(entries), written, 'http://example.com',
+                       max_urls=2)
+        self.es.count.return_value = {'count': 50001}
+        client = self.app.test_client()
+        index = client.get('/sitemap.xml').get_data(as_text=True)
+        assert '<loc>http://example.com/sitemap-2.xml</loc>' in index
+        urls = client.get('/sitemap-2.xml').get_data(as_text=True)
+        assert '<url><loc>http://example.com/2/</loc></url>' in urls
+        assert client.get('/sitemap-3.xml').status_code == 404
+        assert not self.es.search.called
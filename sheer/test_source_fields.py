@@ -0,0 +1,119 @@
+import os
+import json
+import shutil
+import tempfile
+
+import mock
+import flask
+
+from .mappings import MappingRegistry
+from .query import QueryFinder, QueryRegistry
+from .source_fields import ANY_TEMPLATE, SourceFields, source_params
+from .test_mappings import FakeClock
+from .views import do_lookup
+
+
+class TestSourceFields(object):
+
+    def setup_method(self):
+        self.site = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.site, '_queries'))
+        self.write_query('posts', {'query': {'size': 10},
+                                   '_source': ['title', 'date']})
+        self.write_query('archive', {'query': {'size': 10},
+                                     '_source': 'learned'})
+
+        self.es = mock.Mock()
+        self.es.search.return_value = {'hits': {'total': 1, 'hits': [
+            {'_id': '1', '_type': 'posts',
+             '_source': {'title': 'One', 'text': 'Long'}}]}}
+        self.es.get.return_value = {'_id': '1', '_type': 'posts',
+                                    '_source': {'title': 'One'}}
+        self.es.indices.get_mapping.return_value = {}
+        self.clock = FakeClock()
+        self.app = flask.Flask(__name__)
+        self.app.es = self.es
+        self.app.es_index = 'content'
+        self.app.mappings = MappingRegistry(self.es, 'content')
+        self.app.query_registry = QueryRegistry(
+            os.path.join(self.site, '_queries'))
+        self.app.source_fields = SourceFields.for_location(
+            self.site, learning=True, clock=self.clock)
+
+    def teardown_method(self):
+        shutil.rmtree(self.site)
+
+    def write_query(self, name, definition):
+        path = os.path.join(self.site, '_queries', name + '.json')
+        with open(path, 'w') as f:
+            f.write(json.dumps(definition))
+
+    def render(self, template, query_name, fields):
+        with self.app.test_request_context('/'):
+            flask.g.sheer_page_template = template
+            query = getattr(QueryFinder(), query_name)
+            for hit in query.search_with_url_arguments():
+                for field in fields:
+                    getattr(hit, field)
+        return self.es.search.call_args[1]['body'].get('_source')
+
+    def test_source_params(self):
+        assert source_params(None) == {}
+        assert source_params(False) == {'source': False}
+        assert source_params(['title']) == {'source_includes': ['title']}
+        assert source_params({'excludes': ['text']}) == \
+            {'source_excludes': ['text']}
+
+    def test_query_file_source(self):
+        assert self.render('index.html', 'posts', []) == ['title', 'date']
+
+    def test_fields_learned_and_applied(self):
+        assert self.render('index.html', 'archive', ['title']) is None
+        # Unseen templates get every field any template used
+        assert self.render('full.html', 'archive', ['title', 'text']) == \
+            ['title']
+        assert self.render('index.html', 'archive', []) == ['title']
+        assert self.render('full.html', 'archive', []) == ['text', 'title']
+        assert self.render('other.html', 'archive', []) == ['text', 'title']
+
+    def test_learned_fields_saved_and_merged(self):
+        self.render('index.html', 'archive', ['title', '__html__'])
+        path = os.path.join(self.site, '_settings', 'source_fields.json')
+        assert not os.path.exists(path)
+        other = SourceFields(path, learning=True)
+        other.record('archive', 'index.html', 'date')
+        other.save()
+
+        self.clock.now = 10
+        self.render('index.html', 'archive', ['author'])
+        with open(path) as f:
+            assert json.loads(f.read()) == {
+                'archive': {'index.html': ['author', 'date', 'title']}}
+
+    def test_lookup_source(self):
+        with self.app.test_request_context('/blog/1/'):
+            lookup = do_lookup('post', 'posts', source=['title'], id='1')
+            lookup['post'].title
+        self.es.get.assert_called_with(index='content', id='1',
+                                       source_includes=['title'])
+        assert self.app.source_fields.includes('lookup:post') == ['title']
+
+    def test_lookup_fields_learned_across_templates(self):
+        with self.app.test_request_context('/blog/1/'):
+            lookup = do_lookup('post', 'posts', source='learned', id='1')
+            # Only picked once the document has been fetched
+            flask.g.sheer_page_template = 'blog/_single.html'
+            lookup['post'].title
+        with self.app.test_request_context('/blog/2/'):
+            do_lookup('post', 'posts', source='learned', id='2')
+        self.es.get.assert_called_with(index='content', id='2',
+                                       source_includes=['title'])
+        assert self.app.source_fields.fields['lookup:post'] == \
+            {ANY_TEMPLATE: set(['title'])}
+
+    def test_serializing_hits_learns_nothing(self):
+        with self.app.test_request_context('/'):
+            results = QueryFinder().archive.search_with_url_arguments()
+            assert results.json_compatible()['results'] == [
+                {'title': 'One', 'text': 'Long'}]
+        assert self.app.source_fields.includes('archive') is None
@@ -1,4 +1,14 @@
-from sheer.templates import date_formatter
+import os
+import shutil
+import tempfile
+
+import mock
+import flask
+import jinja2
+from jinja2.bccache import FileSystemBytecodeCache
+
+from sheer.templates import (date_formatter, TemplateCache,
+                             render_cached_template, SiteTemplateLoader)
 
 
 class TestTemplates(object):
@@ -7,3 +17,121 @@ class TestTemplates(object):
         date_string = '2012-02'
         result = date_formatter(date_string)
         assert(result == '2012-02-01')
+
+
+class TestTemplateCache(object):
+
+    def setup_method(self):
+        self.site = tempfile.mkdtemp()
+        self.path = os.path.join(self.site, 'index.html')
+        self.write('Hello {{ name }}')
+        self.environment = jinja2.Environment()
+
+    def teardown_method(self):
+        shutil.rmtree(self.site)
+
+    def write(self, source, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(source)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_template_compiled_once(self):
+        cache = TemplateCache()
+        first = cache.get_template(self.environment, self.path)
+        second = cache.get_template(self.environment, self.path)
+        assert first is second
+        assert first.render(name='Sheer') == 'Hello Sheer'
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_template_recompiled_when_changed(self):
+        cache = TemplateCache()
+        cache.get_template(self.environment, self.path)
+        self.write('Goodbye {{ name }}', mtime=1000)
+        template = cache.get_template(self.environment, self.path)
+        assert template.render(name='Sheer') == 'Goodbye Sheer'
+        assert cache.stats()['misses'] == 2
+
+    def test_production_mode_skips_mtime_check(self):
+        cache = TemplateCache(production=True)
+        cache.get_template(self.environment, self.path)
+        self.write('Goodbye {{ name }}', mtime=1000)
+        template = cache.get_template(self.environment, self.path)
+        assert template.render(name='Sheer') == 'Hello Sheer'
+
+    def test_bytecode_cache_shared_between_workers(self):
+        cache_dir = os.path.join(self.site, 'bytecode')
+        os.mkdir(cache_dir)
+        first_worker = jinja2.Environment(
+            bytecode_cache=FileSystemBytecodeCache(cache_dir))
+        TemplateCache().get_template(first_worker, self.path)
+
+        second_worker = jinja2.Environment(
+            bytecode_cache=FileSystemBytecodeCache(cache_dir))
+        with mock.patch.object(second_worker, 'compile') as compile:
+            template = TemplateCache().get_template(second_worker, self.path)
+        assert not compile.called
+        assert template.render(name='Sheer') == 'Hello Sheer'
+
+    def test_render_uses_app_context_processors(self):
+        app = flask.Flask(__name__)
+        app.template_cache = TemplateCache()
+
+        @app.context_processor
+        def add_name():
+            return {'name': 'context'}
+
+        with app.test_request_context('/'):
+            assert render_cached_template(self.path) == 'Hello context'
+            assert render_cached_template(self.path, name='kw') == 'Hello kw'
+        assert app.template_cache.stats()['hits'] == 1
+
+
+class SiteApp(flask.Flask):
+    jinja_options = dict(cache_size=0)
+
+    def create_global_jinja_loader(self):
+        return SiteTemplateLoader(self)
+
+
+class TestSiteTemplateLoader(object):
+
+    def setup_method(self):
+        self.site = tempfile.mkdtemp()
+        with open(os.path.join(self.site, 'include.html'), 'w') as f:
+            f.write('included')
+        self.app = SiteApp(__name__, template_folder=self.site)
+
+    def teardown_method(self):
+        shutil.rmtree(self.site)
+
+    def render(self, path):
+        with self.app.test_request_context(path):
+            return flask.render_template_string('{% include "include.html" %}')
+
+    def test_include_compiled_once_per_file(self):
+        for path in ['/a/', '/b/', '/a/', '/b/c/']:
+            assert self.render(path) == 'included'
+        stats = self.app.jinja_env.loader.stats()
+        assert stats['compiled']['misses'] == 1
+        assert stats['resolved']['hits'] == 1
+
+    def write_include(self, content, mtime):
+        path = os.path.join(self.site, 'include.html')
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def test_changed_include_reloaded_unless_production(self):
+        self.app.template_cache = TemplateCache()
+        # Flask's auto_reload is off outside debug mode; it doesn't matter
+        self.app.jinja_env.auto_reload = False
+        self.write_include('included', 1000)
+        assert self.render('/a/') == 'included'
+        self.write_include('changed', 2000)
+        assert self.render('/a/') == 'changed'
+
+        self.app.template_cache.production = True
+        self.write_include('changed again', 3000)
+        assert self.render('/a/') == 'changed'
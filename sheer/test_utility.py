@@ -1,3 +1,5 @@
+from elasticsearch import Elasticsearch
+
 from .utility import build_search_path, parse_es_host_port_pair, parse_es_hosts
 
 
@@ -49,3 +51,11 @@ class testSearchpaths:
         for result, host, port in zip(parsed, expected_hosts, expected_ports):
             assert(result['host'] == host)
             assert(result['port'] == port)
+
+
+class TestClientHosts(object):
+
+    def test_parsed_hosts_make_a_client(self):
+        es = Elasticsearch(parse_es_hosts("ringo,foo:777"))
+        urls = sorted(node.base_url for node in es.transport.node_pool.all())
+        assert urls == ['http://foo:777', 'http://ringo:9200']
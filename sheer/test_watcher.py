@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+
+from elasticsearch.exceptions import ConnectionError
+
+from .watcher import ChangeIndexer, PollingWatcher, watch
+
+
+class FakeWatcher(object):
+    """
+    Hands out one set of changes per call, advancing a fake clock by the
+    timeout each time.
+    """
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def changes(self, timeout):
+        self.now += timeout
+        return self.batches.pop(0)
+
+    def done(self):
+        return not self.batches
+
+
+class TestWatcher(object):
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+        self.write('2014-06-01-first.md', u"---\ntitle: First\n---\nOne")
+        self.write('second.md', u"---\n_id: '181'\ntitle: Second\n---\nTwo")
+        self.es = mock.Mock()
+        self.actions = []
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, content, mtime=None):
+        with open(self.path(name), 'w') as f:
+            f.write(content)
+        if mtime:
+            os.utime(self.path(name), (mtime, mtime))
+
+    def bulk(self, es, actions, **kwargs):
+        self.actions.append(list(actions))
+        return len(actions), []
+
+    def test_polling_finds_created_changed_and_deleted_files(self):
+        watcher = PollingWatcher([self.directory], interval=0)
+        self.write('2014-06-01-first.md', u"Changed", mtime=1000)
+        self.write('third.md', u"Three")
+        os.remove(self.path('second.md'))
+        self.write('notes.txt', u"Not content")
+        assert watcher.changes(timeout=0) == set([
+            self.path('2014-06-01-first.md'), self.path('third.md'),
+            self.path('second.md')])
+        assert watcher.changes(timeout=0) == set()
+
+    def test_changes_indexed_and_deletions_use_known_ids(self):
+        indexer = ChangeIndexer(self.es, 'content', [self.directory])
+        self.write('2014-06-01-first.md', u"---\ntitle: Changed\n---\nOne")
+        os.remove(self.path('second.md'))
+        with mock.patch('sheer.watcher.bulk', side_effect=self.bulk) as bulk:
+            indexer.index([self.path('2014-06-01-first.md'),
+                           self.path('second.md'),
+                           self.path('never-indexed.md')])
+        [actions] = self.actions
+        assert actions[0]['_id'] == 'first'
+        assert actions[0]['_index'] == 'content'
+        assert actions[0]['title'] == 'Changed'
+        assert actions[1] == {'_op_type': 'delete', '_index': 'content',
+                              '_id': '181'}
+        assert bulk.call_args[1]['refresh'] is True
+
+    def test_changed_id_deletes_old_document(self):
+        indexer = ChangeIndexer(self.es, 'content', [self.directory])
+        self.write('second.md', u"---\n_id: '182'\ntitle: Second\n---\nTwo")
+        with mock.patch('sheer.watcher.bulk', side_effect=self.bulk):
+            indexer.index([self.path('second.md')])
+        [actions] = self.actions
+        assert actions[0] == {'_op_type': 'delete', '_index': 'content',
+                              '_id': '181'}
+        assert actions[1]['_id'] == '182'
+        assert indexer.ids[self.path('second.md')] == '182'
+
+    def test_unparseable_frontmatter_skipped(self):
+        self.write('broken.md', u"---\ntitle: =\n---\nText")
+        indexer = ChangeIndexer(self.es, 'content', [self.directory])
+        assert indexer.ids[self.path('broken.md')] == 'broken'
+        with mock.patch('sheer.watcher.bulk', side_effect=self.bulk):
+            indexer.index([self.path('broken.md')])
+        assert self.actions == []
+
+    def test_changes_are_batched(self):
+        change_indexer = mock.Mock()
+        watcher = FakeWatcher([set(['a.md']), set(['b.md']), set(),
+                               set(['c.md']), set(['d.md']), set(['e.md']),
+                               set(['f.md']), set(['g.md'])])
+        watch(watcher, change_indexer, debounce=0.2, max_delay=0.5,
+              clock=watcher.clock, should_stop=watcher.done)
+        batches = [call[0][0] for call in change_indexer.index.call_args_list]
+        # Quiet after b.md; then c.md keeps changing past max_delay
+        assert batches == [set(['a.md', 'b.md']),
+                           set(['c.md', 'd.md', 'e.md', 'f.md']),
+                           set(['g.md'])]
+
+    def test_failed_batch_is_resent(self):
+        indexer = ChangeIndexer(self.es, 'content', [self.directory])
+        os.remove(self.path('second.md'))
+        with mock.patch('sheer.watcher.bulk',
+                        side_effect=ConnectionError('down')):
+            with pytest.raises(ConnectionError):
+                indexer.index([self.path('second.md')])
+        with mock.patch('sheer.watcher.bulk', side_effect=self.bulk):
+            indexer.index([self.path('second.md')])
+        assert self.actions == [[{'_op_type': 'delete', '_index': 'content',
+                                  '_id': '181'}]]
+
+    def test_batches_retried_after_errors(self):
+        batches = []
+
+        def index(paths):
+            batches.append(set(paths))
+            if len(batches) == 1:
+                raise ConnectionError('down')
+
+        change_indexer = mock.Mock()
+        change_indexer.index.side_effect = index
+        watcher = FakeWatcher([set(['a.md']), set(), set(['b.md']), set(),
+                               set(), set()])
+        watch(watcher, change_indexer, debounce=0.2, max_delay=0.5,
+              retry_delay=0.5, clock=watcher.clock, should_stop=watcher.done)
+        # Not resent until retry_delay is up, then with the new change too
+        assert batches == [set(['a.md']), set(['a.md', 'b.md'])]
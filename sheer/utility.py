@@ -88,7 +88,7 @@ def parse_es_host_port_pair(pair):
     else:
         port = 9200
 
-    return dict(host=host, port=port)
+    return dict(host=host, port=port, scheme='http')
 
 
 def parse_es_hosts(packed_hosts):
@@ -1,5 +1,4 @@
 import os.path
-import codecs
 import mimetypes
 import re
 
@@ -10,21 +9,30 @@ from werkzeug.exceptions import HTTPException, NotFound
 from elasticsearch.exceptions import NotFoundError
 
 from .utility import build_search_path, build_search_path_for_request, find_in_search_path
-from .query import QueryHit
+from .query import QueryHit, send_get
+from .templates import render_cached_template
+from .source_fields import ANY_TEMPLATE, resolve_source
 
 always_404_pattern = re.compile(r'/[._]')
 
-def do_lookup(name, doc_type, **search_params):
+def lookup_source_name(name):
+    return 'lookup:%s' % name
+
+
+def do_lookup(name, doc_type, source=None, **search_params):
     es = flask.current_app.es
     es_index = flask.current_app.es_index
 
     lookup_name = name
     id = search_params['id']
+    source_name = lookup_source_name(name)
 
     try:
         # Modern Elasticsearch doesn't use doc_type in get
-        document = es.get(index=es_index, id=id)
-        hit = QueryHit(document)
+        document = send_get(es, es_index, id, source=resolve_source(
+            source_name, source, ANY_TEMPLATE))
+        hit = QueryHit(document, source_name=source_name,
+                       source_template=ANY_TEMPLATE)
         return {lookup_name: hit}
     except NotFoundError:
         return None
@@ -59,7 +67,8 @@ def handle_request(lookup_name=None, lookup_config=None, **kwargs):
         del search_params['url']
         del search_params['type']
 
-        lookup_doc = do_lookup(lookup_name, doc_type, **kwargs)
+        lookup_doc = do_lookup(lookup_name, doc_type,
+                               source=lookup_config.get('_source'), **kwargs)
 
     template_candidates = [translated_path]
     if lookup_doc:
@@ -75,8 +84,7 @@ def handle_request(lookup_name=None, lookup_config=None, **kwargs):
             template_context = {}
             template_context.update(lookup_doc or {})
 
-            with codecs.open(template_path, encoding="utf-8") as template_source:
-                return flask.render_template_string(template_source.read(), **template_context)
+            return render_cached_template(template_path, **template_context)
 
     except StopIteration:
         return serve_error_page(404)
@@ -92,7 +100,6 @@ def serve_error_page(error_code):
     template_path = find_in_search_path('%s.html' % error_code, search_path)
 
     if template_path:
-        with codecs.open(template_path, encoding="utf-8") as template_source:
-            return flask.render_template_string(template_source.read()), error_code
+        return render_cached_template(template_path), error_code
     else:
         return "Please provide a %s.html!" % error_code, error_code
@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import logging
+
+import yaml
+
+from elasticsearch.helpers import bulk
+
+from sheer.reader import (annotations_from_filename, document_from_path,
+                          parse_frontmatter, read_frontmatter)
+from sheer.resilience import SEARCH_ERRORS
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+# Send a batch once no file has changed for this long...
+DEFAULT_DEBOUNCE = 0.2
+# ...or once its first change is this old, even if files keep changing.
+MAX_BATCH_DELAY = 0.8
+DEFAULT_POLL_INTERVAL = 0.25
+# How long to wait before sending a batch Elasticsearch didn't take again
+RETRY_DELAY = 5
+
+CONTENT_EXTENSION = '.md'
+
+
+def is_content_file(path):
+    return path.endswith(CONTENT_EXTENSION)
+
+
+class PollingWatcher(object):
+    """
+    Finds changed content files by comparing the modification times and
+    sizes in each directory every `interval` seconds.
+    """
+
+    def __init__(self, directories, interval=DEFAULT_POLL_INTERVAL):
+        self.directories = directories
+        self.interval = interval
+        self.snapshots = dict((directory, self.snapshot(directory))
+                              for directory in directories)
+
+    def snapshot(self, directory):
+        files = {}
+        for entry in os.scandir(directory):
+            if is_content_file(entry.name) and entry.is_file():
+                stat = entry.stat()
+                files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def changes(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        for directory in self.directories:
+            before = self.snapshots[directory]
+            after = self.snapshot(directory)
+            for path in set(before) | set(after):
+                if before.get(path) != after.get(path):
+                    changed.add(path)
+            self.snapshots[directory] = after
+        return changed
+
+
+class InotifyWatcher(object):
+    """
+    Finds changed content files through inotify, without reading the
+    directories at all.
+    """
+
+    def __init__(self, directories):
+        flags = inotify_simple.flags
+        self.inotify = inotify_simple.INotify()
+        mask = (flags.CLOSE_WRITE | flags.CREATE | flags.DELETE |
+                flags.MODIFY | flags.MOVED_FROM | flags.MOVED_TO)
+        self.directories = dict((self.inotify.add_watch(directory, mask),
+                                 directory)
+                                for directory in directories)
+
+    def changes(self, timeout):
+        changed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if is_content_file(event.name):
+                changed.add(os.path.join(self.directories[event.wd],
+                                         event.name))
+        return changed
+
+
+def make_watcher(directories):
+    if inotify_simple is not None:
+        return InotifyWatcher(directories)
+    logger.info("inotify_simple is not installed, polling for changes")
+    return PollingWatcher(directories)
+
+
+def document_id(path):
+    """
+    The `_id` the document at `path` is indexed under, read from its
+    frontmatter if it sets one.
+    """
+    docid = annotations_from_filename(os.path.basename(path))['_id']
+    try:
+        frontmatter = read_frontmatter(path)
+        if frontmatter:
+            docid = (parse_frontmatter(frontmatter) or {}).get('_id', docid)
+    except (IOError, ValueError, yaml.YAMLError):
+        pass
+    return docid
+
+
+class ChangeIndexer(object):
+    """
+    Sends the documents for changed content files to Elasticsearch, and
+    deletes the documents for files that are gone.
+    """
+
+    def __init__(self, es, index_name, directories, max_body_bytes=None,
+                 on_batch=None):
+        self.es = es
+        self.index_name = index_name
+        self.max_body_bytes = max_body_bytes
+        self.on_batch = on_batch
+        # Deleted files can't be read, so remember which id each file has
+        self.ids = {}
+        for directory in directories:
+            for entry in os.scandir(directory):
+                if is_content_file(entry.name):
+                    self.ids[entry.path] = document_id(entry.path)
+
+    def actions(self, paths, ids):
+        """
+        The bulk actions for `paths`, noting in `ids` the id each path has
+        once they are sent, or None if it is gone.
+        """
+        for path in sorted(paths):
+            if os.path.exists(path):
+                try:
+                    # Not memory-mapped, since an editor may be
+                    # rewriting the file right now
+                    document = document_from_path(path, self.max_body_bytes,
+                                                  mapped=False)
+                except (IOError, ValueError, yaml.YAMLError):
+                    logger.warning("could not read %s", path, exc_info=True)
+                    continue
+                ids[path] = document['_id']
+                known_id = self.ids.get(path)
+                if known_id is not None and known_id != document['_id']:
+                    # Its frontmatter `_id` changed, leaving the old
+                    # document behind
+                    yield {'_op_type': 'delete',
+                           '_index': self.index_name,
+                           '_id': known_id}
+                document.setdefault('_index', self.index_name)
+                yield document
+            elif path in self.ids:
+                ids[path] = None
+                yield {'_op_type': 'delete',
+                       '_index': self.index_name,
+                       '_id': self.ids[path]}
+
+    def index(self, paths):
+        ids = {}
+        actions = list(self.actions(paths, ids))
+        if not actions:
+            return 0, []
+        # Refreshed right away, so edits are searchable without waiting
+        indexed, errors = bulk(self.es, actions, raise_on_error=False,
+                               refresh=True)
+        # Only once the batch went through, so a failed one can be resent
+        for path, docid in ids.items():
+            if docid is None:
+                del self.ids[path]
+            else:
+                self.ids[path] = docid
+        sys.stdout.write("indexed %s changed files\n" % indexed)
+        for error in errors:
+            if error.get('delete', {}).get('status') != 404:
+                sys.stderr.write("failed to index %s\n" % error)
+        if self.on_batch is not None:
+            self.on_batch()
+        return indexed, errors
+
+
+def send_batch(change_indexer, paths):
+    """
+    Index the changed `paths`. Returns False if Elasticsearch couldn't
+    take them, so they can be sent again.
+    """
+    try:
+        change_indexer.index(paths)
+    except SEARCH_ERRORS:
+        logger.warning("could not index %s changed files", len(paths),
+                       exc_info=True)
+        return False
+    return True
+
+
+def watch(watcher, change_indexer, debounce=DEFAULT_DEBOUNCE,
+          max_delay=MAX_BATCH_DELAY, retry_delay=RETRY_DELAY, clock=time.time,
+          should_stop=None):
+    """
+    Collect changes from `watcher` and hand them to `change_indexer` in
+    batches: once `debounce` seconds pass without a change, or once the
+    oldest change in the batch is `max_delay` seconds old. A batch that
+    fails is kept, along with any new changes, and sent again after
+    `retry_delay` seconds.
+    """
+    pending = set()
+    first_change = None
+    retry_at = None
+    while should_stop is None or not should_stop():
+        changed = watcher.changes(timeout=debounce)
+        now = clock()
+        if changed:
+            if not pending:
+                first_change = now
+            pending |= changed
+            if now - first_change < max_delay:
+                continue
+        if pending and (retry_at is None or now >= retry_at):
+            if send_batch(change_indexer, pending):
+                pending = set()
+                retry_at = None
+            else:
+                retry_at = now + retry_delay
+    if pending:
+        send_batch(change_indexer, pending)
@@ -1,38 +1,61 @@
 import os
 import os.path
 import re
+import atexit
 import functools
 import codecs
 import markdown
 import datetime
+import threading
+from collections import Counter
 from urllib.parse import urlparse
 
 import flask
 import elasticsearch
 
 from jinja2.loaders import FileSystemLoader
+from jinja2.bccache import FileSystemBytecodeCache
 from werkzeug.routing import RequestRedirect
 from .apis import add_apis_to_sheer
-from .templates import date_formatter
+from .templates import date_formatter, TemplateCache, SiteTemplateLoader, request_directory
+from .caching import LRUCache, SingleFlight
+from .resilience import Resilience
 from .views import handle_request, serve_error_page
 from .utility import build_search_path, add_site_libs, build_search_path_for_request, find_in_search_path
-from .query import QueryFinder, add_query_utilities
+from .query import QueryFinder, QueryRegistry, ResultCache, add_query_utilities
 from .filters import add_filter_utilities
 from .feeds import add_feeds_to_sheer
+from .sitemap import add_sitemap_to_sheer
 from .indexer import read_json_file
+from .mappings import MappingRegistry
+from .source_fields import SourceFields
 
 IGNORE_PATH_RE = [r'^[._].+', r'(_includes|_layouts)($|/)']
 IGNORE_PATH_RE_COMPILED = [re.compile(pattern, flags=re.M)
                            for pattern in IGNORE_PATH_RE]
 
+SEARCH_PATH_LOADERS_MAXSIZE = 256
+
 
 class Sheer(flask.Flask):
 
+    # Template names resolve differently depending on the request directory,
+    # so Jinja's name-keyed cache is off; SiteTemplateLoader caches instead.
+    jinja_options = dict(flask.Flask.jinja_options, cache_size=0)
+
     def __init__(self,  *args, **kwargs):
 
         self.root_dir = kwargs['sheer_root']
         self.es = elasticsearch.Elasticsearch(kwargs['elasticsearch_servers'])
         self.es_index = kwargs['es_index']
+        # Shared by every QueryHit, so a page of results costs one
+        # get_mapping call per TTL instead of one per hit.
+        self.mappings = MappingRegistry(self.es, self.es_index)
+        self.es_calls = Counter()
+        self.es_calls_lock = threading.Lock()
+        self.search_path_loaders = LRUCache(SEARCH_PATH_LOADERS_MAXSIZE)
+        # Identical searches and gets running at the same time share a call
+        self.single_flight = SingleFlight()
 
         del kwargs['sheer_root']
         del kwargs['elasticsearch_servers']
@@ -42,13 +65,19 @@ class Sheer(flask.Flask):
 
     @property
     def jinja_loader(self, *args, **kwargs):
-        request = flask.request
-        search_path = build_search_path(self.root_dir,
-                                        request.path,
-                                        append=['_layouts', '_includes'],
-                                        include_start_directory=True)
-
-        return FileSystemLoader(search_path)
+        directory = request_directory()
+        loader = self.search_path_loaders.get(directory)
+        if loader is None:
+            search_path = build_search_path(self.root_dir,
+                                            directory,
+                                            append=['_layouts', '_includes'],
+                                            include_start_directory=True)
+            loader = FileSystemLoader(search_path)
+            self.search_path_loaders.set(directory, loader)
+        return loader
+
+    def create_global_jinja_loader(self):
+        return SiteTemplateLoader(self)
 
     def dispatch_request(self):
         try:
@@ -86,6 +115,43 @@ def app_with_config(config):
     if config.get('debug'):
         app.debug = True
 
+    # Template searches are queued and sent as one _msearch per page.
+    app.defer_queries = config.get('defer_queries', False)
+
+    # Repeated searches are answered from memory until the next `sheer index`.
+    app.result_cache = None
+    if config.get('result_cache_size'):
+        app.result_cache = ResultCache(app.es, app.es_index,
+                                       maxsize=int(config['result_cache_size']),
+                                       mappings=app.mappings)
+
+    # Searches time out, and a failing cluster gets the last good responses
+    # served in its place while it recovers.
+    app.resilience = Resilience(timeout=config.get('search_timeout'),
+                                stale_after=config.get('stale_after'))
+
+    # Fields templates read from hits, used by queries and lookups whose
+    # _source is "learned"; recorded as pages render in learning mode.
+    app.source_fields = SourceFields.for_location(
+        root_dir, learning=config.get('learn_source_fields', False))
+    if app.source_fields.learning:
+        atexit.register(app.source_fields.save)
+
+    # _queries/*.json are parsed once; in debug mode they are re-read
+    # when they change on disk.
+    app.query_registry = QueryRegistry(os.path.join(root_dir, '_queries'),
+                                       check_mtimes=app.debug)
+
+    # In production, compiled page templates are never checked for changes.
+    app.template_cache = TemplateCache(production=config.get('production', False))
+
+    # Shared on disk, so new or restarted workers skip compiling templates.
+    if config.get('bytecode_cache'):
+        bytecode_cache_dir = config['bytecode_cache']
+        # Several worker processes can start up at once
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
     # Load blueprints
     blueprints_path = os.path.join(root_dir, '_settings/blueprints.json')
     if os.path.exists(blueprints_path):
@@ -166,6 +232,7 @@ def app_with_config(config):
     add_query_utilities(app)
     add_apis_to_sheer(app)
     add_feeds_to_sheer(app)
+    add_sitemap_to_sheer(app)
     add_filter_utilities(app)
 
     return app
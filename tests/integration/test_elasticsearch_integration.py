@@ -5,8 +5,10 @@ import os
 import sys
 import pytest
 from elasticsearch import Elasticsearch
+from sheer.builder import lookup_ids
 from sheer.indexer import index_location, ContentProcessor, read_json_file
 from sheer.query import QueryFinder, Query
+from sheer.sitemap import document_hits
 from sheer.wsgi import app_with_config
 
 
@@ -113,11 +115,15 @@ class TestElasticsearchIntegration:
         # Get mappings
         mappings = es.indices.get_mapping(index="test_mappings")
 
-        assert "test_mappings" in mappings
-        assert "mappings" in mappings["test_mappings"]
+        # test_mappings is an alias, so the mapping is keyed by the index it
+        # points to
+        mappings = dict(mappings)
+        assert len(mappings) == 1
+        index_mappings = list(mappings.values())[0]
+        assert "mappings" in index_mappings
 
         # Check that our expected fields are in the mapping
-        props = mappings["test_mappings"]["mappings"]["properties"]
+        props = index_mappings["mappings"]["properties"]
         assert "title" in props
         assert "author" in props
         assert "date" in props
@@ -273,3 +279,41 @@ class TestElasticsearchIntegration:
         # Should still have documents
         result = es.count(index="test_partial")
         assert result['count'] > 0
+
+    def test_lookup_ids(self, elasticsearch_container, test_data_dir):
+        """Test that a static build expands lookups for indexed documents."""
+        es = Elasticsearch([elasticsearch_container["url"]])
+
+        config = {
+            "location": test_data_dir,
+            "elasticsearch": [elasticsearch_container["url"]],
+            "index": "test_lookups"
+        }
+
+        args = Args(reindex=True)
+        index_location(args, config)
+
+        es.indices.refresh(index="test_lookups")
+
+        ids = set(lookup_ids(es, "test_lookups"))
+        assert len(ids) == es.count(index="test_lookups")['count'] == 3
+
+    def test_sitemap_document_hits(self, elasticsearch_container,
+                                   test_data_dir):
+        """Test that the sitemap lists every indexed document."""
+        es = Elasticsearch([elasticsearch_container["url"]])
+
+        config = {
+            "location": test_data_dir,
+            "elasticsearch": [elasticsearch_container["url"]],
+            "index": "test_sitemap"
+        }
+
+        args = Args(reindex=True)
+        index_location(args, config)
+
+        es.indices.refresh(index="test_sitemap")
+
+        hits = list(document_hits(es, "test_sitemap", source=["date"]))
+        assert len(hits) == 3
+        assert all("date" in hit["_source"] for hit in hits)
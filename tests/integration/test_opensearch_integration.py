@@ -163,11 +163,15 @@ class TestOpenSearchIntegration:
         # Get mappings
         mappings = os_client.indices.get_mapping(index="test_os_mappings")
 
-        assert "test_os_mappings" in mappings
-        assert "mappings" in mappings["test_os_mappings"]
+        # test_os_mappings is an alias, so the mapping is keyed by the index it
+        # points to
+        mappings = dict(mappings)
+        assert len(mappings) == 1
+        index_mappings = list(mappings.values())[0]
+        assert "mappings" in index_mappings
 
         # Check that our expected fields are in the mapping
-        props = mappings["test_os_mappings"]["mappings"]["properties"]
+        props = index_mappings["mappings"]["properties"]
         assert "title" in props
         assert "author" in props
         assert "date" in props